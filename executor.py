@@ -0,0 +1,1074 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Bounded, cancellable execution of command methods for squires.
+
+A command method can be run in one of several executors:
+
+  inline: In the calling thread. This is the default. A timeout is
+    enforced with SIGALRM, so only interrupts Python code.
+  thread: In a worker thread. The caller waits for it, and on timeout or
+    ctrl-c regains control within CANCEL_GRACE seconds, whether or not
+    the method cooperates.
+  process: In a forked child process. Output is streamed back to the
+    caller's stdout (and so through any pipes). On timeout or ctrl-c the
+    child is terminated.
+
+A Pool keeps a set of preforked worker processes, for running CPU bound
+methods without holding up the interactive process, and without the cost
+of a fork (or of rebuilding state) per run. Runs in a pool may have CPU
+time and memory limits.
+
+Each run has a CancelToken. Methods doing long running work should
+check it (or, for coroutines, await it) to stop cleanly when cancelled.
+
+A JobTable runs commands as background jobs on a pool of worker threads,
+each job's output being kept in a Spool until the user looks at it.
+"""
+
+import io
+import math
+import os
+import pickle
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+import types
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+import pipe
+
+EXECUTORS = ('inline', 'thread', 'process')
+
+# Seconds to let a cancelled method stop before abandoning it.
+CANCEL_GRACE = 1.0
+
+# Seconds between checks for cancellation while waiting.
+POLL_INTERVAL = 0.05
+
+# Default number of background jobs that may run at once.
+MAX_JOBS = 4
+
+# Default number of worker processes in a Pool.
+POOL_SIZE = 2
+
+_local = threading.local()
+
+
+class Error(Exception):
+  pass
+
+
+class Cancelled(Error):
+  """The command was cancelled."""
+
+
+class Timeout(Cancelled):
+  """The command ran past its timeout."""
+
+
+class LimitExceeded(Cancelled):
+  """The command exceeded its CPU or memory limit."""
+
+
+class RemoteError(Error):
+  """A command run in a child process raised an unpicklable exception."""
+
+
+class CancelToken(object):
+  """Signals cancellation to a running command.
+
+  Attributes:
+    reason: A str, why the token was cancelled.
+  """
+
+  def __init__(self):
+    self.reason = ''
+    self._event = threading.Event()
+    self._callbacks = []
+    self._lock = threading.Lock()
+    self._exc_type = Cancelled
+
+  @property
+  def cancelled(self):
+    """A boolean, whether the token has been cancelled."""
+    return self._event.is_set()
+
+  def Cancel(self, reason='Command cancelled', exc_type=Cancelled):
+    """Cancels the token. Only the first call has any effect.
+
+    Args:
+      reason: A str, the reason for cancellation.
+      exc_type: The Cancelled subclass that Check() will raise.
+    """
+    with self._lock:
+      if self._event.is_set():
+        return
+      self.reason = reason
+      self._exc_type = exc_type
+      self._event.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for callback in callbacks:
+      callback()
+
+  def AddCallback(self, callback):
+    """Calls callback() on cancellation, or now if already cancelled."""
+    with self._lock:
+      if not self._event.is_set():
+        self._callbacks.append(callback)
+        return
+    callback()
+
+  def Check(self):
+    """Raises Cancelled if the token has been cancelled."""
+    if self._event.is_set():
+      raise self._exc_type(self.reason)
+
+  def Wait(self, timeout=None):
+    """Waits for cancellation.
+
+    Args:
+      timeout: A float, the seconds to wait. If None, wait forever.
+
+    Returns:
+      A boolean, whether the token was cancelled.
+    """
+    return self._event.wait(timeout)
+
+  def AsyncWait(self):
+    """Returns an awaitable, done when the token is cancelled.
+
+    Must be called from within a running asyncio event loop.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _Done():
+      if not future.done():
+        future.set_result(True)
+
+    def _Wake():
+      try:
+        loop.call_soon_threadsafe(_Done)
+      except RuntimeError:
+        pass  # The loop has already finished.
+
+    self.AddCallback(_Wake)
+    return future
+
+
+def CurrentToken():
+  """Returns the CancelToken for the command running in this thread.
+
+  Returns:
+    A CancelToken. If no command is running, one that is never
+    cancelled.
+  """
+  token = getattr(_local, 'token', None)
+  if token is None:
+    token = CancelToken()
+  return token
+
+
+def Run(func, args=(), executor=None, timeout=None, token=None):
+  """Runs func(*args) in the requested executor.
+
+  If func returns a coroutine, it is run to completion in a new event
+  loop, and cancelled along with the token.
+
+  Args:
+    func: A callable.
+    args: A tuple, arguments for func.
+    executor: A str, one of EXECUTORS. If None, 'inline'.
+    timeout: A float, seconds after which the run is cancelled. If None
+      or zero, there is no timeout.
+    token: A CancelToken. If None, a new one is used.
+
+  Returns:
+    The value returned by func.
+
+  Raises:
+    Cancelled: The token was cancelled (or Timeout, if timed out).
+    ValueError: The executor is unknown.
+  """
+  executor = executor or 'inline'
+  token = token or CancelToken()
+  if executor not in EXECUTORS:
+    raise ValueError('Unknown executor "%s", must be one of: %s' % (
+        executor, ', '.join(EXECUTORS)))
+  if (executor == 'inline' and timeout and
+      (not hasattr(signal, 'setitimer') or
+       threading.current_thread() is not threading.main_thread())):
+    # SIGALRM can only interrupt the main thread.
+    executor = 'thread'
+  if executor == 'thread':
+    return _RunThread(func, args, timeout, token)
+  elif executor == 'process':
+    return _RunProcess(func, args, timeout, token)
+  return _RunInline(func, args, timeout, token)
+
+
+def _Call(func, args, token):
+  """Calls func with token set as the current token."""
+  previous = getattr(_local, 'token', None)
+  _local.token = token
+  try:
+    token.Check()
+    result = func(*args)
+    if isinstance(result, types.CoroutineType):
+      result = _RunCoroutine(result, token)
+    return result
+  finally:
+    _local.token = previous
+
+
+def _RunCoroutine(coro, token):
+  """Runs a coroutine to completion, cancelling it with the token."""
+  import asyncio
+  loop = asyncio.new_event_loop()
+  try:
+    task = loop.create_task(coro)
+
+    def _Cancel():
+      try:
+        loop.call_soon_threadsafe(task.cancel)
+      except RuntimeError:
+        pass  # The coroutine already finished and the loop is closed.
+
+    token.AddCallback(_Cancel)
+    try:
+      return loop.run_until_complete(task)
+    except asyncio.CancelledError:
+      token.Check()
+      raise Cancelled('Command cancelled')
+    except BaseException:
+      # Interrupted, eg by ctrl-c. Let the coroutine clean up.
+      task.cancel()
+      try:
+        loop.run_until_complete(task)
+      except BaseException:
+        pass
+      raise
+  finally:
+    loop.close()
+
+
+def _TimeoutReason(timeout):
+  return 'Command timed out after %ss' % timeout
+
+
+def _RunInline(func, args, timeout, token):
+  """Runs func in this thread, using SIGALRM for timeouts."""
+  if not timeout:
+    return _Call(func, args, token)
+
+  def _Alarm(unused_signum, unused_frame):
+    token.Cancel(_TimeoutReason(timeout), Timeout)
+    token.Check()
+
+  old_handler = signal.signal(signal.SIGALRM, _Alarm)
+  signal.setitimer(signal.ITIMER_REAL, timeout)
+  try:
+    return _Call(func, args, token)
+  finally:
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    signal.signal(signal.SIGALRM, old_handler)
+
+
+def _WaitFor(done, timeout, token, blocking=False):
+  """Waits until done() is True, or the run should be cancelled.
+
+  Cancels the token on timeout or ctrl-c.
+
+  Args:
+    done: A callable, returning True when the run is complete.
+    timeout: A float, seconds to wait. None or zero waits forever.
+    token: The CancelToken for the run.
+    blocking: A boolean, True if done() itself waits (for up to
+      POLL_INTERVAL) for progress, so need not be polled.
+
+  Returns:
+    A boolean, True if done, False if cancelled.
+  """
+  deadline = timeout and time.time() + timeout
+  try:
+    while not done():
+      if token.cancelled:
+        return False
+      if deadline and time.time() >= deadline:
+        token.Cancel(_TimeoutReason(timeout), Timeout)
+        return False
+      if not blocking:
+        token.Wait(POLL_INTERVAL)
+  except KeyboardInterrupt:
+    token.Cancel('Command interrupted')
+    return False
+  return True
+
+
+def _RaiseInThread(thread, exc_type):
+  """Asynchronously raises exc_type in the given thread."""
+  try:
+    import ctypes
+  except ImportError:
+    return
+  if thread.ident is None:
+    return
+  ctypes.pythonapi.PyThreadState_SetAsyncExc(
+      ctypes.c_ulong(thread.ident), ctypes.py_object(exc_type))
+
+
+def _RunThread(func, args, timeout, token):
+  """Runs func in a worker thread."""
+  result = {}
+  output = pipe.GetThreadOutput()
+
+  def _Worker():
+    pipe.SetThreadOutput(output)
+    try:
+      result['value'] = _Call(func, args, token)
+    except BaseException as e:
+      result['error'] = e
+
+  worker = threading.Thread(target=_Worker, name='squires-command')
+  worker.daemon = True
+  worker.start()
+  if not _WaitFor(lambda: not worker.is_alive(), timeout, token):
+    # Give the method a chance to notice the token, then force the
+    # issue by raising in the thread. If it still runs, abandon it.
+    if not _WaitFor(lambda: not worker.is_alive(), CANCEL_GRACE,
+                    CancelToken()):
+      _RaiseInThread(worker, token._exc_type)
+      worker.join(CANCEL_GRACE)
+    token.Check()
+  if 'error' in result:
+    raise result['error']
+  return result.get('value')
+
+
+def _RunProcess(func, args, timeout, token):
+  """Runs func in a forked child, streaming its output back."""
+  out_r, out_w = os.pipe()
+  res_r, res_w = os.pipe()
+  _FlushStdio()
+  pid = os.fork()
+  if not pid:
+    os.close(out_r)
+    os.close(res_r)
+    _Child(func, args, out_w, res_w)
+
+  os.close(out_w)
+  os.close(res_w)
+  try:
+    streams = [out_r, res_r]
+    result = []
+
+    def _Pump():
+      """Forwards child output, returns True once the child is done."""
+      ready = select.select(streams, [], [], POLL_INTERVAL)[0]
+      for fd in ready:
+        data = os.read(fd, pipe.COPY_CHUNK)
+        if not data:
+          streams.remove(fd)
+        elif fd == out_r:
+          pipe.WriteBytes(data)
+        else:
+          result.append(data)
+      return not streams
+
+    try:
+      done = _WaitFor(_Pump, timeout, token, blocking=True)
+    except BaseException:
+      # Eg PipeClosed, as the pipe stopped reading. Leave no zombie.
+      _Kill(pid)
+      raise
+    if not done:
+      _Kill(pid)
+      token.Check()
+    os.waitpid(pid, 0)
+  finally:
+    os.close(out_r)
+    os.close(res_r)
+
+  try:
+    status, value = pickle.loads(b''.join(result))
+  except (EOFError, pickle.UnpicklingError):
+    raise RemoteError('Command process exited unexpectedly')
+  if status == 'error':
+    raise value
+  return value
+
+
+def _Child(func, args, out_w, res_w):
+  """Runs in the child process. Never returns."""
+  token = CancelToken()
+
+  def _Terminate(unused_signum, unused_frame):
+    token.Cancel('Command cancelled')
+    token.Check()
+
+  signal.signal(signal.SIGTERM, _Terminate)
+  os.dup2(out_w, 1)
+  os.close(out_w)
+  sys.stdout = io.open(1, 'w', buffering=1, closefd=False)
+  try:
+    result = ('ok', _Call(func, args, token))
+  except BaseException as e:
+    result = ('error', e)
+  try:
+    sys.stdout.flush()
+  except (IOError, ValueError):
+    pass
+  os.close(1)
+  try:
+    _WriteAll(res_w, _PickleResult(result))
+  finally:
+    os._exit(0)
+
+
+def _FlushStdio():
+  """Flushes stdout and stderr, so buffered output is not forked."""
+  for stream in (sys.stdout, sys.stderr):
+    try:
+      stream.flush()
+    except (AttributeError, ValueError):
+      pass
+
+
+def _PickleResult(result):
+  """Pickles a ('ok', value) or ('error', exception) result.
+
+  An unpicklable value is returned as None, an unpicklable exception as
+  a RemoteError.
+  """
+  try:
+    return pickle.dumps(result)
+  except Exception:
+    if result[0] == 'ok':
+      return pickle.dumps(('ok', None))
+    import traceback
+    return pickle.dumps(('error', RemoteError(
+        ''.join(traceback.format_exception_only(
+            type(result[1]), result[1])).strip())))
+
+
+def _WriteAll(fd, data):
+  """Writes all of data to fd."""
+  view = memoryview(data)
+  while view:
+    view = view[os.write(fd, view):]
+
+
+def _Kill(pid):
+  """Terminates and reaps a child, killing it if it does not exit in time."""
+  try:
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + CANCEL_GRACE
+    while time.time() < deadline:
+      if os.waitpid(pid, os.WNOHANG)[0]:
+        return
+      time.sleep(POLL_INTERVAL)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+  except OSError:
+    pass  # Already gone.
+
+
+class _Worker(object):
+  """The parent's end of a Pool worker process."""
+
+  def __init__(self, pid, req_w, out_r, res_r, generation):
+    self.pid = pid
+    self.req_w = req_w
+    self.out_r = out_r
+    self.res_r = res_r
+    self.generation = generation
+
+  def Close(self):
+    for fd in (self.req_w, self.out_r, self.res_r):
+      try:
+        os.close(fd)
+      except OSError:
+        pass
+
+
+class Pool(object):
+  """A pool of preforked worker processes.
+
+  The workers are forked when the pool is started, so they inherit the
+  state of the process at that point (for squires, the built command
+  tree) rather than having to rebuild it. Each run calls handler(*args)
+  in an idle worker. The worker's output is streamed back to the
+  caller's stdout as it is written, and its return value (or exception)
+  is returned (or raised) by Run().
+
+  A worker that is cancelled or dies is replaced by a freshly forked one
+  when next needed. So are the workers retired by Retire(), once idle.
+
+  Attributes:
+    handler: A callable, run in the workers. Its arguments and return
+      value are pickled.
+    size: An int, the maximum number of workers.
+  """
+
+  def __init__(self, handler, size=None):
+    self.handler = handler
+    self.size = size or POOL_SIZE
+    self._idle = queue.Queue()
+    self._workers = []
+    self._lock = threading.Lock()
+    # Workers forked before the last Retire() are of older generations.
+    self._generation = 0
+
+  def Start(self):
+    """Forks any workers not yet running."""
+    with self._lock:
+      count = self.size - len(self._workers)
+    for _ in range(count):
+      self._idle.put(self._Fork())
+
+  def Close(self):
+    """Stops the workers. Busy workers are killed."""
+    with self._lock:
+      workers, self._workers = self._workers, []
+    for worker in workers:
+      # Idle workers exit when their request pipe closes.
+      worker.Close()
+      _Kill(worker.pid)
+    self._idle = queue.Queue()
+
+  def Retire(self):
+    """Stops the workers once idle, eg as they hold state now out of date.
+
+    Idle workers are stopped now, busy ones when their run finishes.
+    Workers forked afterwards, when needed, have the state of the process
+    at that point.
+    """
+    with self._lock:
+      self._generation += 1
+      idle = []
+      while True:
+        try:
+          idle.append(self._idle.get_nowait())
+        except queue.Empty:
+          break
+    for worker in idle:
+      self._Discard(worker)
+
+  def Run(self, args=(), timeout=None, token=None, limits=None):
+    """Runs handler(*args) in a worker, waiting for it to finish.
+
+    Args:
+      args: A tuple, arguments for the handler.
+      timeout: A float, seconds after which the run is cancelled,
+        including any time waiting for a free worker. If None or zero,
+        there is no timeout.
+      token: A CancelToken. If None, a new one is used.
+      limits: A dict of resource limits for the run. 'cpu' is the CPU
+        seconds it may use, 'memory' the bytes of address space the
+        worker may grow to. Ignored where the resource module is not
+        available.
+
+    Returns:
+      The value returned by the handler.
+
+    Raises:
+      Cancelled: The token was cancelled (or Timeout, if timed out).
+      LimitExceeded: The run exceeded one of its limits.
+      RemoteError: The worker died, or raised an unpicklable exception.
+    """
+    token = token or CancelToken()
+    request = pickle.dumps((args, limits))
+    state = {'worker': None, 'result': b''}
+
+    def _Step():
+      """Acquires a worker then pumps its output, True once done."""
+      worker = state['worker']
+      if worker is None:
+        worker = state['worker'] = self._Acquire()
+        if worker is not None:
+          try:
+            _WriteAll(worker.req_w, struct.pack('!I', len(request)) + request)
+          except OSError:
+            pass  # Worker died, reported when reading the result.
+        return False
+      ready = select.select([worker.out_r, worker.res_r], [], [],
+                            POLL_INTERVAL)[0]
+      if worker.out_r in ready:
+        data = os.read(worker.out_r, pipe.COPY_CHUNK)
+        if data:
+          pipe.WriteBytes(data)
+      if worker.res_r in ready:
+        data = os.read(worker.res_r, pipe.COPY_CHUNK)
+        if not data:
+          return True
+        state['result'] += data
+        return _Complete(state['result'])
+      return False
+
+    try:
+      if not _WaitFor(_Step, timeout, token, blocking=True):
+        self._Discard(state['worker'])
+        token.Check()
+    except BaseException:
+      # Eg the consumer stopped reading, the worker is still writing.
+      self._Discard(state['worker'])
+      raise
+
+    worker = state['worker']
+    if not _Complete(state['result']):
+      self._Discard(worker)
+      raise RemoteError('Command process exited unexpectedly')
+    try:
+      # Output written before the result is already in the pipe.
+      while select.select([worker.out_r], [], [], 0)[0]:
+        data = os.read(worker.out_r, pipe.COPY_CHUNK)
+        if not data:
+          break
+        pipe.WriteBytes(data)
+    except BaseException:
+      self._Discard(worker)
+      raise
+    self._Release(worker)
+    status, value = pickle.loads(state['result'][4:])
+    if status == 'error':
+      raise value
+    return value
+
+  def _Acquire(self):
+    """Returns an idle worker, forking one if needed, or None if busy."""
+    try:
+      return self._idle.get_nowait()
+    except queue.Empty:
+      pass
+    with self._lock:
+      spare = len(self._workers) < self.size
+    if spare:
+      return self._Fork()
+    try:
+      return self._idle.get(timeout=POLL_INTERVAL)
+    except queue.Empty:
+      return None
+
+  def _Release(self, worker):
+    """Returns a worker to the idle ones, unless it has been retired."""
+    with self._lock:
+      if worker.generation == self._generation:
+        self._idle.put(worker)
+        return
+    self._Discard(worker)
+
+  def _Discard(self, worker):
+    """Kills a worker and removes it from the pool."""
+    if worker is None:
+      return
+    with self._lock:
+      if worker in self._workers:
+        self._workers.remove(worker)
+    _Kill(worker.pid)
+    worker.Close()
+
+  def _Fork(self):
+    """Forks a new worker."""
+    req_r, req_w = os.pipe()
+    out_r, out_w = os.pipe()
+    res_r, res_w = os.pipe()
+    _FlushStdio()
+    with self._lock:
+      pid = os.fork()
+      if not pid:
+        try:
+          for worker in self._workers:
+            worker.Close()
+          for fd in (req_w, out_r, res_r):
+            os.close(fd)
+          _PoolWorker(self.handler, req_r, out_w, res_w)
+        finally:
+          os._exit(1)
+      worker = _Worker(pid, req_w, out_r, res_r, self._generation)
+      self._workers.append(worker)
+    for fd in (req_r, out_w, res_w):
+      os.close(fd)
+    return worker
+
+
+def _Complete(message):
+  """Returns True if message holds a complete length prefixed message."""
+  return (len(message) >= 4 and
+          len(message) - 4 >= struct.unpack('!I', message[:4])[0])
+
+
+def _ReadMessage(fd):
+  """Reads a length prefixed message, returns None at end of file."""
+  data = b''
+  size = 4
+  while len(data) < size:
+    chunk = os.read(fd, size - len(data))
+    if not chunk:
+      return None
+    data += chunk
+    if size == 4 and len(data) == 4:
+      size += struct.unpack('!I', data)[0]
+  return data[4:]
+
+
+def _PoolWorker(handler, req_r, out_w, res_w):
+  """Runs in a Pool worker process, serving requests. Never returns."""
+  current = {'token': None, 'limits': None}
+
+  def _Terminate(unused_signum, unused_frame):
+    token = current['token']
+    if token is None:
+      os._exit(0)
+    token.Cancel('Command cancelled')
+    token.Check()
+
+  def _CpuLimit(unused_signum, unused_frame):
+    if current['limits']:
+      raise LimitExceeded('Command exceeded its CPU limit of %ss' %
+                          current['limits']['cpu'])
+
+  signal.signal(signal.SIGTERM, _Terminate)
+  # The parent handles ctrl-c, and cancels the run.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  if hasattr(signal, 'SIGXCPU'):
+    signal.signal(signal.SIGXCPU, _CpuLimit)
+  os.dup2(out_w, 1)
+  os.close(out_w)
+  sys.stdout = io.open(1, 'w', buffering=1, closefd=False)
+  while True:
+    request = _ReadMessage(req_r)
+    if request is None:
+      os._exit(0)
+    args, limits = pickle.loads(request)
+    token = current['token'] = CancelToken()
+    saved = _SetLimits(limits)
+    current['limits'] = limits
+    try:
+      result = ('ok', _Call(handler, args, token))
+    except MemoryError:
+      if limits and limits.get('memory'):
+        result = ('error', LimitExceeded(
+            'Command exceeded its memory limit of %s bytes' %
+            limits['memory']))
+      else:
+        result = ('error', MemoryError())
+    except BaseException as e:
+      result = ('error', e)
+    finally:
+      current['limits'] = None
+      _RestoreLimits(saved)
+    current['token'] = None
+    try:
+      sys.stdout.flush()
+    except (IOError, ValueError):
+      pass
+    data = _PickleResult(result)
+    _WriteAll(res_w, struct.pack('!I', len(data)) + data)
+    if token.cancelled:
+      # The parent has given up on this worker.
+      os._exit(0)
+
+
+def _SetLimits(limits):
+  """Applies the resource limits for a Pool run.
+
+  Args:
+    limits: A dict, as per Pool.Run(), or None.
+
+  Returns:
+    A list of (resource, previous limits), for _RestoreLimits().
+  """
+  saved = []
+  if not limits or resource is None:
+    return saved
+  if limits.get('cpu'):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    saved.append(_SetLimit(resource.RLIMIT_CPU,
+                           int(math.ceil(used + limits['cpu']))))
+  if limits.get('memory'):
+    saved.append(_SetLimit(resource.RLIMIT_AS, int(limits['memory'])))
+  return saved
+
+
+def _SetLimit(kind, soft):
+  """Sets the soft limit of a resource, returns (kind, previous limits)."""
+  previous = resource.getrlimit(kind)
+  hard = previous[1]
+  if hard != resource.RLIM_INFINITY:
+    soft = min(soft, hard)
+  resource.setrlimit(kind, (soft, hard))
+  return kind, previous
+
+
+def _RestoreLimits(saved):
+  """Restores limits saved by _SetLimits()."""
+  for kind, previous in saved:
+    resource.setrlimit(kind, previous)
+
+
+class Spool(object):
+  """Holds the output of a background job.
+
+  This is a write-only file object for the job, which may be read from
+  (and followed) by other threads.
+  """
+
+  def __init__(self):
+    self._chunks = []
+    self._closed = False
+    self._cond = threading.Condition()
+
+  def write(self, string):
+    with self._cond:
+      self._chunks.append(string)
+      self._cond.notify_all()
+
+  def flush(self):
+    pass
+
+  def isatty(self):
+    return False
+
+  def close(self):
+    """Marks the output as complete."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+  def Read(self, offset=0, timeout=None):
+    """Reads output written after the given offset.
+
+    Args:
+      offset: An int, the offset returned by a previous call.
+      timeout: A float, seconds to wait for new output. If zero, do not
+        wait. If None, wait until there is output or the spool closes.
+
+    Returns:
+      A tuple of the output (a str) and the new offset. The output is
+      empty if there is none yet, or the spool is closed.
+    """
+    with self._cond:
+      if timeout != 0 and len(self._chunks) <= offset and not self._closed:
+        self._cond.wait(timeout)
+      return ''.join(self._chunks[offset:]), len(self._chunks)
+
+  @property
+  def closed(self):
+    """A boolean, whether the job has finished writing output."""
+    return self._closed
+
+
+class Job(object):
+  """A command run in the background.
+
+  Attributes:
+    id: An int, the job number.
+    command: A str, the command line.
+    token: A CancelToken, cancels the job.
+    state: A str, one of 'queued', 'running', 'done', 'failed' or
+      'cancelled'.
+    result: The value returned by the job, once done.
+    error: The exception raised by the job, if it failed.
+    output: A Spool, the output of the job.
+    reported: A boolean, whether the job's completion has been reported.
+  """
+  FINISHED = ('done', 'failed', 'cancelled')
+
+  def __init__(self, job_id, command, func, token=None):
+    self.id = job_id
+    self.command = command
+    self.token = token or CancelToken()
+    self.state = 'queued'
+    self.result = None
+    self.error = None
+    self.output = Spool()
+    self.reported = False
+    self._func = func
+    self._thread = None
+    self._lock = threading.Lock()
+    self._done = threading.Event()
+
+  @property
+  def finished(self):
+    """A boolean, whether the job has finished."""
+    return self.state in self.FINISHED
+
+  def Wait(self, timeout=None):
+    """Waits for the job to finish.
+
+    Args:
+      timeout: A float, seconds to wait. If None, wait forever.
+
+    Returns:
+      A boolean, whether the job has finished.
+    """
+    return self._done.wait(timeout)
+
+  def Cancel(self):
+    """Cancels the job.
+
+    A queued job never starts. A running job that does not stop within
+    CANCEL_GRACE seconds has Cancelled raised in its thread.
+    """
+    self.token.Cancel('Job cancelled')
+    with self._lock:
+      if self.state == 'queued':
+        self._Finish('cancelled')
+        return
+    if self.Wait(CANCEL_GRACE):
+      return
+    with self._lock:
+      # Only raised while the job's function runs, and only once, as the
+      # thread goes on to run other jobs.
+      if self.state == 'running' and self._thread is not None:
+        _RaiseInThread(self._thread, Cancelled)
+        self._thread = None
+
+  def _Finish(self, state):
+    self.state = state
+    self.output.close()
+    self._done.set()
+
+  def _Run(self):
+    """Runs the job, in a worker thread."""
+    with self._lock:
+      if self.state != 'queued':
+        return
+      self.state = 'running'
+      self._thread = threading.current_thread()
+    previous = pipe.SetThreadOutput((self.output, self.output))
+    state = 'done'
+    try:
+      try:
+        self.result = _Call(self._func, (), self.token)
+      finally:
+        with self._lock:
+          self._thread = None
+    except Cancelled:
+      state = 'cancelled'
+    except BaseException as e:
+      self.error = e
+      state = 'failed'
+      import traceback
+      traceback.print_exc(file=self.output)
+    finally:
+      pipe.SetThreadOutput(previous)
+      if self.token.cancelled:
+        state = 'cancelled'
+      self._Finish(state)
+
+
+class JobTable(object):
+  """Background jobs, run on a pool of worker threads.
+
+  Attributes:
+    max_jobs: An int, the number of jobs that may run at once. Others
+      are queued until a worker is free.
+  """
+
+  def __init__(self, max_jobs=MAX_JOBS):
+    self.max_jobs = max_jobs
+    self._jobs = {}
+    self._next_id = 1
+    self._queue = queue.Queue()
+    self._workers = []
+    self._lock = threading.Lock()
+
+  def Submit(self, command, func, token=None):
+    """Queues func() to run as a background job.
+
+    Args:
+      command: A str, the command line, for display.
+      func: A callable, run with no arguments.
+      token: A CancelToken, for the job. If None, a new one is used.
+
+    Returns:
+      A Job.
+    """
+    pipe.InstallThreadStdout()
+    with self._lock:
+      job = Job(self._next_id, command, func, token)
+      self._jobs[job.id] = job
+      self._next_id += 1
+      if len(self._workers) < self.max_jobs:
+        worker = threading.Thread(target=self._Worker,
+                                  name='squires-job-%d' % len(self._workers))
+        worker.daemon = True
+        self._workers.append(worker)
+        worker.start()
+    self._queue.put(job)
+    return job
+
+  def _Worker(self):
+    while True:
+      job = self._queue.get()
+      try:
+        job._Run()
+      except BaseException:
+        # A cancellation that arrived as the job finished. The worker
+        # must carry on, as it is counted towards max_jobs.
+        if not job.finished:
+          job._Finish('cancelled')
+
+  def Get(self, job_id=None):
+    """Returns a job.
+
+    Args:
+      job_id: An int, the job number. If None, the most recent job.
+
+    Returns:
+      A Job, or None if there is no such job.
+    """
+    with self._lock:
+      if job_id is None:
+        if not self._jobs:
+          return None
+        job_id = max(self._jobs)
+      return self._jobs.get(int(job_id))
+
+  def List(self):
+    """Returns a list of all jobs, in order of submission."""
+    with self._lock:
+      return [self._jobs[job_id] for job_id in sorted(self._jobs)]
+
+  def Remove(self, job):
+    """Forgets about a finished job."""
+    with self._lock:
+      self._jobs.pop(job.id, None)
+
+  def Unreported(self):
+    """Returns finished jobs that have not been reported, marking them so."""
+    finished = []
+    for job in self.List():
+      if job.finished and not job.reported:
+        job.reported = True
+        finished.append(job)
+    return finished
@@ -0,0 +1,361 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import unittest
+
+import executor
+import pipe
+
+
+class CapturePipe(pipe.Pipe):
+
+  def __init__(self):
+    self.string = ''
+
+  def write(self, string):
+    self.string += string
+
+  def flush(self):
+    pass
+
+  def OutputFd(self):
+    return None
+
+
+class ExecutorTest(unittest.TestCase):
+
+  def setUp(self):
+    self.grace = executor.CANCEL_GRACE
+    executor.CANCEL_GRACE = 0.2
+
+  def tearDown(self):
+    executor.CANCEL_GRACE = self.grace
+
+  def testCancelToken(self):
+    token = executor.CancelToken()
+    called = []
+    token.AddCallback(lambda: called.append(1))
+    self.assertFalse(token.cancelled)
+    token.Check()
+    self.assertFalse(token.Wait(0))
+    token.Cancel('Stop it')
+    token.Cancel('Ignored')
+    self.assertTrue(token.cancelled)
+    self.assertTrue(token.Wait(0))
+    self.assertEqual('Stop it', token.reason)
+    self.assertRaises(executor.Cancelled, token.Check)
+    token.AddCallback(lambda: called.append(2))
+    self.assertEqual([1, 2], called)
+
+  def testUnknownExecutor(self):
+    self.assertRaises(ValueError, executor.Run, lambda: None,
+                      executor='fibre')
+
+  def testInline(self):
+    self.assertEqual(3, executor.Run(lambda x: x + 1, (2,)))
+
+    def Spin():
+      while True:
+        pass
+
+    start = time.time()
+    self.assertRaises(executor.Timeout, executor.Run, Spin, timeout=0.1)
+    self.assertTrue(time.time() - start < 1)
+
+  def testThread(self):
+    def Cooperative():
+      executor.CurrentToken().Wait()
+      executor.CurrentToken().Check()
+
+    def Spin():
+      while True:
+        pass
+
+    for method in (Cooperative, Spin):
+      start = time.time()
+      self.assertRaises(executor.Timeout, executor.Run, method,
+                        executor='thread', timeout=0.1)
+      self.assertTrue(time.time() - start < 1)
+
+    def Fail():
+      raise KeyError('boom')
+
+    self.assertRaises(KeyError, executor.Run, Fail, executor='thread')
+    self.assertEqual('done', executor.Run(lambda: 'done', executor='thread'))
+
+    token = executor.CancelToken()
+    token.Cancel()
+    self.assertRaises(executor.Cancelled, executor.Run, Cooperative,
+                      executor='thread', token=token)
+
+  def testProcess(self):
+    def Output():
+      print('from the child')
+      pipe.WriteBytes(b'bytes\n')
+      return {'result': 42}
+
+    capture = CapturePipe()
+    old_stdout = sys.stdout
+    sys.stdout = capture
+    try:
+      self.assertEqual({'result': 42},
+                       executor.Run(Output, executor='process'))
+    finally:
+      sys.stdout = old_stdout
+    self.assertEqual('from the child\nbytes\n', capture.string)
+
+    def Fail():
+      raise KeyError('boom')
+
+    self.assertRaises(KeyError, executor.Run, Fail, executor='process')
+
+    start = time.time()
+    self.assertRaises(executor.Timeout, executor.Run, time.sleep, (100,),
+                      executor='process', timeout=0.1)
+    self.assertTrue(time.time() - start < 1)
+
+    # The child is reaped when the pipe stops reading.
+    class ClosedPipe(CapturePipe):
+
+      def write(self, string):
+        self.string += string
+        raise pipe.PipeClosed('closed')
+
+    def Forever():
+      print(os.getpid())
+      while True:
+        print('more')
+        time.sleep(0.01)
+
+    closed = ClosedPipe()
+    sys.stdout = closed
+    try:
+      self.assertRaises(pipe.PipeClosed, executor.Run, Forever,
+                        executor='process')
+    finally:
+      sys.stdout = old_stdout
+    self.assertRaises(ChildProcessError, os.waitpid,
+                      int(closed.string.split()[0]), os.WNOHANG)
+
+  def testCoroutine(self):
+    async def Sleepy(token):
+      await token.AsyncWait()
+      return 'woken'
+
+    async def Quick():
+      await asyncio.sleep(0)
+      return 'quick'
+
+    self.assertEqual('quick', executor.Run(Quick))
+    start = time.time()
+    token = executor.CancelToken()
+    self.assertRaises(executor.Timeout, executor.Run, Sleepy, (token,),
+                      executor='thread', timeout=0.1, token=token)
+    self.assertTrue(time.time() - start < 1)
+
+
+_POOL_STATE = []
+
+
+def _PoolHandler(action, *args):
+  if action == 'echo':
+    print('%s from %d' % (args[0], os.getpid()))
+    pipe.WriteBytes(b'bytes\n')
+    return list(_POOL_STATE)
+  elif action == 'fail':
+    raise KeyError('boom')
+  elif action == 'unpicklable':
+    return lambda: None
+  elif action == 'sleep':
+    time.sleep(args[0])
+  elif action == 'spin':
+    while True:
+      pass
+  elif action == 'allocate':
+    return len(bytearray(args[0]))
+  elif action == 'exit':
+    os._exit(1)
+
+
+class PoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.grace = executor.CANCEL_GRACE
+    executor.CANCEL_GRACE = 0.2
+    _POOL_STATE[:] = ['before']
+    self.pool = executor.Pool(_PoolHandler, size=1)
+    self.pool.Start()
+    _POOL_STATE.append('after')
+
+  def tearDown(self):
+    self.pool.Close()
+    executor.CANCEL_GRACE = self.grace
+
+  def Run(self, *args, **kwargs):
+    capture = CapturePipe()
+    old_stdout = sys.stdout
+    sys.stdout = capture
+    try:
+      return self.pool.Run(args, **kwargs), capture.string
+    finally:
+      sys.stdout = old_stdout
+
+  def testRun(self):
+    # The worker has the state from when it was forked.
+    result, output = self.Run('echo', 'hello')
+    self.assertEqual(['before'], result)
+    self.assertNotEqual(str(os.getpid()), output.split()[2])
+    self.assertEqual('hello from %s\nbytes\n' % output.split()[2], output)
+    # And is reused.
+    self.assertEqual(output, self.Run('echo', 'hello')[1])
+
+    self.assertRaises(KeyError, self.pool.Run, ('fail',))
+    self.assertEqual((None, ''), self.Run('unpicklable'))
+    self.assertRaises(executor.RemoteError, self.pool.Run, ('exit',))
+
+    # A dead or cancelled worker is replaced.
+    self.assertEqual(['before', 'after'], self.Run('echo', 'again')[0])
+    start = time.time()
+    self.assertRaises(executor.Timeout, self.pool.Run, ('sleep', 100),
+                      timeout=0.1)
+    self.assertTrue(time.time() - start < 1)
+    token = executor.CancelToken()
+    threading.Timer(0.1, token.Cancel).start()
+    self.assertRaises(executor.Cancelled, self.pool.Run, ('sleep', 100),
+                      token=token)
+    self.assertEqual(None, self.pool.Run(('sleep', 0)))
+
+  def testRetire(self):
+    pid = self.Run('echo', 'hello')[1].split()[2]
+    results = []
+    busy = threading.Thread(
+        target=lambda: results.append(self.pool.Run(('sleep', 0.5))))
+    busy.start()
+    time.sleep(0.1)
+    _POOL_STATE.append('retired')
+    # The busy worker finishes its run, then is replaced.
+    self.pool.Retire()
+    busy.join()
+    self.assertEqual([None], results)
+    result, output = self.Run('echo', 'hello')
+    self.assertEqual(['before', 'after', 'retired'], result)
+    self.assertNotEqual(pid, output.split()[2])
+    # Idle workers are replaced too.
+    pid = output.split()[2]
+    self.pool.Retire()
+    self.assertNotEqual(pid, self.Run('echo', 'hello')[1].split()[2])
+
+  def testLimits(self):
+    if executor.resource is None:
+      return
+    start = time.time()
+    self.assertRaises(executor.LimitExceeded, self.pool.Run, ('spin',),
+                      limits={'cpu': 1})
+    self.assertTrue(time.time() - start < 5)
+    self.assertRaises(executor.LimitExceeded, self.pool.Run,
+                      ('allocate', 4 << 30), limits={'memory': 1 << 30})
+    # Limits apply only to the run they were set for.
+    self.assertEqual(64 << 20, self.pool.Run(('allocate', 64 << 20)))
+
+
+class JobTableTest(unittest.TestCase):
+
+  def setUp(self):
+    self.grace = executor.CANCEL_GRACE
+    executor.CANCEL_GRACE = 0.2
+    self.stdout = sys.stdout
+
+  def tearDown(self):
+    executor.CANCEL_GRACE = self.grace
+    sys.stdout = self.stdout
+
+  def testJobs(self):
+    table = executor.JobTable(max_jobs=2)
+    release = executor.CancelToken()
+    started = [threading.Event() for _ in range(3)]
+
+    def Blocked(name, i):
+      print('%s started' % name)
+      started[i].set()
+      release.Wait()
+      pipe.WriteBytes(b'bytes\n')
+      return name
+
+    jobs = [table.Submit('job %d' % i, lambda i=i: Blocked('job%d' % i, i))
+            for i in range(3)]
+    self.assertTrue(isinstance(sys.stdout, pipe.ThreadStdout))
+    self.assertTrue(started[0].wait(1) and started[1].wait(1))
+    self.assertFalse(started[2].wait(0.1))
+    self.assertEqual(('job0 started\n', 2), jobs[0].output.Read())
+    self.assertEqual(('job1 started\n', 2), jobs[1].output.Read(0, 0))
+    # Only two run at once.
+    self.assertEqual(['running', 'running', 'queued'],
+                     [job.state for job in jobs])
+    self.assertEqual(jobs, table.List())
+    self.assertEqual(jobs[2], table.Get())
+    self.assertEqual(jobs[1], table.Get('2'))
+    self.assertEqual(None, table.Get(99))
+    self.assertEqual([], table.Unreported())
+
+    release.Cancel()
+    for job in jobs:
+      self.assertTrue(job.Wait(1))
+    self.assertEqual(['done'] * 3, [job.state for job in jobs])
+    self.assertEqual(['job0', 'job1', 'job2'], [job.result for job in jobs])
+    self.assertEqual('job2 started\nbytes\n', jobs[2].output.Read()[0])
+    self.assertEqual(jobs, table.Unreported())
+    self.assertEqual([], table.Unreported())
+    table.Remove(jobs[0])
+    self.assertEqual(jobs[1:], table.List())
+
+  def testCancel(self):
+    table = executor.JobTable(max_jobs=1)
+
+    def Spin():
+      while True:
+        pass
+
+    def Fail():
+      raise KeyError('boom')
+
+    spinning = table.Submit('spin', Spin)
+    queued = table.Submit('queued', lambda: None)
+    failing = table.Submit('fail', Fail)
+    queued.Cancel()
+    self.assertEqual('cancelled', queued.state)
+    start = time.time()
+    spinning.Cancel()
+    self.assertTrue(spinning.Wait(1))
+    self.assertTrue(time.time() - start < 1)
+    self.assertEqual('cancelled', spinning.state)
+    self.assertTrue(failing.Wait(1))
+    self.assertEqual('failed', failing.state)
+    self.assertTrue(isinstance(failing.error, KeyError))
+    self.assertTrue('boom' in failing.output.Read()[0])
+    # Cancelling a finished job leaves its worker free for the next.
+    spinning.Cancel()
+    later = table.Submit('later', lambda: 'ok')
+    self.assertTrue(later.Wait(1))
+    self.assertEqual('ok', later.result)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -16,11 +16,19 @@
 
 """options for squires."""
 
+import array
+import bisect
 import collections
-import inspect
+import heapq
+import importlib
+import math
 import os
 import re
-from functools import total_ordering
+import struct
+import sys
+import threading
+import types
+from functools import lru_cache, total_ordering
 
 
 # Represents a match for an option.
@@ -34,6 +42,1125 @@ from functools import total_ordering
 #     are the associated helptext.
 Match = collections.namedtuple('Match', 'value count reason valid')
 
+def _IsRoutine(value):
+  """Returns inspect.isroutine(value), importing inspect only if needed."""
+  if isinstance(value, (types.FunctionType, types.MethodType,
+                        types.BuiltinFunctionType)):
+    return True
+  import inspect
+  return inspect.isroutine(value)
+
+
+# Objects imported for a Reference, keyed by the reference's path.
+_RESOLVED = {}
+
+# Most compiled regexes kept by CompilePattern(). Once full, the least
+# recently used are dropped, and compiled again if used again.
+PATTERN_CACHE_SIZE = 4096
+
+
+# Domains by name. See Domain().
+_DOMAINS = {}
+_DOMAINS_LOCK = threading.Lock()
+
+# Changes of more values than this are merged into a domain in one pass,
+# rather than a value at a time.
+_DOMAIN_BULK = 64
+
+# Values a domain is scanned by at a time. See Domain.Scan().
+_DOMAIN_PAGE = 256
+
+# Catalogs by real path. See Catalog().
+_CATALOGS = {}
+
+# Starts a catalog file, followed by the count of values.
+CATALOG_MAGIC = b'squires-catalog1'
+_CATALOG_HEADER = struct.Struct('<16sQ')
+_CATALOG_OFFSETS = struct.Struct('<QQ')
+
+# Most values a fuzzy completion returns.
+FUZZY_LIMIT = 10
+
+# Bounds on the work of one fuzzy lookup, however many values there are:
+# the most values found by their trigrams, the most further trigram
+# postings checked for those values, and the most of them then ranked.
+_FUZZY_CANDIDATES = 10000
+_FUZZY_POSTINGS = 50000
+_FUZZY_RANKED = 200
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def CompilePattern(pattern, flags=0):
+  """Compiles a regex, from a cache shared by all the matchers.
+
+  Options with the same pattern share the compiled regex. Unlike the re
+  module's own cache, which is cleared when it fills, only the least
+  recently used patterns are dropped, so trees with many thousands of
+  patterns do not keep compiling the ones in use.
+
+  Args:
+    pattern: A str, the regex.
+    flags: An int, the re module flags.
+
+  Returns:
+    A compiled regex.
+  """
+  return re.compile(pattern, flags)
+
+
+class Reference(object):
+  """A function named by a 'pkg.mod:func' string, imported when first called.
+
+  This lets a tree name the methods of its commands and options, without
+  importing their modules until they are run or completed.
+
+  Attributes:
+    path: A string, the module and the attribute in it, eg
+      'mycli.interfaces:Names' or 'mycli.interfaces:Interface.Names'.
+  """
+
+  def __init__(self, path):
+    module, _, attribute = path.partition(':')
+    if not module or not attribute:
+      raise ValueError('Reference "%s" is not of the form "pkg.mod:func".'
+                       % path)
+    self.path = path
+
+  def __repr__(self):
+    return "Reference('%s')" % self.path
+
+  def __eq__(self, other):
+    return isinstance(other, Reference) and self.path == other.path
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.path)
+
+  def Resolve(self):
+    """Imports the referenced object, once per path.
+
+    Returns:
+      The object the path names.
+
+    Raises:
+      ImportError: The module or the attribute was not found.
+    """
+    try:
+      return _RESOLVED[self.path]
+    except KeyError:
+      pass
+    module, _, attribute = self.path.partition(':')
+    target = importlib.import_module(module)
+    for name in attribute.split('.'):
+      try:
+        target = getattr(target, name)
+      except AttributeError:
+        raise ImportError('Cannot import "%s" for Reference("%s")' % (
+            attribute, self.path))
+    _RESOLVED[self.path] = target
+    return target
+
+  def __call__(self, *args, **kwargs):
+    return self.Resolve()(*args, **kwargs)
+
+
+class Domain(object):
+  """A named set of values, shared by all the options matching on it.
+
+  Domain('interfaces') returns the same object wherever it is called, so
+  however many options match on a domain, its values are kept once, in
+  one sorted list. Values are added and removed in place, and each change
+  bumps the version, so completions cached for the options of the domain
+  are worked out again, and no others.
+
+  Only the name is pickled, so a tree loaded from a snapshot, or sent to
+  a worker, uses the domain of the same name there. The values are for
+  the program to fill in.
+
+  Attributes:
+    name: A str, the name of the domain.
+    version: An int, changed each time the values change.
+  """
+
+  def __new__(cls, name):
+    with _DOMAINS_LOCK:
+      domain = _DOMAINS.get(name)
+      if domain is None:
+        domain = _DOMAINS[name] = super(Domain, cls).__new__(cls)
+        domain.name = name
+        domain.version = 0
+        domain._values = []
+        domain._help = {}  # Only for values with help text.
+        domain._lock = threading.Lock()
+    return domain
+
+  def __repr__(self):
+    return "Domain('%s')" % self.name
+
+  def __reduce__(self):
+    return Domain, (self.name,)
+
+  def __len__(self):
+    return len(self._values)
+
+  def __iter__(self):
+    return iter(list(self._values))
+
+  def __contains__(self, value):
+    with self._lock:
+      return self._Find(value) is not None
+
+  def _Find(self, value):
+    """Returns the index of value in the sorted values, or None."""
+    index = bisect.bisect_left(self._values, value)
+    if index < len(self._values) and self._values[index] == value:
+      return index
+    return None
+
+  def Add(self, values):
+    """Adds values to the domain. Values already present are kept.
+
+    Args:
+      values: A list of str, or a dict of str to their help text, in
+        which case the help of values already present is replaced.
+    """
+    helps = values if isinstance(values, dict) else {}
+    with self._lock:
+      new = set()
+      for value in values:
+        if self._Find(value) is None:
+          new.add(value)
+      if len(new) > _DOMAIN_BULK:
+        self._values[:] = heapq.merge(self._values, sorted(new))
+      else:
+        for value in new:
+          bisect.insort(self._values, value)
+      changed = bool(new)
+      for value, helptext in helps.items():
+        if (helptext or '') != self._help.get(value, ''):
+          if helptext:
+            self._help[value] = helptext
+          else:
+            del self._help[value]
+          changed = True
+      if changed:
+        self.version += 1
+
+  def Remove(self, values):
+    """Removes values from the domain. Those not present are ignored.
+
+    Args:
+      values: A list of str.
+    """
+    with self._lock:
+      if not isinstance(values, (set, frozenset, dict)):
+        values = set(values)
+      size = len(self._values)
+      if len(values) > _DOMAIN_BULK:
+        self._values[:] = [value for value in self._values
+                           if value not in values]
+      else:
+        for value in values:
+          index = self._Find(value)
+          if index is not None:
+            del self._values[index]
+      for value in values:
+        self._help.pop(value, None)
+      if len(self._values) != size:
+        self.version += 1
+
+  def Replace(self, values):
+    """Makes the domain hold just these values.
+
+    Only the values that differ are added and removed.
+
+    Args:
+      values: As for Add().
+    """
+    if not isinstance(values, dict):
+      values = set(values)
+    with self._lock:
+      stale = [value for value in self._values if value not in values]
+    self.Remove(stale)
+    self.Add(values)
+
+  def GetHelp(self, value):
+    """Returns the help text of a value, '' if it has none."""
+    return self._help.get(value, '')
+
+  def Prefix(self, prefix, limit=None):
+    """Returns the values starting with prefix, in sorted order.
+
+    Args:
+      prefix: A str. '' for all values.
+      limit: An int, the most values to return, or None for no limit.
+
+    Returns:
+      A list of str.
+    """
+    with self._lock:
+      values = self._values
+      start = end = bisect.bisect_left(values, prefix)
+      stop = len(values) if limit is None else min(len(values), start + limit)
+      while end < stop and values[end].startswith(prefix):
+        end += 1
+      return values[start:end]
+
+  def Items(self, prefix, limit=None):
+    """Returns the values starting with prefix, with their help text.
+
+    Args:
+      prefix: A str. '' for all values.
+      limit: An int, the most values to return, or None for no limit.
+
+    Returns:
+      A list of (value, help text) tuples of str, in sorted order.
+    """
+    return [(value, self._help.get(value, ''))
+            for value in self.Prefix(prefix, limit)]
+
+  def Scan(self, prefix):
+    """Yields the values starting with prefix, in sorted order.
+
+    The values are read a page at a time, so the domain is not locked
+    while they are used, and each page sees the changes made before it.
+
+    Args:
+      prefix: A str. '' for all values.
+    """
+    last = None
+    while True:
+      with self._lock:
+        values = self._values
+        if last is None:
+          start = bisect.bisect_left(values, prefix)
+        else:
+          start = bisect.bisect_right(values, last)
+        page = values[start:start + _DOMAIN_PAGE]
+      for value in page:
+        if not value.startswith(prefix):
+          return
+        yield value
+      if len(page) < _DOMAIN_PAGE:
+        return
+      last = page[-1]
+
+
+class Catalog(object):
+  """A sorted file of values, memory mapped, for options to match on.
+
+  For options with millions of values, too many to hold in every session.
+  Values are found by binary search over the mapped file, so only the
+  pages read are loaded, and processes using the same catalog share them
+  through the OS page cache. Build the file with BuildCatalog().
+
+  Catalog(path) returns the same object wherever it is called with the
+  same file, and it pickles as the file's real path, so it names the same
+  file whatever the working directory.
+
+  The file holds CATALOG_MAGIC and the count of values, a table of that
+  count plus one offsets into the records, then the records. Each record
+  is a UTF-8 value, and if it has any, a NUL and its help text. Numbers
+  are 64 bit little endian. Records are sorted by value.
+
+  Attributes:
+    path: A str, the real path of the file.
+    name: A str, the file name, for messages.
+    version: An int, changed each time Reload() maps a new file.
+  """
+
+  def __new__(cls, path):
+    real_path = os.path.realpath(path)
+    with _DOMAINS_LOCK:
+      catalog = _CATALOGS.get(real_path)
+      if catalog is None:
+        catalog = super(Catalog, cls).__new__(cls)
+        catalog.path = real_path
+        catalog.name = os.path.basename(path)
+        catalog.version = 0
+        catalog._Open()
+        _CATALOGS[real_path] = catalog
+    return catalog
+
+  def __repr__(self):
+    return "Catalog('%s')" % self.path
+
+  def __reduce__(self):
+    return Catalog, (self.path,)
+
+  def __len__(self):
+    return self._mapping[1]
+
+  def __contains__(self, value):
+    return self._Find(self._mapping, value) is not None
+
+  def _Open(self):
+    """Maps the file."""
+    import mmap
+    with open(self.path, 'rb') as catalog_file:
+      self._stat = os.fstat(catalog_file.fileno())
+      mapped = mmap.mmap(catalog_file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, count = _CATALOG_HEADER.unpack_from(mapped)
+    if magic != CATALOG_MAGIC:
+      mapped.close()
+      raise ValueError('"%s" is not a catalog.' % self.path)
+    # Replaced whole by Reload(), so lookups under way see one file.
+    self._mapping = (mapped, count, _CATALOG_HEADER.size + 8 * (count + 1))
+
+  def Reload(self):
+    """Maps the file again if it has been rebuilt since it was mapped.
+
+    Returns:
+      A bool, True if the file changed.
+    """
+    stat = os.stat(self.path)
+    if (stat.st_ino, stat.st_mtime) == (self._stat.st_ino,
+                                        self._stat.st_mtime):
+      return False
+    self._Open()
+    self.version += 1
+    return True
+
+  @staticmethod
+  def _Record(mapping, index):
+    """Returns the value and help text of a record, as bytes."""
+    mapped, _, data = mapping
+    start, end = _CATALOG_OFFSETS.unpack_from(
+        mapped, _CATALOG_HEADER.size + 8 * index)
+    value, _, helptext = mapped[data + start:data + end].partition(b'\0')
+    return value, helptext
+
+  def _Search(self, mapping, key):
+    """Returns the index of the first record not before key, as bytes."""
+    low, high = 0, mapping[1]
+    while low < high:
+      middle = (low + high) // 2
+      if self._Record(mapping, middle)[0] < key:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  def _Find(self, mapping, value):
+    """Returns the index of value's record, or None."""
+    key = value.encode('utf-8')
+    index = self._Search(mapping, key)
+    if index < mapping[1] and self._Record(mapping, index)[0] == key:
+      return index
+    return None
+
+  def GetHelp(self, value):
+    """Returns the help text of a value, '' if it has none."""
+    mapping = self._mapping
+    index = self._Find(mapping, value)
+    if index is None:
+      return ''
+    return self._Record(mapping, index)[1].decode('utf-8')
+
+  def Items(self, prefix, limit=None):
+    """Returns the values starting with prefix, with their help text.
+
+    Args:
+      prefix: A str. '' for all values.
+      limit: An int, the most values to return, or None for no limit.
+
+    Returns:
+      A list of (value, help text) tuples of str, in sorted order.
+    """
+    mapping = self._mapping
+    key = prefix.encode('utf-8')
+    index = self._Search(mapping, key)
+    count = mapping[1]
+    stop = count if limit is None else min(count, index + limit)
+    items = []
+    while index < stop:
+      value, helptext = self._Record(mapping, index)
+      if not value.startswith(key):
+        break
+      items.append((value.decode('utf-8'), helptext.decode('utf-8')))
+      index += 1
+    return items
+
+  def Prefix(self, prefix, limit=None):
+    """Returns the values starting with prefix, in sorted order.
+
+    Args:
+      prefix: A str. '' for all values.
+      limit: An int, the most values to return, or None for no limit.
+
+    Returns:
+      A list of str.
+    """
+    return [value for value, _ in self.Items(prefix, limit)]
+
+  def Scan(self, prefix):
+    """Yields the values starting with prefix, in sorted order.
+
+    The values come from the file mapped when the scan starts, even if
+    the catalog is reloaded meanwhile.
+
+    Args:
+      prefix: A str. '' for all values.
+    """
+    mapping = self._mapping
+    key = prefix.encode('utf-8')
+    for index in range(self._Search(mapping, key), mapping[1]):
+      value = self._Record(mapping, index)[0]
+      if not value.startswith(key):
+        return
+      yield value.decode('utf-8')
+
+
+def BuildCatalog(path, values):
+  """Writes a file for Catalog().
+
+  The file is written alongside, then moved into place, so processes with
+  the old file mapped carry on with it until they call Catalog.Reload().
+
+  Args:
+    path: A str, the file to write.
+    values: An iterable of str, or of (value, help text) tuples of str, eg
+      a dict's items(). Of duplicate values, the last is kept.
+
+  Returns:
+    An int, the number of values written.
+
+  Raises:
+    ValueError: A value is empty, or a value or help text holds a NUL.
+  """
+  import array
+  records = {}
+  for item in values:
+    if isinstance(item, str):
+      value, helptext = item, ''
+    else:
+      value, helptext = item
+      helptext = helptext or ''
+    if not value or '\0' in value or '\0' in helptext:
+      raise ValueError('Invalid catalog value: %r' % (item,))
+    records[value.encode('utf-8')] = helptext.encode('utf-8')
+  keys = sorted(records)
+  offsets = array.array('Q', [0])
+  for key in keys:
+    size = len(key)
+    if records[key]:
+      size += 1 + len(records[key])
+    offsets.append(offsets[-1] + size)
+  if sys.byteorder != 'little':
+    offsets.byteswap()
+  temp_path = '%s.%d.tmp' % (path, os.getpid())
+  try:
+    with open(temp_path, 'wb') as catalog_file:
+      catalog_file.write(_CATALOG_HEADER.pack(CATALOG_MAGIC, len(keys)))
+      catalog_file.write(offsets.tobytes())
+      for key in keys:
+        catalog_file.write(key)
+        if records[key]:
+          catalog_file.write(b'\0' + records[key])
+    os.replace(temp_path, path)
+  except BaseException:
+    # Eg the disk is full. Leave no partial file behind.
+    try:
+      os.remove(temp_path)
+    except OSError:
+      pass
+    raise
+  return len(keys)
+
+
+class FuzzyIndex(object):
+  """Finds the values closest to a token, for fuzzy completion.
+
+  Each value is indexed by its trigrams, the runs of three characters in
+  it, ignoring case. A token is looked up by its own trigrams, the rarest
+  first, so only values sharing some of them are looked at, and a lookup
+  stays quick on many thousands of values. The candidates are ranked by
+  the trigrams they share with the token, then by whether they contain it,
+  or its characters in order, then by length.
+
+  Attributes:
+    values: A list of str, the values, sorted.
+  """
+
+  __slots__ = ('values', '_lower', '_grams')
+
+  def __init__(self, values):
+    """Initialise object.
+
+    Args:
+      values: An iterable of str.
+    """
+    self.values = sorted(values)
+    self._lower = [value.lower() for value in self.values]
+    grams = collections.defaultdict(list)
+    for number, value in enumerate(self._lower):
+      for gram in set(self._Trigrams(value)):
+        grams[gram].append(number)
+    self._grams = {gram: array.array('I', numbers)
+                   for gram, numbers in grams.items()}
+
+  def __len__(self):
+    return len(self.values)
+
+  @staticmethod
+  def _Trigrams(value):
+    return [value[i:i + 3] for i in range(len(value) - 2)]
+
+  def Search(self, token, limit=FUZZY_LIMIT):
+    """Returns the values closest to token, best first.
+
+    The values sharing the rarest of the token's trigrams are found first.
+    The more common trigrams are then counted for those values only, as
+    far as the bounds allow, and the values sharing the most are ranked.
+
+    Args:
+      token: A str. Tokens shorter than three characters match nothing.
+      limit: An int, the most values to return.
+
+    Returns:
+      A list of str.
+    """
+    token = token.lower()
+    grams = set(self._Trigrams(token))
+    postings = sorted((self._grams[gram] for gram in grams
+                       if gram in self._grams), key=len)
+    counts = collections.Counter()
+    budget = _FUZZY_CANDIDATES
+    while postings and len(postings[0]) <= budget:
+      numbers = postings.pop(0)
+      counts.update(numbers)
+      budget -= len(numbers)
+    if not counts and postings:
+      # Even the rarest trigram is common. A spread of its values is used.
+      numbers = postings.pop(0)
+      counts.update(numbers[::len(numbers) // budget + 1])
+    candidates = set(counts)
+    budget = _FUZZY_POSTINGS
+    for numbers in postings:
+      if len(numbers) > budget:
+        break
+      counts.update(candidates.intersection(numbers))
+      budget -= len(numbers)
+    # Not compiled with CompilePattern(), as each token would take a place
+    # in its cache that the options' own patterns need.
+    in_order = re.compile('.*?'.join(re.escape(char) for char in token))
+    ranked = []
+    for number, _ in counts.most_common(_FUZZY_RANKED):
+      value = self._lower[number]
+      ranked.append((-sum(gram in value for gram in grams),
+                     token not in value, not in_order.search(value),
+                     len(value), self.values[number]))
+    return [item[-1] for item in heapq.nsmallest(limit, ranked)]
+
+
+# A range, eg '[0-47]' or '[1,3,5-7]', or a wildcard, in an option value.
+_EXPANSION_RE = re.compile(r'\[(\d+(?:-\d+)?(?:,\d+(?:-\d+)?)*)\]|([*?])')
+
+# Unless an expansion has a digit next to a range, the number matched by
+# the range must not have one either.
+_RANGE_AFTER = r'(?<![0-9])'
+_RANGE_BEFORE = r'(?![0-9])'
+
+# Most prefixes the ranges of an expansion are enumerated into, each
+# looked up in the option's values. Ranges past this are matched while
+# scanning the values instead.
+_EXPANSION_PREFIXES = 1024
+
+
+def IsExpansion(token):
+  """Returns True if token has ranges or wildcards, see Expansion()."""
+  return _EXPANSION_RE.search(token) is not None
+
+
+class RangeSet(object):
+  """A set of numbers, kept as sorted ranges.
+
+  Attributes:
+    ranges: A list of (first, last) tuples of int, sorted and not
+      overlapping.
+    width: An int, the digits numbers are zero padded to, or 0.
+  """
+
+  __slots__ = ('ranges', 'width')
+
+  def __init__(self, text):
+    """Initialise object.
+
+    Args:
+      text: A str, ranges separated by commas, eg '1,3,5-7'. If a number
+        starts with a zero, eg '00-47', numbers are padded to its length.
+
+    Raises:
+      ValueError: A range ends before it starts.
+    """
+    self.width = 0
+    ranges = []
+    for item in text.split(','):
+      first, _, last = item.partition('-')
+      last = last or first
+      for number in (first, last):
+        if len(number) > 1 and number.startswith('0'):
+          self.width = max(self.width, len(number))
+      if int(first) > int(last):
+        raise ValueError('Range "%s" ends before it starts.' % item)
+      ranges.append((int(first), int(last)))
+    ranges.sort()
+    self.ranges = []
+    for first, last in ranges:
+      if self.ranges and first <= self.ranges[-1][1] + 1:
+        self.ranges[-1] = (self.ranges[-1][0], max(last, self.ranges[-1][1]))
+      else:
+        self.ranges.append((first, last))
+
+  def __repr__(self):
+    return 'RangeSet(%r)' % ','.join(
+        self.Format(first) if first == last else
+        '%s-%s' % (self.Format(first), self.Format(last))
+        for first, last in self.ranges)
+
+  def __len__(self):
+    return sum(last - first + 1 for first, last in self.ranges)
+
+  def __iter__(self):
+    for first, last in self.ranges:
+      for number in range(first, last + 1):
+        yield number
+
+  def __contains__(self, number):
+    index = bisect.bisect_right(self.ranges, (number, float('inf'))) - 1
+    return index >= 0 and number <= self.ranges[index][1]
+
+  def Format(self, number):
+    """Returns number as text, zero padded to width."""
+    return '%0*d' % (self.width, number)
+
+  def Regex(self):
+    """Returns a regex matching the numbers, as formatted by Format()."""
+    alternatives = []
+    for first, last in self.ranges:
+      # Numbers formatted to the same length are in the same order as text.
+      for length in range(len(self.Format(first)),
+                          len(self.Format(last)) + 1):
+        shortest = 10 ** (length - 1) if length > max(self.width, 1) else 0
+        low = max(first, shortest)
+        high = min(last, 10 ** length - 1)
+        alternatives.append(_DigitsRegex('%0*d' % (length, low),
+                                         '%0*d' % (length, high)))
+    return '(?:%s)' % '|'.join(alternatives)
+
+
+def _DigitsRegex(low, high):
+  """Returns a regex matching the strings of digits from low to high.
+
+  Args:
+    low: A str of digits.
+    high: A str of digits, of the same length, not less than low.
+
+  Returns:
+    A str.
+  """
+  if low == high:
+    return low
+  if low[0] == high[0]:
+    return low[0] + _DigitsRegex(low[1:], high[1:])
+  size = len(low) - 1
+  rest = '[0-9]{%d}' % size if size else ''
+  alternatives = []
+  first, last = low[0], high[0]
+  if low[1:] != '0' * size:
+    alternatives.append(low[0] + _DigitsRegex(low[1:], '9' * size))
+    first = chr(ord(first) + 1)
+  if high[1:] != '9' * size:
+    last = chr(ord(last) - 1)
+  if first <= last:
+    alternatives.append('[%s-%s]%s' % (first, last, rest))
+  if high[1:] != '9' * size:
+    alternatives.append(high[0] + _DigitsRegex('0' * size, high[1:]))
+  return '(?:%s)' % '|'.join(alternatives)
+
+
+class Expansion(object):
+  """The values of an option value with ranges or wildcards.
+
+  Eg 'ge-1/0/[0-47]' or 'xe-*/1/*'. A range is numbers and ranges of
+  numbers, separated by commas, in square brackets. '*' is any run of
+  characters and '?' any one character.
+
+  Values are worked out as they are iterated over, never all at once. For
+  an option matching on a list, dict, method, domain or catalog, they are
+  the option's values fitting the pattern. The ranges before the first
+  wildcard are enumerated, in order, into up to 1024 prefixes, and only
+  the values starting with each are scanned, in sorted order. So a
+  pattern is looked up in the values, rather than checked against each.
+  For a regex option, the ranges are enumerated, in order, and wildcards
+  are not allowed.
+
+  An empty expansion is false, as is one whose values do not match the
+  option.
+
+  Attributes:
+    pattern: A str, the option value.
+    matcher: The option's matcher, eg a ListMatch().
+  """
+
+  __slots__ = ('pattern', 'matcher', '_parts', '_regex')
+
+  def __init__(self, pattern, matcher, literal=False):
+    """Initialise object.
+
+    Args:
+      pattern: A str, the option value.
+      matcher: The option's matcher.
+      literal: A bool. If True, the pattern is a single value, and any
+        brackets or wildcards in it are plain characters.
+
+    Raises:
+      ValueError: A range is invalid, or there are wildcards but no values
+        to match them against.
+    """
+    self.pattern = pattern
+    self.matcher = matcher
+    self._parts = []
+    position = 0
+    for match in ([] if literal else _EXPANSION_RE.finditer(pattern)):
+      if match.start() > position:
+        self._parts.append(pattern[position:match.start()])
+      if match.group(1):
+        self._parts.append(RangeSet(match.group(1)))
+      else:
+        self._parts.append(match.group(2))
+      position = match.end()
+    if position < len(pattern):
+      self._parts.append(pattern[position:])
+    regex = []
+    for index, part in enumerate(self._parts):
+      if part in ('*', '?'):
+        regex.append('.*' if part == '*' else '.')
+      elif isinstance(part, RangeSet):
+        before = self._parts[index - 1] if index else ''
+        after = self._parts[index + 1] if index + 1 < len(self._parts) else ''
+        if not isinstance(before, str) or not before[-1:].isdigit():
+          regex.append(_RANGE_AFTER)
+        regex.append(part.Regex())
+        if not isinstance(after, str) or not after[:1].isdigit():
+          regex.append(_RANGE_BEFORE)
+      else:
+        regex.append(re.escape(part))
+    # Not compiled with CompilePattern(). A pattern the user gives is seldom
+    # used twice, and would push the options' own patterns out of its cache.
+    self._regex = re.compile('(?s)%s\\Z' % ''.join(regex))
+    if (not isinstance(matcher, (ListMatch, DomainMatch)) and
+        ('*' in self._parts or '?' in self._parts)):
+      raise ValueError('Wildcards need a list of values to match.')
+
+  def __repr__(self):
+    return 'Expansion(%r)' % self.pattern
+
+  def __str__(self):
+    return self.pattern
+
+  def __bool__(self):
+    if not isinstance(self.matcher, (ListMatch, DomainMatch)):
+      for value in self._Product(self._Ends):
+        if not self.matcher.Matches([value], 0):
+          return False
+    for _ in self:
+      return True
+    return False
+
+  def __iter__(self):
+    if isinstance(self.matcher, TypedMatch):
+      return (self.matcher.Convert(value) for value in self._Product(iter))
+    if not isinstance(self.matcher, (ListMatch, DomainMatch)):
+      return self._Product(iter)
+    return self._Scan()
+
+  def _Scan(self, index=0, head='', count=1):
+    """Yields the option's values fitting the pattern.
+
+    Args:
+      index: An int, the part to start from.
+      head: A str, the text of the parts before index.
+      count: An int, the prefixes enumerated so far, including head.
+    """
+    parts = self._parts
+    while (index < len(parts) and isinstance(parts[index], str) and
+           parts[index] not in ('*', '?')):
+      head += parts[index]
+      index += 1
+    if index == len(parts):
+      # Just one value, the first of those starting with it, if present.
+      for value in self.matcher.Scan(head):
+        if value == head:
+          yield value
+        break
+      return
+    part = parts[index]
+    if (isinstance(part, RangeSet) and
+        count * len(part) <= _EXPANSION_PREFIXES):
+      for number in part:
+        for value in self._Scan(index + 1, head + part.Format(number),
+                                count * len(part)):
+          yield value
+      return
+    for value in self.matcher.Scan(head):
+      if self._Fits(value):
+        yield value
+
+  def _Fits(self, value):
+    """Returns True if value fits the pattern."""
+    return self._regex.match(value) is not None
+
+  @staticmethod
+  def _Ends(ranges):
+    """Yields the first and last numbers of a RangeSet."""
+    yield ranges.ranges[0][0]
+    if len(ranges) > 1:
+      yield ranges.ranges[-1][1]
+
+  def _Product(self, numbers, index=0, head=''):
+    """Yields the values of the ranges, in order.
+
+    Args:
+      numbers: A function, returning the numbers to use of a RangeSet.
+      index: An int, the part to start from.
+      head: A str, the text of the parts before index.
+    """
+    if index == len(self._parts):
+      yield head
+      return
+    part = self._parts[index]
+    if isinstance(part, RangeSet):
+      for number in numbers(part):
+        for value in self._Product(numbers, index + 1,
+                                   head + part.Format(number)):
+          yield value
+    else:
+      for value in self._Product(numbers, index + 1, head + part):
+        yield value
+
+
+# An integer, in decimal.
+_INTEGER_RE = re.compile(r'[-+]?[0-9]+\Z')
+
+# A number, in decimal, with an optional exponent.
+_FLOAT_RE = re.compile(
+    r'[-+]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?\Z')
+
+# Parts of a duration, eg '1h30m', and their lengths in seconds.
+_DURATION_RE = re.compile(r'(\d+(?:\.\d*)?|\.\d+)(ms|us|[wdhms])', re.I)
+_DURATION_UNITS = {'w': 604800, 'd': 86400, 'h': 3600, 'm': 60, 's': 1,
+                   'ms': 0.001, 'us': 0.000001}
+
+# A size, eg '64k' or '1.5GiB', and the multipliers of its units.
+_SIZE_RE = re.compile(r'(\d+)(?:\.(\d*))?\s*(?:([kmgtp])(i)?)?b?\Z', re.I)
+_SIZE_POWERS = 'kmgtp'
+
+
+class ValueType(object):
+  """The type of an option's values, eg Integer(1, 4094).
+
+  An option matching on a type takes values of it, parsed once as they
+  are matched. The option's value is the parsed one, and it completes
+  with a placeholder for the type.
+
+  Attributes:
+    NAME: A str, the type for messages and placeholders.
+    minimum: The smallest value allowed, or None. For a type with limits.
+    maximum: The largest value allowed, or None.
+  """
+  NAME = 'value'
+  __slots__ = ('minimum', 'maximum')
+
+  def __init__(self, minimum=None, maximum=None):
+    """Initialise object.
+
+    Args:
+      minimum: The smallest value allowed, or None for no limit. A str is
+        parsed as a value.
+      maximum: The largest value allowed, or None for no limit.
+    """
+    if isinstance(minimum, str):
+      minimum = self._Parse(minimum)
+    if isinstance(maximum, str):
+      maximum = self._Parse(maximum)
+    self.minimum = minimum
+    self.maximum = maximum
+
+  def __repr__(self):
+    return '%s(%r, %r)' % (type(self).__name__, self.minimum, self.maximum)
+
+  def Placeholder(self):
+    """Returns a str, the completion for a value yet to be typed."""
+    if self.minimum is not None and self.maximum is not None:
+      return '<%s-%s>' % (self.minimum, self.maximum)
+    return '<%s>' % self.NAME
+
+  def Parse(self, text):
+    """Returns text parsed as a value of the type.
+
+    Raises:
+      ValueError: text is not a valid value, with the reason why.
+    """
+    value = self._Parse(text)
+    if self.minimum is not None and value < self.minimum:
+      raise ValueError('"%s" is less than %s.' % (text, self.minimum))
+    if self.maximum is not None and value > self.maximum:
+      raise ValueError('"%s" is more than %s.' % (text, self.maximum))
+    return value
+
+  def _Parse(self, text):
+    """Returns text parsed as a value, not checking the limits."""
+    raise NotImplementedError
+
+
+class Integer(ValueType):
+  """Whole numbers, in decimal. The value is an int."""
+  NAME = 'integer'
+  __slots__ = ()
+
+  def _Parse(self, text):
+    if not _INTEGER_RE.match(text):
+      raise ValueError('"%s" is not an integer.' % text)
+    return int(text)
+
+
+class Float(ValueType):
+  """Numbers, eg 0.5 or 1e-3. The value is a float."""
+  NAME = 'number'
+  __slots__ = ()
+
+  def _Parse(self, text):
+    # As for Integer, only ASCII digits, so not float()'s underscores,
+    # spaces, other scripts' digits, nor 'inf' and 'nan'.
+    if not _FLOAT_RE.match(text):
+      raise ValueError('"%s" is not a number.' % text)
+    value = float(text)
+    if not math.isfinite(value):
+      raise ValueError('"%s" is too large.' % text)
+    return value
+
+
+class Duration(ValueType):
+  """Lengths of time, eg 90s, 5m, 1h30m or 1.5d. A plain number is seconds.
+
+  The value is a datetime.timedelta. Units are w, d, h, m, s, ms and us.
+  """
+  NAME = 'duration'
+  __slots__ = ()
+
+  def Placeholder(self):
+    return '<%s>' % self.NAME
+
+  def _Parse(self, text):
+    import datetime
+    seconds = 0
+    position = 0
+    for match in _DURATION_RE.finditer(text):
+      if match.start() != position:
+        break
+      seconds += float(match.group(1)) * _DURATION_UNITS[
+          match.group(2).lower()]
+      position = match.end()
+    if not text or position != len(text):
+      try:
+        seconds = float(text)
+      except ValueError:
+        seconds = -1
+      if seconds < 0 or not math.isfinite(seconds):
+        raise ValueError(
+            '"%s" is not a duration, eg 90s, 5m or 1h30m.' % text)
+    return datetime.timedelta(seconds=seconds)
+
+
+class Size(ValueType):
+  """Sizes in bytes, eg 512, 64k, 10MB or 1.5GiB. The value is an int.
+
+  k, m, g, t and p are powers of 1000, ki, mi, gi, ti and pi powers of
+  1024. A trailing b is optional, and case is ignored.
+  """
+  NAME = 'size'
+  __slots__ = ()
+
+  def Placeholder(self):
+    return '<%s>' % self.NAME
+
+  def _Parse(self, text):
+    match = _SIZE_RE.match(text)
+    if not match:
+      raise ValueError('"%s" is not a size, eg 512, 64k or 1.5GiB.' % text)
+    whole, fraction, unit, binary = match.groups()
+    fraction = fraction or ''
+    multiplier = 1
+    if unit:
+      base = 1024 if binary else 1000
+      multiplier = base ** (_SIZE_POWERS.index(unit.lower()) + 1)
+    scale = 10 ** len(fraction)
+    size, remainder = divmod(int(whole + fraction) * multiplier, scale)
+    if remainder:
+      raise ValueError('"%s" is not a whole number of bytes.' % text)
+    return size
+
+
+class Address(ValueType):
+  """IP addresses. The value is an ipaddress.IPv4Address or IPv6Address.
+
+  Attributes:
+    version: An int, 4 or 6 for only addresses of that version, or None.
+  """
+  NAME = 'address'
+  __slots__ = ('version',)
+
+  def __init__(self, version=None):
+    ValueType.__init__(self)
+    self.version = version
+
+  def __repr__(self):
+    return '%s(%r)' % (type(self).__name__, self.version)
+
+  def Placeholder(self):
+    if self.version:
+      return '<ipv%d-%s>' % (self.version, self.NAME)
+    return '<%s>' % self.NAME
+
+  def _Parse(self, text):
+    import ipaddress
+    value = self._Convert(ipaddress, text)
+    if self.version and value.version != self.version:
+      raise ValueError('"%s" is not an IPv%d %s.' % (
+          text, self.version, self.NAME))
+    return value
+
+  @staticmethod
+  def _Convert(ipaddress, text):
+    return ipaddress.ip_address(text)
+
+
+class Network(Address):
+  """IP networks, eg 10.0.0.0/8. An address alone is a /32 or /128.
+
+  The value is an ipaddress.IPv4Network or IPv6Network.
+
+  Attributes:
+    version: An int, 4 or 6 for only networks of that version, or None.
+    strict: A bool. If True, the address may not have host bits set, eg
+      10.0.0.1/8 is not allowed.
+  """
+  NAME = 'prefix'
+  __slots__ = ('strict',)
+
+  def __init__(self, version=None, strict=False):
+    Address.__init__(self, version)
+    self.strict = strict
+
+  def __repr__(self):
+    return '%s(%r, %r)' % (type(self).__name__, self.version, self.strict)
+
+  def _Convert(self, ipaddress, text):
+    return ipaddress.ip_network(text, strict=self.strict)
+
 
 @total_ordering
 class Option(object):
@@ -68,6 +1195,14 @@ class Option(object):
         If it is a function pointer, the function is executed at every
           match request call (with this option instance as the only arg), and
           the returned value is used in evaluation, per above.
+        If it is a Reference(), as for a function pointer, but the function
+          is only imported on the first match request.
+        If it is a Domain(), the values of the domain, as they are at each
+          match request.
+        If it is a Catalog(), the values in the catalog file.
+        If it is a ValueType(), eg Integer(1, 4094) or Network(), values
+          of that type, and the value of the option is the parsed one,
+          eg an int or an ipaddress.IPv4Network.
     group: A string, if not None, only one of the options with the same
         group may be supplied in a command line.
     position: An int, positional option location. If -1, option
@@ -82,13 +1217,31 @@ class Option(object):
         internally by Squires.
     meta: Any object type. Meta information that can be stored by the calling
       program for reference later.
+    inherit: A boolean. If True, the option also applies to all commands
+        below the one it is added to, unless a command nearer to them has
+        an option of the same name.
+    fuzzy: A boolean. If True, and no value starts with the token being
+        completed, the values closest to it are completed instead, as per
+        FuzzyIndex. Only for list and dict matches. The token must still
+        match a value by prefix for the command to run.
+    expand: A boolean. If True, the value may have ranges and wildcards,
+        eg 'ge-1/0/[0-47]', and the option's value is an Expansion() of
+        the values it stands for, even if it has neither. Not for boolean
+        or path options.
   """
 
+  # Trees hold many options, so they have no instance dict.
+  __slots__ = ('name', 'helptext', 'boolean', 'keyvalue', 'required',
+               'position', 'default', 'is_path', 'only_valid_paths',
+               'only_dir_paths', 'path_dir', 'group', 'arg_key', 'arg_val',
+               'hidden', 'matcher', 'multiword', '_index', 'meta', '_match',
+               'inherit', 'fuzzy', 'expand')
+
   def __init__(self, name, boolean=None, keyvalue=False, required=False,
                helptext=None, match=None, default=None, group=None, position=-1,
                is_path=False, only_valid_paths=False, hidden=False,
                only_dir_paths=False, path_dir=None, multiword=False,
-               meta=None):
+               meta=None, inherit=False, fuzzy=False, expand=False):
     self.name = name
     self.helptext = helptext
     self.boolean = boolean
@@ -108,6 +1261,9 @@ class Option(object):
     self.multiword = multiword
     self._index = 0
     self.meta = meta
+    self.inherit = inherit
+    self.fuzzy = fuzzy
+    self.expand = expand
     if match is not None and self.boolean is None:
       self.boolean = False
     self._match = match
@@ -129,12 +1285,22 @@ class Option(object):
       self.matcher = ListMatch(match, helptext, self)
     elif isinstance(match, dict):
       self.matcher = DictMatch(match, self)
-    elif inspect.isroutine(match):
-      self.matcher = MethodMatch(match, self)
+    elif isinstance(match, Domain):
+      self.matcher = DomainMatch(match, self)
+    elif isinstance(match, Catalog):
+      self.matcher = CatalogMatch(match, self)
+    elif isinstance(match, ValueType):
+      self.matcher = TypedMatch(match, self)
     elif match is None:
       self.matcher = BooleanMatch(name, self.helptext)
       if boolean is None:
         self.boolean = True
+    elif isinstance(match, Reference) or _IsRoutine(match):
+      self.matcher = MethodMatch(match, self)
+    if self.fuzzy and type(self.matcher) not in (ListMatch, DictMatch):
+      raise ValueError('fuzzy is only valid with a list or dict match.')
+    if self.expand and (self.boolean or self.is_path):
+      raise ValueError('expand is not valid for boolean or path options.')
 
   def __str__(self):
     opts = ["'%s'" % self.name]
@@ -150,6 +1316,12 @@ class Option(object):
       opts.append('default=%s' % self.default)
     if self.required:
       opts.append('required=True')
+    if self.inherit:
+      opts.append('inherit=True')
+    if self.fuzzy:
+      opts.append('fuzzy=True')
+    if self.expand:
+      opts.append('expand=True')
     if self.multiword:
       opts.append('multiword=True')
     else:
@@ -179,14 +1351,28 @@ class Option(object):
       if not key_match.count:
         return Match('', 0, 'key mismatch', {})
 
+    if self.expand and IsExpansion(command[index]):
+      try:
+        expansion = Expansion(command[index], self.matcher)
+      except ValueError as error:
+        return Match('', 0, str(error), {})
+      if not expansion:
+        return Match('', 0, 'Nothing matches "%s"' % command[index], {})
+      return Match(expansion, 1, '', {})
+
     # Possible completions
     valid = self.matcher.GetValidMatches(command, index)
     # Any successful match.
     value = self.matcher.GetMatch(command, index)
-    if self.boolean:
-      value = value and True or False
     reason = self.matcher.reason
     count = self.matcher.Matches(command, index)
+    if self.boolean:
+      value = value and True or False
+    elif self.expand and count:
+      if not isinstance(value, str):
+        # A typed value, expanded from its text.
+        value = command[index]
+      value = Expansion(value, self.matcher, literal=True)
     return Match(value, count, reason, valid)
 
   def __cmp__(self, other):
@@ -209,6 +1395,8 @@ class BaseMatch(object):
     reason: A str, the reason that a match failed.
   """
   MATCH = None
+  __slots__ = ('reason',)
+
   def __init__(self):
     """Override."""
     self.reason = ''
@@ -256,6 +1444,7 @@ class BaseMatch(object):
 class BooleanMatch(BaseMatch):
   """An option that matches on a boolean."""
   MATCH = 'boolean'
+  __slots__ = ('match', 'helptext')
 
   def __init__(self, value, helptext):
     """Initialise object.
@@ -282,8 +1471,12 @@ class BooleanMatch(BaseMatch):
 
 
 class RegexMatch(BaseMatch):
-  """An option that matches on a regex."""
+  """An option that matches on a regex.
+
+  The regex is compiled the first time it is matched.
+  """
   MATCH = 'regex'
+  __slots__ = ('_match', 'match_str', 'helptext', 'option')
 
   def __init__(self, value, helptext, option):
     """Initialise object.
@@ -294,12 +1487,23 @@ class RegexMatch(BaseMatch):
       option: The Option() associated with this match.
     """
     BaseMatch.__init__(self)
-    self.match = re.compile('^%s' % value, re.I)
+    self._match = None
     self.match_str = value
     self.helptext = helptext
     self.reason = ''
     self.option = option
 
+  @property
+  def match(self):
+    """The compiled regex."""
+    if self._match is None:
+      self._match = CompilePattern('^%s' % self.match_str, re.I)
+    return self._match
+
+  @match.setter
+  def match(self, value):
+    self._match = value
+
   def Matches(self, command, index):
     """Return count of matching tokens."""
     if not command[index].strip():
@@ -351,8 +1555,21 @@ class RegexMatch(BaseMatch):
 
 
 class ListMatch(BaseMatch):
-  """An option that matches on a list."""
+  """An option that matches on a list.
+
+  The values may be assigned to match, or changed in place, after which
+  Changed() must be called so the lookups see them.
+
+  Attributes:
+    INDEXED: A bool, whether prefix lookups use a sorted index of the values.
+      Off for matches whose values are rebuilt on every lookup.
+    version: An int, changed each time the values change.
+  """
   MATCH = 'list'
+  INDEXED = True
+  __slots__ = ('_match', 'helptext', 'option', 'version', '_index',
+               '_regexes', '_fuzzy')
+
   def __init__(self, value, helptext, option):
     """Initialise object.
 
@@ -362,11 +1579,100 @@ class ListMatch(BaseMatch):
       option: An Option(), the associated option for this match.
     """
     BaseMatch.__init__(self)
+    self.version = 0
+    self._index = None
+    self._fuzzy = None
     self.match = value
     self.helptext = helptext
     self.reason = ''
     self.option = option
 
+  @property
+  def match(self):
+    """The valid matches. Call Changed() after changing them in place."""
+    return self._match
+
+  @match.setter
+  def match(self, value):
+    self._match = value
+    self.Changed()
+
+  def Changed(self):
+    """Notes that the values changed, so lookups build their index again.
+
+    The values that are regexes are compiled now, the plain values are
+    only sorted when next looked up.
+    """
+    self.version += 1
+    self._index = None
+    self._regexes = None
+    if self.INDEXED and self._match:
+      regexes = [value for value in self._match if self._GetRegex(value)]
+      self._regexes = (regexes, [CompilePattern(self._GetRegex(value))
+                                 for value in regexes])
+
+  def _Index(self):
+    """Returns the values, split for lookups.
+
+    The plain values are sorted on first use after the values change.
+
+    Returns:
+      A tuple of a sorted list of the plain values, a list of the values
+      that are regexes, and a list of those regexes compiled.
+    """
+    if self._index is None:
+      regexes, patterns = self._regexes or ([], [])
+      values = sorted(value for value in self.match
+                      if not self._GetRegex(value))
+      self._index = (values, regexes, patterns)
+    return self._index
+
+  def _PrefixValues(self, token, limit=None):
+    """Returns the plain values starting with token, in sorted order.
+
+    Args:
+      token: A str.
+      limit: An int, the most values to return, or None for no limit.
+
+    Returns:
+      A list of str.
+    """
+    values = self._Index()[0]
+    start = end = bisect.bisect_left(values, token)
+    stop = len(values) if limit is None else min(len(values), start + limit)
+    while end < stop and values[end].startswith(token):
+      end += 1
+    return values[start:end]
+
+  def Scan(self, prefix):
+    """Yields the plain values starting with prefix, in sorted order."""
+    values = self._Index()[0]
+    for index in range(bisect.bisect_left(values, prefix), len(values)):
+      if not values[index].startswith(prefix):
+        return
+      yield values[index]
+
+  def _CompleteValues(self, token):
+    """Returns the plain values to complete token with.
+
+    Those starting with token, or if there are none and the option is
+    fuzzy, the closest to it. The FuzzyIndex is built on first use, and
+    again whenever the plain values change.
+
+    Args:
+      token: A str.
+
+    Returns:
+      A list of str.
+    """
+    values = self._PrefixValues(token)
+    if values or not self.option.fuzzy:
+      return values
+    plain = self._Index()[0]
+    if self._fuzzy is None or self._fuzzy[0] is not plain:
+      self._fuzzy = (plain, FuzzyIndex(plain))
+    return self._fuzzy[1].Search(token)
+
   def _GetRegex(self, needle):
     """If the string parameter embeds a regex, return the regex.
 
@@ -384,12 +1690,20 @@ class ListMatch(BaseMatch):
 
   def Matches(self, command, index):
     """Determine if this option matches the command string."""
+    if self.INDEXED:
+      if not command[index].strip():
+        # Never matches the empty command line.
+        return 0
+      for pattern in self._Index()[2]:
+        if pattern.match(command[index]):
+          return 1
+      return 1 if self._PrefixValues(command[index], limit=1) else 0
     for value in self.match:
       if not command[index].strip():
         # Never matches the empty command line.
         return 0
       if self._GetRegex(value):
-        if re.match(self._GetRegex(value), command[index]):
+        if CompilePattern(self._GetRegex(value)).match(command[index]):
           return 1
       else:
         if len(self.GetValidMatches(command, index)) > 0:
@@ -411,27 +1725,39 @@ class ListMatch(BaseMatch):
     """
     self.reason = ''
     token = command[index]
-    found_close_match = False
-    close_matches = 0
-    matching_token = None
-    for value in self.match:
-      if value == token:
-        return value
-      if value.startswith(token):
-        close_matches += 1
-        if not found_close_match:
-          # The "closest" is the first non-exact find if we don't
-          # find an exact match.
-          matching_token = value
-          found_close_match = True
-    if found_close_match and close_matches == 1:
-      return matching_token
+    if self.INDEXED:
+      if token in self.match:
+        return token
+      close_matches = self._PrefixValues(token, limit=2) + [
+          value for value in self._Index()[1] if value.startswith(token)]
+      if len(close_matches) == 1:
+        return close_matches[0]
+    else:
+      found_close_match = False
+      close_matches = 0
+      matching_token = None
+      for value in self.match:
+        if value == token:
+          return value
+        if value.startswith(token):
+          close_matches += 1
+          if not found_close_match:
+            # The "closest" is the first non-exact find if we don't
+            # find an exact match.
+            matching_token = value
+            found_close_match = True
+      if found_close_match and close_matches == 1:
+        return matching_token
 
     self.reason = 'Must match one of: %s' % ','.join(self.match)
     return None
 
   def GetValidMatches(self, command, index):
     matches = {}
+    if self.INDEXED and index is not None and command[index].strip():
+      for item in self._CompleteValues(command[index]):
+        matches[item] = '[Default]' if self.option.default == item else ''
+      return matches
     for item in self.match:
       if index is None or command[index] == ' ':
         if self.option.default == item:
@@ -456,6 +1782,7 @@ class ListMatch(BaseMatch):
 class DictMatch(ListMatch):
   """An option that matches on a dict."""
   MATCH = 'dict'
+  __slots__ = ()
 
   def __init__(self, value, option):
     """Initialise object.
@@ -465,13 +1792,16 @@ class DictMatch(ListMatch):
       option: The  Option() this match is for.
     """
     ListMatch.__init__(self, value, '', option)
-    self.match = value
-    self.reason = ''
-    self.option = option
 
   def GetValidMatches(self, command, index):
     """Returns the valid matches for the given token."""
     matches = {}
+    if self.INDEXED and index is not None and command[index].strip():
+      for item in self._CompleteValues(command[index]):
+        matches[item] = self.match[item]
+        if self.option.default == item:
+          matches[item] += ' [Default]'
+      return matches
     for item, helptext in self.match.items():
       if index is None or command[index] == ' ':
         matches[item] = helptext
@@ -490,42 +1820,203 @@ class DictMatch(ListMatch):
     return matches
 
 
+class DomainMatch(BaseMatch):
+  """An option that matches on the values of a Domain().
+
+  Attributes:
+    LIMIT: An int, the most values GetValidMatches() returns, or None for
+      all of them.
+  """
+  MATCH = 'domain'
+  LIMIT = None
+  __slots__ = ('domain', 'option')
+
+  def __init__(self, domain, option):
+    """Constructor.
+
+    Args:
+      domain: A Domain() or Catalog(), the values to match.
+      option: The related 'Option' object.
+    """
+    BaseMatch.__init__(self)
+    self.domain = domain
+    self.option = option
+
+  def Matches(self, command, index):
+    """Determine if this option matches the command string."""
+    token = command[index]
+    if token.strip() and self.domain.Prefix(token, limit=1):
+      return 1
+    return 0
+
+  def GetMatch(self, command, index):
+    """Get the best match for this token. See ListMatch.GetMatch()."""
+    self.reason = ''
+    close_matches = self.domain.Prefix(command[index], limit=2)
+    if command[index] in close_matches[:1] or len(close_matches) == 1:
+      return close_matches[0]
+    self.reason = 'Must match one of the %s' % self.domain.name
+    return None
+
+  def GetValidMatches(self, command, index):
+    """Returns the valid matches for the given token."""
+    if index is None or command[index] == ' ':
+      prefix = ''
+    else:
+      prefix = command[index]
+    matches = {}
+    for value, helptext in self.domain.Items(prefix, self.LIMIT):
+      matches[value] = helptext
+      if self.option.default == value:
+        matches[value] = (helptext + ' [Default]').lstrip()
+    return matches
+
+  def Scan(self, prefix):
+    """Yields the values starting with prefix, in sorted order."""
+    return self.domain.Scan(prefix)
+
+
+class CatalogMatch(DomainMatch):
+  """An option that matches on the values of a Catalog().
+
+  A catalog may hold millions of values, so only the first LIMIT matching
+  a token are listed. An exact match is always among them.
+  """
+  MATCH = 'catalog'
+  LIMIT = 1000
+  __slots__ = ()
+
+
+class TypedMatch(BaseMatch):
+  """An option that matches values of a ValueType(), eg Integer(1, 4094).
+
+  A token is parsed once, however often it is matched, as the last token
+  parsed is kept with its value.
+  """
+  MATCH = 'typed'
+  __slots__ = ('type', 'option', '_parsed')
+
+  def __init__(self, value_type, option):
+    """Initialise object.
+
+    Args:
+      value_type: A ValueType(), the type of the values.
+      option: The Option() this match is for.
+    """
+    BaseMatch.__init__(self)
+    self.type = value_type
+    self.option = option
+    self._parsed = (None, None, '')
+
+  def _Parse(self, token):
+    """Returns the token's value, or None, and why it is not valid."""
+    parsed = self._parsed
+    if parsed[0] != token:
+      try:
+        parsed = (token, self.type.Parse(token), '')
+      except ValueError as error:
+        parsed = (token, None, str(error))
+      self._parsed = parsed
+    return parsed[1:]
+
+  def Convert(self, value):
+    """Returns a value, such as a default, as the type. A str is parsed."""
+    if isinstance(value, str):
+      return self.type.Parse(value)
+    return value
+
+  def Matches(self, command, index):
+    """Determine if this option matches the command string."""
+    token = command[index]
+    if not token.strip() or self._Parse(token)[1]:
+      return 0
+    return 1
+
+  def GetMatch(self, command, index):
+    """Returns the token's value, or None, setting reason, if invalid."""
+    value, self.reason = self._Parse(command[index])
+    return value
+
+  def GetValidMatches(self, command, index):
+    """Returns the placeholder, or the token if it is valid."""
+    helptext = self.option.helptext or ''
+    if index is None or command[index] == ' ':
+      return {self.type.Placeholder(): helptext}
+    if self.Matches(command, index):
+      return {command[index]: helptext}
+    return {}
+
+
 class MethodMatch(DictMatch):
   """An option that matches on a method."""
   MATCH = 'method'
+  INDEXED = False
+  __slots__ = ('method',)
 
   def __init__(self, method, option):
     """Constructor.
 
     Args:
-      method: A callable, the method used for match. The callable
-        must return a dict of valid matches:helptext.
+      method: A callable or Reference(), the method used for match. The
+        callable must return a dict of valid matches:helptext.
       option: The related 'Option' object
     """
     DictMatch.__init__(self, '', option)
     self.method = method
     self.option = option
-    self.match = self.method(self.option)
+    if isinstance(method, Reference):
+      # Not imported until first used.
+      self.match = None
+    else:
+      self.match = self.method(self.option)
+
+  def Matches(self, command, index):
+    """Determine if this option matches the command string."""
+    if self.match is None:
+      self._Update()
+    return super(MethodMatch, self).Matches(command, index)
+
+  def GetMatch(self, command, index):
+    """Get the best match for this token. See ListMatch.GetMatch()."""
+    if self.match is None:
+      self._Update()
+    return super(MethodMatch, self).GetMatch(command, index)
 
   def GetValidMatches(self, command, index):
     """Returns the valid matches for the given token."""
-    self.match = {}
+    self._Update()
+    return super(MethodMatch, self).GetValidMatches(command, index)
+
+  def Scan(self, prefix):
+    """Yields the values starting with prefix. See ListMatch.Scan()."""
+    if self.match is None:
+      self._Update()
+    return super(MethodMatch, self).Scan(prefix)
+
+  def _Update(self):
+    """Sets match from the values the method returns now."""
     match = self.method(self.option)
     if isinstance(match, list):
+      values = {}
       for item in match:
-        self.match[item] = ''
+        values[item] = ''
         if item == self.option.default:
-          self.match[item] += ' [Default]'
+          values[item] += ' [Default]'
+      match = values
     elif isinstance(match, str):
-      self.match[match] = ''
-    else:
-      self.match = match
-    return super(MethodMatch, self).GetValidMatches(command, index)
+      match = {match: ''}
+    self.match = match
 
 
 class PathMatch(BaseMatch):
-  """An option matching a file path."""
+  """An option matching a file path.
+
+  The regex is compiled the first time paths are listed.
+  """
   MATCH = 'path'
+  __slots__ = ('only_existing', 'default_path', 'only_dirs', 'option',
+               'match_str', '_match_re')
+
   def __init__(self, matches, option, only_existing=False,
                default_path=None, only_dirs=False):
     """Constructor.
@@ -544,15 +2035,24 @@ class PathMatch(BaseMatch):
     self.default_path = default_path
     self.only_dirs = only_dirs
     self.option = option
-    if matches is None:
-      self.match_re = re.compile('.*')
-    else:
-      self.match_re = re.compile(matches)
+    self.match_str = '.*' if matches is None else matches
+    self._match_re = None
 
     if self.default_path:
       if not self.default_path.endswith(os.sep):
         self.default_path += os.sep
 
+  @property
+  def match_re(self):
+    """The compiled regex that file names must match."""
+    if self._match_re is None:
+      self._match_re = CompilePattern(self.match_str)
+    return self._match_re
+
+  @match_re.setter
+  def match_re(self, value):
+    self._match_re = value
+
   def Matches(self, command, index):
     token = command[index].strip()
     if not token:
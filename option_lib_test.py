@@ -15,10 +15,19 @@
 # permissions and limitations under the License.
 
 import os
+import pickle
+import re
+import shutil
+import tempfile
 import unittest
 
 import option_lib
 
+
+def _Colours(unused_option):
+  return ['red', 'green']
+
+
 TEST_PATH = '.'
 
 
@@ -107,6 +116,24 @@ class MatchTest(unittest.TestCase):
     self.assertEqual({},
                      bm.GetValidMatches(['so-0/0/0'], 0))
 
+  def testPatternCache(self):
+    first = option_lib.Option('first', match='[fgx]e-.*')
+    second = option_lib.Option('second', match='[fgx]e-.*')
+    self.assertIsNone(first.matcher._match)
+    self.assertTrue(first.matcher.Matches(['xe-1'], 0))
+    self.assertIsNone(second.matcher._match)
+    self.assertTrue(second.matcher.Matches(['xe-1'], 0))
+    self.assertIs(first.matcher.match, second.matcher.match)
+    path = option_lib.Option('path', is_path=True, match=r'\.txt$',
+                             position=0)
+    self.assertIsNone(path.matcher._match_re)
+    self.assertIs(option_lib.CompilePattern(r'\.txt$'), path.matcher.match_re)
+    colours = option_lib.ListMatch(['/gr[ae]y/', 'red'], '', first)
+    self.assertTrue(colours.Matches(['grey'], 0))
+    self.assertIs(option_lib.CompilePattern('gr[ae]y'), colours._Index()[2][0])
+    self.assertEqual(option_lib.PATTERN_CACHE_SIZE,
+                     option_lib.CompilePattern.cache_info().maxsize)
+
   def testMultiword(self):
     opt = option_lib.Option(name='<interface>', multiword=True)
     bm = option_lib.RegexMatch('\d+[^\d]+\d+', 'A Juniper ethernet interface', opt)
@@ -142,6 +169,15 @@ class MatchTest(unittest.TestCase):
                      bm.GetValidMatches([''], 0))
     self.assertEqual({},
                      bm.GetValidMatches(['wh'], 0))
+    # The values may be changed in place, once the change is noted.
+    bm.match[0] = 'white'
+    self.assertEqual(0, bm.Matches(['white'], 0))
+    version = bm.version
+    bm.Changed()
+    self.assertNotEqual(version, bm.version)
+    self.assertEqual(1, bm.Matches(['white'], 0))
+    self.assertEqual(0, bm.Matches(['red'], 0))
+    self.assertEqual({'white': ''}, bm.GetValidMatches(['wh'], 0))
 
   def testListRegexMatch(self):
     bm = option_lib.ListMatch(['/wi*/', '/bo*/', 'foobar'], 'foo',
@@ -161,6 +197,10 @@ class MatchTest(unittest.TestCase):
     self.assertEqual({'foobar': '', '/bo*/': '', '/wi*/': ''},
                      bm.GetValidMatches([''], 0))
     self.assertEqual({}, bm.GetValidMatches(['booo'], 0))
+    # Regexes are compiled as the values are set, not when first used.
+    self.assertRaises(re.error, option_lib.ListMatch, ['/wi(/'], 'foo',
+                      option_lib.Option(['foo'], 0))
+    self.assertRaises(re.error, setattr, bm, 'match', ['/bo)/'])
 
   def testDict(self):
     bm = option_lib.DictMatch(
@@ -191,6 +231,23 @@ class MatchTest(unittest.TestCase):
     self.assertEqual({},
                      bm.GetValidMatches(['wh'], 0))
 
+  def testDictIndex(self):
+    values = dict(('v%05d' % i, 'Value %d' % i) for i in range(20000))
+    option = option_lib.Option('foo', default='v00100')
+    bm = option_lib.DictMatch(values, option)
+    self.assertEqual(['v00100', 'v00101'],
+                     list(bm.GetValidMatches(['v0010'], 0))[:2])
+    self.assertEqual('Value 100 [Default]',
+                     bm.GetValidMatches(['v0010'], 0)['v00100'])
+    self.assertEqual(10, len(bm.GetValidMatches(['v0010'], 0)))
+    # The index follows changes to the values, once noted.
+    values['v00109x'] = 'New'
+    bm.Changed()
+    self.assertEqual(11, len(bm.GetValidMatches(['v0010'], 0)))
+    bm.match = {'v00100': 'Replaced'}
+    self.assertEqual({'v00100': 'Replaced [Default]'},
+                     bm.GetValidMatches(['v0010'], 0))
+
   def testDictRegexMatch(self):
     bm = option_lib.DictMatch(
         {'foobar': 'foobar',
@@ -247,6 +304,279 @@ class MatchTest(unittest.TestCase):
     self.assertEqual({},
                      bm.GetValidMatches(['wh'], 0))
 
+  def testDomain(self):
+    domain = option_lib.Domain('option_lib_test colours')
+    self.assertIs(domain, option_lib.Domain('option_lib_test colours'))
+    domain.Add(['red', 'blue', 'blueish'])
+    domain.Add({'black': 'The colour black', 'red': ''})
+    self.assertEqual(['black', 'blue', 'blueish', 'red'], list(domain))
+    version = domain.version
+    domain.Add(['red'])
+    self.assertEqual(version, domain.version)
+    domain.Remove(['red', 'white'])
+    self.assertNotIn('red', domain)
+    self.assertLess(version, domain.version)
+    domain.Add(['c%03d' % i for i in range(100)])
+    domain.Replace(['blue', 'blueish', 'c001', 'green'])
+    self.assertEqual(['blue', 'blueish', 'c001', 'green'], list(domain))
+    self.assertEqual('', domain.GetHelp('black'))
+    self.assertIs(domain, pickle.loads(pickle.dumps(domain)))
+
+    option = option_lib.Option('foo', match=domain, default='green')
+    bm = option.matcher
+    self.assertEqual('domain', bm.MATCH)
+    self.assertTrue(bm.Matches(['blu'], 0))
+    self.assertFalse(bm.Matches(['white'], 0))
+    self.assertEqual('blue', bm.GetMatch(['blue'], 0))
+    self.assertEqual('green', bm.GetMatch(['g'], 0))
+    self.assertEqual(None, bm.GetMatch(['bl'], 0))
+    self.assertEqual({'blue': '', 'blueish': ''},
+                     bm.GetValidMatches(['bl'], 0))
+    self.assertEqual({'blue': '', 'blueish': '', 'c001': '',
+                      'green': '[Default]'}, bm.GetValidMatches([' '], 0))
+    domain.Add({'cyan': 'Light blue'})
+    self.assertEqual({'c001': '', 'cyan': 'Light blue'},
+                     bm.GetValidMatches(['c'], 0))
+
+  def testCatalog(self):
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    path = os.path.join(tmpdir, 'serials.cat')
+    serials = ['SN%06d' % i for i in range(0, 20000, 3)]
+    self.assertEqual(len(serials) + 1, option_lib.BuildCatalog(
+        path, serials + [('SN000003', 'Spare'), ('caf\xe9', 'Caf\xe9')]))
+    self.assertRaises(ValueError, option_lib.BuildCatalog, path, ['a\0b'])
+    catalog = option_lib.Catalog(path)
+    self.assertIs(catalog, option_lib.Catalog(path))
+    self.assertIs(catalog, pickle.loads(pickle.dumps(catalog)))
+    self.assertEqual(len(serials) + 1, len(catalog))
+    self.assertIn('SN019998', catalog)
+    self.assertNotIn('SN000001', catalog)
+    self.assertEqual('Spare', catalog.GetHelp('SN000003'))
+    self.assertEqual([('SN000000', ''), ('SN000003', 'Spare')],
+                     catalog.Items('SN00000', 2))
+    self.assertEqual(['SN019992', 'SN019995', 'SN019998'],
+                     catalog.Prefix('SN01999'))
+    self.assertEqual(['caf\xe9'], catalog.Prefix('caf'))
+    self.assertEqual([], catalog.Prefix('SN02'))
+
+    option = option_lib.Option('serial', match=catalog)
+    bm = option.matcher
+    self.assertEqual('catalog', bm.MATCH)
+    self.assertTrue(bm.Matches(['SN0000'], 0))
+    self.assertFalse(bm.Matches(['SN0000001'], 0))
+    self.assertEqual('SN000012', bm.GetMatch(['SN000012'], 0))
+    self.assertEqual(None, bm.GetMatch(['SN0000'], 0))
+    self.assertEqual({'SN000030': '', 'SN000033': '', 'SN000036': '',
+                      'SN000039': ''}, bm.GetValidMatches(['SN00003'], 0))
+    self.assertEqual(bm.LIMIT, len(bm.GetValidMatches([' '], 0)))
+
+    # A rebuilt file is only used once reloaded.
+    option_lib.BuildCatalog(path, ['SN1'])
+    self.assertIn('SN000000', catalog)
+    self.assertTrue(catalog.Reload())
+    self.assertEqual(['SN1'], catalog.Prefix(''))
+    self.assertFalse(catalog.Reload())
+
+    # A failed build leaves no file behind.
+    os.mkdir(os.path.join(tmpdir, 'dir.cat'))
+    self.assertRaises(OSError, option_lib.BuildCatalog,
+                      os.path.join(tmpdir, 'dir.cat'), ['SN1'])
+    self.assertEqual(['dir.cat', 'serials.cat'], sorted(os.listdir(tmpdir)))
+
+    # A relative path still names the file from another directory.
+    self.addCleanup(os.chdir, os.getcwd())
+    os.chdir(tmpdir)
+    relative = option_lib.Catalog('serials.cat')
+    self.assertIs(catalog, relative)
+    os.chdir(os.path.dirname(tmpdir))
+    option_lib.BuildCatalog(path, ['SN2'])
+    self.assertTrue(relative.Reload())
+    self.assertIs(catalog, pickle.loads(pickle.dumps(relative)))
+
+  def testFuzzy(self):
+    index = option_lib.FuzzyIndex(
+        ['ge-0/0/%d.%s' % (port, unit) for port in range(48)
+         for unit in ('core', 'edge', 'mgmt')] + ['Uplink-Core'])
+    self.assertEqual(145, len(index))
+    self.assertEqual(['ge-0/0/17.core', 'ge-0/0/17.edge'],
+                     index.Search('0/17.', 2))
+    # Typos still find the value.
+    self.assertEqual('ge-0/0/17.core', index.Search('17.cor')[0])
+    self.assertEqual('ge-0/0/17.mgmt', index.Search('/17.mgtm')[0])
+    self.assertEqual(['Uplink-Core'], index.Search('UPLINK', 1))
+    self.assertEqual(option_lib.FUZZY_LIMIT, len(index.Search('core')))
+    self.assertEqual([], index.Search('ge'))
+    self.assertEqual([], index.Search('xyz'))
+
+    option = option_lib.Option('colour', match=['red', 'green', 'yellow'],
+                               fuzzy=True)
+    bm = option.matcher
+    self.assertEqual({'green': ''}, bm.GetValidMatches(['gr'], 0))
+    self.assertEqual({'yellow': ''}, bm.GetValidMatches(['yelow'], 0))
+    self.assertEqual(0, bm.Matches(['yelow'], 0))
+    self.assertEqual(None, bm.GetMatch(['yelow'], 0))
+    bm.match = ['red', 'mellow']
+    self.assertEqual({'mellow': ''}, bm.GetValidMatches(['yelow'], 0))
+    option = option_lib.Option('port', match={'uplink': 'Up'}, fuzzy=True)
+    self.assertEqual({'uplink': 'Up'},
+                     option.matcher.GetValidMatches(['uplnk'], 0))
+    self.assertRaises(ValueError, option_lib.Option, 'colour', match='[a-z]+',
+                      fuzzy=True)
+
+  def testExpansion(self):
+    ranges = option_lib.RangeSet('5-7,1,000-2,6-9')
+    self.assertEqual([(0, 2), (5, 9)], ranges.ranges)
+    self.assertEqual(8, len(ranges))
+    self.assertIn(6, ranges)
+    self.assertNotIn(4, ranges)
+    self.assertEqual("RangeSet('000-002,005-009')", repr(ranges))
+    self.assertRaises(ValueError, option_lib.RangeSet, '3-1')
+    self.assertTrue(option_lib.IsExpansion('ge-0/0/[0-3]'))
+    self.assertTrue(option_lib.IsExpansion('ge-*'))
+    self.assertFalse(option_lib.IsExpansion('ge-[a]'))
+
+    values = ['ge-0/0/%d' % port for port in range(12)] + ['xe-0/1/0']
+    option = option_lib.Option('port', match=values, expand=True)
+    self.assertEqual('ge-0/0/1[0-9]',
+                     str(option.FindMatches(['ge-0/0/1[0-9]'], 0).value))
+    self.assertEqual(['ge-0/0/10', 'ge-0/0/11'],
+                     list(option.FindMatches(['ge-0/0/1[0-9]'], 0).value))
+    # Values are in the order of the ranges, unless a range is too large to
+    # enumerate, when they are in the order of the index.
+    self.assertEqual(['ge-0/0/1', 'ge-0/0/9', 'ge-0/0/10'],
+                     list(option.FindMatches(['ge-0/0/[1,9-10]'], 0).value))
+    self.assertEqual(['ge-0/0/1', 'ge-0/0/10', 'ge-0/0/11', 'ge-0/0/9'],
+                     list(option.FindMatches(['ge-0/0/[1,9-5000]'], 0).value))
+    self.assertEqual(['ge-0/0/1', 'ge-0/0/10', 'ge-0/0/11'],
+                     list(option.FindMatches(['?e-0/0/1*'], 0).value))
+    self.assertEqual(['xe-0/1/0'],
+                     list(option.FindMatches(['xe'], 0).value))
+    match = option.FindMatches(['ge-0/0/[20-30]'], 0)
+    self.assertEqual((0, 'Nothing matches "ge-0/0/[20-30]"'),
+                     (match.count, match.reason))
+    self.assertEqual([], list(option_lib.Expansion('ge-0/0/0[1-2]',
+                                                    option.matcher)))
+    # Wildcards give way to ranges, which match numbers in them only.
+    option = option_lib.Option('unit', match=['a-2-5x', 'a-5-9x', 'a-02'],
+                               expand=True)
+    self.assertEqual(['a-2-5x'],
+                     list(option.FindMatches(['*-[1-3]*'], 0).value))
+    self.assertEqual(['a-02'],
+                     list(option.FindMatches(['a-[00-10]'], 0).value))
+    self.assertEqual(['a-2-5x', 'a-5-9x'],
+                     list(option.FindMatches(['a-[0-10]*'], 0).value))
+
+    option = option_lib.Option('vlan', match=r'\d{1,4}$', expand=True)
+    self.assertEqual(['8', '9', '10', '4000'],
+                     list(option.FindMatches(['[8-10,4000]'], 0).value))
+    self.assertEqual(0, option.FindMatches(['[8-10000]'], 0).count)
+    self.assertEqual('Wildcards need a list of values to match.',
+                     option.FindMatches(['1*'], 0).reason)
+    self.assertEqual(['[1]'], list(option_lib.Expansion(
+        '[1]', option.matcher, literal=True)))
+    self.assertRaises(ValueError, option_lib.Option, 'all', expand=True)
+
+    domain = option_lib.Domain('option_lib_test scan')
+    domain.Replace(['v%04d' % i for i in range(1000)])
+    option = option_lib.Option('value', match=domain, expand=True)
+    scan = iter(option.FindMatches(['v0[100-999]'], 0).value)
+    self.assertEqual('v0100', next(scan))
+    # Scanned a page at a time, so later changes are seen.
+    domain.Remove(['v0999'])
+    self.assertEqual(['v%04d' % i for i in range(101, 999)], list(scan))
+
+  def testTyped(self):
+    vlan = option_lib.Integer(1, 4094)
+    self.assertEqual(100, vlan.Parse('100'))
+    self.assertEqual('<1-4094>', vlan.Placeholder())
+    self.assertEqual('<integer>', option_lib.Integer().Placeholder())
+    for text, reason in (('0', '"0" is less than 1.'),
+                         ('5000', '"5000" is more than 4094.'),
+                         ('1.5', '"1.5" is not an integer.'),
+                         ('', '"" is not an integer.')):
+      with self.assertRaises(ValueError) as raised:
+        vlan.Parse(text)
+      self.assertEqual(reason, str(raised.exception))
+    self.assertEqual(-2, option_lib.Integer().Parse('-2'))
+
+    ratio = option_lib.Float(0, 1)
+    self.assertEqual(0.25, ratio.Parse('0.25'))
+    self.assertEqual(1e-3, ratio.Parse('1e-3'))
+    for text in ('nan', '2', '0_5', ' 0.5', '1e999'):
+      self.assertRaises(ValueError, ratio.Parse, text)
+    self.assertRaises(ValueError, option_lib.Integer().Parse, '1_000')
+    self.assertRaises(ValueError, option_lib.Float().Parse, '1_000')
+
+    duration = option_lib.Duration(maximum='1d')
+    self.assertEqual(5400, duration.Parse('1h30m').total_seconds())
+    self.assertEqual(90, duration.Parse('90').total_seconds())
+    self.assertEqual(0.25, duration.Parse('250ms').total_seconds())
+    self.assertEqual('<duration>', duration.Placeholder())
+    for text in ('1x', 'h', '1h 30m', '-5'):
+      self.assertRaises(ValueError, duration.Parse, text)
+    self.assertRaises(ValueError, duration.Parse, '2d')
+
+    size = option_lib.Size()
+    self.assertEqual(65536, size.Parse('64KiB'))
+    self.assertEqual(1500000000, size.Parse('1.5g'))
+    self.assertEqual(512, size.Parse('512'))
+    self.assertRaises(ValueError, size.Parse, '1.5')
+    self.assertRaises(ValueError, size.Parse, '5q')
+
+    import ipaddress
+    self.assertEqual(ipaddress.ip_address('2001:db8::1'),
+                     option_lib.Address().Parse('2001:db8::1'))
+    with self.assertRaises(ValueError) as raised:
+      option_lib.Address(4).Parse('2001:db8::1')
+    self.assertEqual('"2001:db8::1" is not an IPv4 address.',
+                     str(raised.exception))
+    self.assertEqual('<ipv4-address>', option_lib.Address(4).Placeholder())
+    self.assertEqual(ipaddress.ip_network('10.0.0.0/8'),
+                     option_lib.Network().Parse('10.1.0.0/8'))
+    self.assertRaises(ValueError, option_lib.Network(strict=True).Parse,
+                      '10.1.0.0/8')
+    self.assertEqual('<prefix>', option_lib.Network().Placeholder())
+
+    option = option_lib.Option('vlan', match=vlan, helptext='VLAN id')
+    bm = option.matcher
+    self.assertEqual('typed', bm.MATCH)
+    self.assertEqual({'<1-4094>': 'VLAN id'}, bm.GetValidMatches([' '], 0))
+    self.assertEqual({'12': 'VLAN id'}, bm.GetValidMatches(['12'], 0))
+    self.assertEqual({}, bm.GetValidMatches(['x'], 0))
+    match = option.FindMatches(['12'], 0)
+    self.assertEqual((12, 1, ''), match[:3])
+    # The token is only parsed once.
+    parsed = bm._parsed
+    option.FindMatches(['12'], 0)
+    self.assertIs(parsed, bm._parsed)
+    match = option.FindMatches(['9999'], 0)
+    self.assertEqual((None, 0, '"9999" is more than 4094.'), match[:3])
+    self.assertEqual(pickle.loads(pickle.dumps(vlan)).maximum, 4094)
+
+    option = option_lib.Option('vlan', match=vlan, expand=True)
+    self.assertEqual([1, 2, 3], list(option.FindMatches(['[1-3]'], 0).value))
+    self.assertEqual(0, option.FindMatches(['[0-3]'], 0).count)
+    self.assertEqual([7], list(option.FindMatches(['7'], 0).value))
+
+  def testReference(self):
+    reference = option_lib.Reference('os.path:join')
+    self.assertEqual(os.path.join, reference.Resolve())
+    self.assertEqual('a/b', reference('a', 'b'))
+    self.assertEqual(option_lib.Reference('os.path:join'), reference)
+    self.assertRaises(ValueError, option_lib.Reference, 'os.path.join')
+    self.assertRaises(ImportError, option_lib.Reference('os.path:nope'))
+    self.assertRaises(ImportError, option_lib.Reference('nosuchmodule:x'))
+
+    # The method is not called until the option is matched.
+    option = option_lib.Option(
+        'foo', match=option_lib.Reference('os:nosuchfunction'))
+    self.assertTrue(isinstance(option.matcher, option_lib.MethodMatch))
+    option = option_lib.Option(
+        'foo', match=option_lib.Reference('option_lib_test:_Colours'))
+    self.assertEqual(1, option.matcher.Matches(['gr'], 0))
+    self.assertEqual({'red': ''}, option.matcher.GetValidMatches(['r'], 0))
+
   def testPath(self):
     """Tests path matching."""
     fm = option_lib.PathMatch(None, None)
@@ -8,13 +8,313 @@ pipes, ie 'command | modifier'.
 #TODO(bbuxton): Support chaining pipes.
 __author__ = 'bbuxton@google.com (Ben Buxton)'
 
+import codecs
+import errno
+import io
+import os
 import re
-import subprocess
 import sys
+import threading
+
+try:
+  import termios
+  import tty
+except ImportError:
+  termios = None  # Not a unix terminal, paging is disabled.
 
 # Character used as a pipe to split command line
 PIPE_CHAR = '|'
 
+# Terminal height used when it cannot be determined.
+DEFAULT_LINES = 24
+
+# Largest number of bytes moved by a single copy between descriptors.
+COPY_CHUNK = 1 << 20
+
+# Largest number of buffers handed to a single writev().
+IOV_MAX = 1024
+
+
+_thread = threading.local()
+
+
+class PipeClosed(IOError):
+  """Raised by a pipe's write() once it no longer accepts output."""
+
+
+class ThreadStdout(object):
+  """A sys.stdout that can be redirected separately in each thread.
+
+  Installed by InstallThreadStdout() once commands run in the background,
+  so that their output is kept apart from the foreground's.
+
+  Attributes:
+    default: A file object, stdout for threads that are not redirected.
+  """
+
+  def __init__(self, default):
+    self.default = default
+
+  def Target(self):
+    """Returns the stdout for the current thread."""
+    return getattr(_thread, 'stdout', None) or self.default
+
+  def write(self, string):
+    return self.Target().write(string)
+
+  def flush(self):
+    return self.Target().flush()
+
+  def __getattr__(self, name):
+    return getattr(self.Target(), name)
+
+
+def InstallThreadStdout():
+  """Replaces sys.stdout with a ThreadStdout, if not already done."""
+  if not isinstance(sys.stdout, ThreadStdout):
+    sys.stdout = ThreadStdout(sys.stdout)
+
+
+def CurrentStdout():
+  """Returns the stdout for the current thread."""
+  out = sys.stdout
+  if isinstance(out, ThreadStdout):
+    out = out.Target()
+  return out
+
+
+def RedirectStdout(fdesc):
+  """Redirects stdout, for this thread only if a ThreadStdout is installed.
+
+  Args:
+    fdesc: A file-like object, the new stdout.
+
+  Returns:
+    The previous stdout, to pass to RedirectStdout() to restore it.
+  """
+  if isinstance(sys.stdout, ThreadStdout):
+    old = getattr(_thread, 'stdout', None)
+    _thread.stdout = fdesc
+    return old
+  old, sys.stdout = sys.stdout, fdesc
+  return old
+
+
+def Terminal():
+  """Returns where output is finally displayed for the current thread.
+
+  This is sys.__stdout__, except in a background job, where it is the
+  job's output spool. Pipes write their output here.
+  """
+  return getattr(_thread, 'terminal', None) or sys.__stdout__
+
+
+def GetThreadOutput():
+  """Returns the output settings of this thread, for SetThreadOutput()."""
+  return (getattr(_thread, 'stdout', None),
+          getattr(_thread, 'terminal', None))
+
+
+def SetThreadOutput(output):
+  """Sets the stdout and terminal for the current thread.
+
+  Args:
+    output: A tuple of (stdout, terminal). None for either means the
+      process wide default.
+
+  Returns:
+    The previous output settings.
+  """
+  old = GetThreadOutput()
+  _thread.stdout, _thread.terminal = output
+  return old
+
+
+def _Fileno(source):
+  """Returns the file descriptor for a file object or descriptor."""
+  if isinstance(source, int):
+    return source
+  if hasattr(source, 'flush'):
+    source.flush()
+  return source.fileno()
+
+
+def _WriteFd(fd, buffers):
+  """Writes bytes-like objects to a file descriptor, without copying them.
+
+  Args:
+    fd: An int, the file descriptor to write to.
+    buffers: A list of bytes-like objects, eg bytes or memoryview.
+
+  Raises:
+    PipeClosed: The reader of fd has gone away.
+  """
+  views = [memoryview(b).cast('B') for b in buffers]
+  views = [v for v in views if len(v)]
+  try:
+    while views:
+      if hasattr(os, 'writev'):
+        written = os.writev(fd, views[:IOV_MAX])
+      else:
+        written = os.write(fd, views[0])
+      while written:
+        if written >= len(views[0]):
+          written -= len(views.pop(0))
+        else:
+          views[0] = views[0][written:]
+          written = 0
+  except (IOError, OSError) as e:
+    if e.errno == errno.EPIPE:
+      raise PipeClosed(str(e))
+    raise
+
+
+def _CopyFd(in_fd, out_fd, offset=None, count=None):
+  """Copies data between file descriptors.
+
+  The copy is done within the kernel where possible, with sendfile()
+  when in_fd is a regular file, or splice() when either end is a pipe.
+  Otherwise data is moved through a single reused buffer.
+
+  Args:
+    in_fd: An int, the file descriptor to read from.
+    out_fd: An int, the file descriptor to write to.
+    offset: An int, the offset in in_fd to read from. If None, read
+      from (and advance) the current position.
+    count: An int, the number of bytes to copy. If None, copy to EOF.
+
+  Returns:
+    An int, the number of bytes copied.
+
+  Raises:
+    PipeClosed: The reader of out_fd has gone away.
+  """
+  copied = 0
+  methods = ['sendfile', 'splice']
+  buf = None
+  try:
+    while count is None or copied < count:
+      size = COPY_CHUNK if count is None else min(COPY_CHUNK, count - copied)
+      done = None
+      while methods and done is None:
+        try:
+          if methods[0] == 'sendfile' and hasattr(os, 'sendfile'):
+            done = os.sendfile(out_fd, in_fd, offset, size)
+          elif methods[0] == 'splice' and hasattr(os, 'splice'):
+            done = os.splice(in_fd, out_fd, size, offset_src=offset)
+          else:
+            methods.pop(0)
+        except (IOError, OSError) as e:
+          if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ESPIPE,
+                             errno.ENOTSOCK):
+            raise
+          methods.pop(0)  # Unsupported for these descriptors.
+      if done is None:
+        if buf is None:
+          buf = memoryview(bytearray(COPY_CHUNK))
+        if offset is None:
+          done = os.readv(in_fd, [buf[:size]])
+        else:
+          done = os.preadv(in_fd, [buf[:size]], offset)
+        _WriteFd(out_fd, [buf[:done]])
+      if not done:
+        break  # EOF
+      copied += done
+      if offset is not None:
+        offset += done
+  except (IOError, OSError) as e:
+    if e.errno == errno.EPIPE:
+      raise PipeClosed(str(e))
+    raise
+  return copied
+
+
+def WriteBytes(*buffers):
+  """Writes bytes-like objects to stdout.
+
+  Commands dumping large or binary output should use this rather than
+  print(). If stdout is a pipe, the buffers are handed to it directly,
+  otherwise they are written to the stdout file descriptor. Either way
+  they are not copied into Python strings.
+
+  Args:
+    buffers: bytes-like objects, eg bytes, bytearray or memoryview.
+  """
+  out = CurrentStdout()
+  if isinstance(out, Pipe):
+    out.WriteBytes(*buffers)
+    return
+  try:
+    fd = _Fileno(out)
+  except (AttributeError, ValueError, io.UnsupportedOperation):
+    # Not a real file, eg a StringIO.
+    for buf in buffers:
+      out.write(codecs.decode(buf, 'utf-8', 'replace'))
+    return
+  _WriteFd(fd, buffers)
+
+
+def SendFile(source, offset=None, count=None):
+  """Writes the contents of a file to stdout.
+
+  See WriteBytes(). The data is copied with sendfile() or splice() where
+  possible.
+
+  Args:
+    source: A file object or file descriptor to read from.
+    offset: An int, the offset to read from. If None, read from (and
+      advance) the current position.
+    count: An int, the number of bytes to write. If None, write to EOF.
+
+  Returns:
+    An int, the number of bytes written.
+  """
+  out = CurrentStdout()
+  if isinstance(out, Pipe):
+    return out.SendFile(source, offset=offset, count=count)
+  try:
+    fd = _Fileno(out)
+  except (AttributeError, ValueError, io.UnsupportedOperation):
+    return _SendFileAsBytes(source, offset, count, WriteBytes)
+  return _CopyFd(_Fileno(source), fd, offset, count)
+
+
+def _SendFileAsBytes(source, offset, count, write):
+  """Reads a file in chunks and passes them to write().
+
+  Used when the destination is not a file descriptor, eg it filters
+  the output.
+
+  Returns:
+    An int, the number of bytes written.
+  """
+  fd = _Fileno(source)
+  buf = memoryview(bytearray(COPY_CHUNK))
+  copied = 0
+  while count is None or copied < count:
+    size = COPY_CHUNK if count is None else min(COPY_CHUNK, count - copied)
+    if offset is None:
+      done = os.readv(fd, [buf[:size]])
+    else:
+      done = os.preadv(fd, [buf[:size]], offset + copied)
+    if not done:
+      break
+    write(buf[:done])
+    copied += done
+  return copied
+
+
+def TerminalLines():
+  """Returns the number of lines on the terminal."""
+  try:
+    return int(os.environ['LINES'])
+  except (KeyError, ValueError):
+    pass
+  try:
+    return os.get_terminal_size(sys.__stdout__.fileno()).lines
+  except (AttributeError, ValueError, OSError):
+    return DEFAULT_LINES
+
 
 def SplitByPipe(line):
   """Splits a line by the PIPE_CHAR.
@@ -58,6 +358,7 @@ class Pipe(object):
     self.cmd = cmd
     success = False
     if self.cmd.GetOption('start'):
+      self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
       success = self.Begin()
       self.SetStdout(self)
     if self.cmd.GetOption('stop'):
@@ -68,20 +369,57 @@ class Pipe(object):
   def SetStdout(self, fdesc):
     """Sets stdout to 'fdesc'."""
     # TODO(bbuxton): Better stdin/stdout support for pipe chaining.
-    self.old_stdout = sys.stdout
-    sys.stdout = fdesc
+    self.old_stdout = RedirectStdout(fdesc)
 
   def ResetStdout(self):
     """Sets stdout to 'fdesc'."""
-    sys.stdout = self.old_stdout
+    RedirectStdout(self.old_stdout)
 
   def write(self, string):
     """Overwrites sys.stdout.write."""
-    sys.__stdout__.write(string)
+    Terminal().write(string)
 
   def flush(self):
     """Overwrites sys.stdout.flush."""
-    sys.__stdout__.flush()
+    Terminal().flush()
+
+  def OutputFd(self):
+    """Returns the file descriptor that output is forwarded to.
+
+    Pipes that filter or transform output return None. They are then
+    passed bytes output as text, through write().
+
+    Returns:
+      An int, the file descriptor, or None.
+    """
+    terminal = Terminal()
+    terminal.flush()
+    try:
+      return terminal.fileno()
+    except (AttributeError, ValueError, io.UnsupportedOperation):
+      return None  # Not a real file, eg a job's output spool.
+
+  def WriteBytes(self, *buffers):
+    """Writes bytes-like objects through the pipe. See pipe.WriteBytes()."""
+    fd = self.OutputFd()
+    if fd is None:
+      for buf in buffers:
+        self.write(self._Decode(buf))
+    else:
+      _WriteFd(fd, buffers)
+
+  def SendFile(self, source, offset=None, count=None):
+    """Writes a file through the pipe. See pipe.SendFile()."""
+    fd = self.OutputFd()
+    if fd is None:
+      return _SendFileAsBytes(source, offset, count, self.WriteBytes)
+    return _CopyFd(_Fileno(source), fd, offset, count)
+
+  def _Decode(self, buf):
+    """Decodes bytes output to text, for pipes that filter text."""
+    if getattr(self, 'decoder', None) is None:
+      self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    return self.decoder.decode(buf)
 
   def Begin(self):
     """Called as the pipe is set up.
@@ -107,27 +445,33 @@ class GrepPipe(Pipe):
     self.regex = re.compile(self.cmd.GetOption('string'), re.I)
     self.linebuffer = []
 
+  def OutputFd(self):
+    return None
+
   def write(self, string):
     self.linebuffer.append(string)
     if '\n' in string:
-      if self.regex.search(''.join(self.linebuffer)):
-        super(GrepPipe, self).write(''.join(self.linebuffer))
-      self.linebuffer = []
+      lines = ''.join(self.linebuffer).split('\n')
+      self.linebuffer = [lines.pop()]
+      for line in lines:
+        if self.Keep(line):
+          super(GrepPipe, self).write(line + '\n')
+
+  def Keep(self, line):
+    """Returns whether to print the line."""
+    return self.regex.search(line)
 
   def End(self):
-    if '\n' in self.linebuffer:
-      super(GrepPipe, self).write(''.join(self.linebuffer))
+    line = ''.join(self.linebuffer)
+    if line and self.Keep(line):
+      super(GrepPipe, self).write(line)
 
 
 class ExceptPipe(GrepPipe):
   """An except pipe, prints lines that do not match."""
 
-  def write(self, string):
-    self.linebuffer.append(string)
-    if '\n' in string:
-      if not self.regex.search(''.join(self.linebuffer)):
-        sys.__stdout__.write(''.join(self.linebuffer))
-      self.linebuffer = []
+  def Keep(self, line):
+    return not self.regex.search(line)
 
 
 class CountPipe(Pipe):
@@ -139,6 +483,13 @@ class CountPipe(Pipe):
   def write(self, string):
     self.linecount += string.count('\n')
 
+  def WriteBytes(self, *buffers):
+    for buf in buffers:
+      self.linecount += bytes(buf).count(b'\n')
+
+  def SendFile(self, source, offset=None, count=None):
+    return _SendFileAsBytes(source, offset, count, self.WriteBytes)
+
   def End(self):
     super(CountPipe, self).write('Count: %d\n' % self.linecount)
 
@@ -148,13 +499,23 @@ class ShellPipe(Pipe):
 
   def Begin(self):
     # Get shell command, and open it, redirecting stdin
+    import subprocess
     cmd = self.cmd.GetOption('string')
     self.pipe = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
 
   def write(self, string):
     # Write to the pipe.
+    if not isinstance(string, bytes):
+      string = string.encode('utf-8')
     self.pipe.stdin.write(string)
 
+  def flush(self):
+    self.pipe.stdin.flush()
+
+  def OutputFd(self):
+    self.pipe.stdin.flush()
+    return self.pipe.stdin.fileno()
+
   def End(self):
     # Close stdin and wait for subprocess to end.
     self.pipe.stdin.close()
@@ -162,9 +523,180 @@ class ShellPipe(Pipe):
     del self.pipe
 
 
-class MorePipe(ShellPipe):
-  """Display output one page at a time."""
+class MorePipe(Pipe):
+  """Display output one page at a time.
+
+  The pager runs in-process. Lines are displayed as they are written,
+  and once a page is full write() blocks until the user asks for more.
+  A command therefore only produces as much output as is viewed. If
+  the user quits, PipeClosed is raised back into the producing command.
+
+  Keys at the '--More--' prompt:
+    <space>: Next page.
+    <return>: Next line.
+    /: Search forward for a regex.
+    n: Repeat the previous search.
+    q: Quit.
+
+  Attributes:
+    lines: An int, the page height. If None, the terminal height is used.
+  """
+  PROMPT = '--More--'
+
+  def __init__(self, lines=None):
+    self.lines = lines
+
+  def OutputFd(self):
+    return None
 
   def Begin(self):
-    # Just pipe through shell "more"
-    self.pipe = subprocess.Popen('more -', shell=True, stdin=subprocess.PIPE)
+    self.page = self.lines or TerminalLines()
+    self.linebuffer = []
+    self.shown = 0
+    self.search = None
+    self.skipping = False
+    self.closed = False
+    self.paging = self.IsInteractive()
+
+  def IsInteractive(self):
+    """Returns whether a user is available to page through output."""
+    return (termios is not None and sys.stdin.isatty() and
+            Terminal().isatty())
+
+  def write(self, string):
+    if self.closed:
+      raise PipeClosed('Pager closed')
+    self.linebuffer.append(string)
+    if '\n' not in string:
+      return
+    lines = ''.join(self.linebuffer).split('\n')
+    self.linebuffer = [lines.pop()]
+    for line in lines:
+      self._ShowLine(line + '\n')
+
+  def End(self):
+    if not self.closed and ''.join(self.linebuffer):
+      super(MorePipe, self).write(''.join(self.linebuffer))
+    self.linebuffer = []
+
+  def _ShowLine(self, line):
+    """Displays a line, waiting for the user when the page is full."""
+    if self.skipping:
+      if not self.search.search(line):
+        return
+      self.skipping = False
+    super(MorePipe, self).write(line)
+    self.shown += 1
+    if self.paging and self.shown >= self.page - 1:
+      self._Wait()
+
+  def _Wait(self):
+    """Prompts the user and acts on the key pressed.
+
+    Raises:
+      PipeClosed: The user quit the pager.
+    """
+    while True:
+      super(MorePipe, self).write(self.PROMPT)
+      super(MorePipe, self).flush()
+      key = self.ReadKey()
+      super(MorePipe, self).write('\r%s\r' % (' ' * len(self.PROMPT)))
+      if key in ('q', 'Q', '', '\x03', '\x04'):
+        self.closed = True
+        raise PipeClosed('Pager closed')
+      elif key in ('\r', '\n'):
+        self.shown -= 1
+        return
+      elif key == ' ':
+        self.shown = 0
+        return
+      elif key in ('/', 'n'):
+        if key == '/':
+          pattern = self.ReadLine('/')
+          try:
+            self.search = re.compile(pattern, re.I)
+          except re.error as e:
+            super(MorePipe, self).write('Bad pattern: %s\n' % e)
+            continue
+        if self.search is not None:
+          super(MorePipe, self).write('...skipping\n')
+          self.skipping = True
+          self.shown = 0
+          return
+
+  def ReadKey(self):
+    """Reads a single keypress from the terminal.
+
+    Returns:
+      A str, the key pressed. Empty on EOF.
+    """
+    fd = sys.stdin.fileno()
+    old = termios.tcgetattr(fd)
+    try:
+      tty.setraw(fd)
+      return os.read(fd, 1).decode('utf-8', 'replace')
+    finally:
+      termios.tcsetattr(fd, termios.TCSADRAIN, old)
+
+  def ReadLine(self, prompt):
+    """Reads a line of input, eg a search pattern."""
+    super(MorePipe, self).write(prompt)
+    super(MorePipe, self).flush()
+    return sys.stdin.readline().rstrip('\n')
+
+
+class SavePipe(Pipe):
+  """Save output to a file instead of displaying it."""
+  MODE = 'wb'
+
+  def Begin(self):
+    self.file = open(os.path.expanduser(self.cmd.GetOption('path')),
+                     self.MODE)
+
+  def write(self, string):
+    self.file.write(string.encode('utf-8'))
+
+  def flush(self):
+    self.file.flush()
+
+  def OutputFd(self):
+    self.file.flush()
+    return self.file.fileno()
+
+  def End(self):
+    self.file.close()
+    del self.file
+
+
+class TeePipe(SavePipe):
+  """Save output to a file, as well as displaying it."""
+  MODE = 'w+b'
+
+  def write(self, string):
+    super(TeePipe, self).write(string)
+    Pipe.write(self, string)
+
+  def flush(self):
+    super(TeePipe, self).flush()
+    Pipe.flush(self)
+
+  def WriteBytes(self, *buffers):
+    super(TeePipe, self).WriteBytes(*buffers)
+    fd = Pipe.OutputFd(self)
+    if fd is None:
+      for buf in buffers:
+        Pipe.write(self, self._Decode(buf))
+    else:
+      _WriteFd(fd, buffers)
+
+  def SendFile(self, source, offset=None, count=None):
+    # Copy into the file, then from there to stdout. This works
+    # even if the source can only be read once, eg is a pipe.
+    start = self.file.tell()
+    copied = super(TeePipe, self).SendFile(source, offset, count)
+    fd = Pipe.OutputFd(self)
+    if fd is None:
+      return _SendFileAsBytes(
+          self.file.fileno(), start, copied,
+          lambda buf: Pipe.write(self, self._Decode(buf)))
+    return _CopyFd(self.file.fileno(), fd, start, copied)
@@ -15,6 +15,7 @@
 # permissions and limitations under the License.
 
 import os
+import tempfile
 import unittest
 
 import pipe
@@ -168,6 +169,178 @@ class PipeTest(unittest.TestCase):
     self.assertTrue('One line' in open('/tmp/squires_test.log').read())
     os.remove('/tmp/squires_test.log')
 
+  def testMorePipe(self):
+
+    class ScriptedMorePipe(pipe.MorePipe):
+
+      def __init__(self, keys):
+        super(ScriptedMorePipe, self).__init__(lines=4)
+        self.keys = list(keys)
+
+      def IsInteractive(self):
+        return True
+
+      def ReadKey(self):
+        return self.keys.pop(0)
+
+      def ReadLine(self, prompt):
+        return self.keys.pop(0)
+
+    class DummyCommand(object):
+
+      def __init__(self, start):
+        self.start = start
+
+      def GetOption(self, name):
+        return {'start': self.start, 'stop': not self.start}[name]
+
+    op = pipe.Pipe.write
+    of = pipe.Pipe.flush
+    tp = TestPipe()
+    pipe.Pipe.write = tp.write
+    pipe.Pipe.flush = lambda self: None
+    try:
+      # A page is three lines then a prompt. Space shows the next page,
+      # 'q' stops the producer.
+      more = ScriptedMorePipe([' ', 'q'])
+      more.State(DummyCommand(True), None)
+      written = 0
+      try:
+        for i in range(1000):
+          print('line %d' % i)
+          written += 1
+      except pipe.PipeClosed:
+        pass
+      more.State(DummyCommand(False), None)
+      # The sixth line filled the second page, and quitting there
+      # interrupted the producer.
+      self.assertEqual(5, written)
+      self.assertTrue('line 5\n' in tp.string)
+      lines = [l.strip() for l in tp.string.split('\n')]
+      self.assertEqual(['line 0', 'line 1', 'line 2'], lines[:3])
+      self.assertEqual(2, tp.string.count(pipe.MorePipe.PROMPT))
+      self.assertFalse('line 6' in tp.string)
+
+      # Search skips forward to the matching line.
+      tp.string = ''
+      more = ScriptedMorePipe(['/', 'line 4[0-9]', 'q'])
+      more.State(DummyCommand(True), None)
+      try:
+        for i in range(1000):
+          print('line %d' % i)
+      except pipe.PipeClosed:
+        pass
+      more.State(DummyCommand(False), None)
+      self.assertTrue('...skipping' in tp.string)
+      self.assertFalse('line 3\n' in tp.string)
+      self.assertTrue('line 40\n' in tp.string)
+      self.assertFalse('line 43' in tp.string)
+
+      # Without a terminal, output passes straight through.
+      tp.string = ''
+      more = pipe.MorePipe(lines=4)
+      more.IsInteractive = lambda: False
+      more.State(DummyCommand(True), None)
+      for i in range(10):
+        print('line %d' % i)
+      sys.stdout.write('partial')
+      more.State(DummyCommand(False), None)
+      self.assertEqual(10, tp.string.count('\n'))
+      self.assertTrue(tp.string.endswith('partial'))
+    finally:
+      pipe.Pipe.write = op
+      pipe.Pipe.flush = of
+
+  def testBytes(self):
+
+    class DummyCommand(object):
+
+      def __init__(self, start, path):
+        self.options = {'start': start, 'stop': not start, 'path': path}
+
+      def GetOption(self, name):
+        return self.options[name]
+
+    tmpdir = tempfile.mkdtemp()
+    source = os.path.join(tmpdir, 'source')
+    data = b''.join(b'%06d\n' % i for i in range(300000))
+    with open(source, 'wb') as f:
+      f.write(data)
+
+    # Files, pipes and buffers are all saved intact.
+    saved = os.path.join(tmpdir, 'saved')
+    save = pipe.SavePipe()
+    save.State(DummyCommand(True, saved), None)
+    try:
+      with open(source, 'rb') as f:
+        self.assertEqual(len(data), pipe.SendFile(f))
+      with open(source, 'rb') as f:
+        self.assertEqual(7, pipe.SendFile(f, offset=7, count=7))
+      rfd, wfd = os.pipe()
+      os.write(wfd, b'from a pipe\n')
+      os.close(wfd)
+      self.assertEqual(12, pipe.SendFile(rfd))
+      os.close(rfd)
+      print('text')
+      pipe.WriteBytes(memoryview(b'one\n'), bytearray(b'two\n'))
+    finally:
+      save.State(DummyCommand(False, saved), None)
+    with open(saved, 'rb') as f:
+      self.assertEqual(
+          data + b'000001\nfrom a pipe\ntext\none\ntwo\n', f.read())
+
+    # Tee writes to the file and stdout.
+    rfd, wfd = os.pipe()
+    old_stdout = os.dup(sys.__stdout__.fileno())
+    os.dup2(wfd, sys.__stdout__.fileno())
+    teed = os.path.join(tmpdir, 'teed')
+    tee = pipe.TeePipe()
+    tee.State(DummyCommand(True, teed), None)
+    try:
+      with open(source, 'rb') as f:
+        pipe.SendFile(f, count=14)
+      pipe.WriteBytes(b'bytes\n')
+    finally:
+      tee.State(DummyCommand(False, teed), None)
+      os.dup2(old_stdout, sys.__stdout__.fileno())
+      os.close(old_stdout)
+      os.close(wfd)
+    with open(teed, 'rb') as f:
+      self.assertEqual(b'000000\n000001\nbytes\n', f.read())
+    self.assertEqual(b'000000\n000001\nbytes\n', os.read(rfd, 100))
+    os.close(rfd)
+
+    # Filtering pipes see bytes as text.
+    count = pipe.CountPipe()
+    count.State(DummyCommand(True, None), None)
+    with open(source, 'rb') as f:
+      pipe.SendFile(f)
+    pipe.WriteBytes(b'a\nb\n')
+    self.assertEqual(300002, count.linecount)
+    count.ResetStdout()
+
+    op = pipe.Pipe.write
+    tp = TestPipe()
+    pipe.Pipe.write = tp.write
+    try:
+      cmd = DummyCommand(True, None)
+      cmd.options['string'] = '^00001[0-2]'
+      grep = pipe.GrepPipe()
+      grep.State(cmd, None)
+      with open(source, 'rb') as f:
+        pipe.SendFile(f)
+      # A multi-byte character split across writes.
+      pipe.WriteBytes(b'000010 \xe2\x82')
+      pipe.WriteBytes(b'\xac\n')
+      grep.ResetStdout()
+    finally:
+      pipe.Pipe.write = op
+    self.assertEqual(u'000010\n000011\n000012\n000010 \u20ac\n', tp.string)
+
+    for name in os.listdir(tmpdir):
+      os.remove(os.path.join(tmpdir, name))
+    os.rmdir(tmpdir)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -32,4 +32,5 @@ setup(name='squires',
           'Operating System :: OS Independent',
           'Topic :: Software Development :: User Interfaces',
           'Topic :: Software Development :: Libraries'],
-      py_modules=['squires', 'option_lib', 'pipe'])
+      py_modules=['squires', 'option_lib', 'pipe', 'executor',
+                  'shell_completion'])
@@ -0,0 +1,387 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Shell completion of squires command trees, without starting Python.
+
+A program whose commands are run one-shot from the shell (eg
+'mycli show interface xe1') can export its tree once, and have bash or
+zsh complete it from then on:
+
+  shell_completion.Export(root, 'mycli', '/etc/mycli',
+                          callback='mycli --complete')
+
+This writes three files:
+
+  mycli.index: A static index of the tree. Each line is a tab separated
+    record, one of:
+      C <path> <name> <flags>: A subcommand of the command at path.
+      O <path> <name> <kind> <position> <group> <flags>: An option.
+      V <path> <option name> <value>: A static value of an option.
+    Paths are command names joined by spaces, '' being the root. Flags
+    is 'h' for hidden entries, which are parsed but not offered. The
+    option kind is one of KINDS, prefixed by 'k' for keyvalue options,
+    where it is the kind of the value following the key.
+  mycli.bash, mycli.zsh: Completion functions to source from the shell.
+
+The functions walk the index with awk. Path values are completed by the
+shell itself. Values that can only be found by running Python (options
+matching on a method) are fetched with the callback command, which is
+passed the words after the program name, and prints one completion per
+line. PrintCandidates() does the printing for a program's tree.
+
+The walk follows squires' own parsing only so far:
+  Commands match case insensitively, and by a unique prefix.
+  List and dict values match exactly, or by a unique prefix.
+  Option names, of flags and keyvalue options, must be given in full.
+  Free form values (of regex, typed, method and path options) are not
+    checked. So the first such option not yet given takes any word, even
+    one that squires would match to a later option.
+"""
+
+import os
+import re
+import shlex
+import sys
+
+import squires
+
+# Option kinds in the index, keyed by option_lib match type.
+KINDS = {
+    'boolean': 'f',  # A flag, the option name.
+    'list': 's',  # Static values, listed in 'V' records.
+    'dict': 's',
+    'method': 'd',  # Dynamic values, from the callback.
+    'domain': 'd',
+    'catalog': 'd',
+    'path': 'p',  # A path. 'P' if only directories.
+    'regex': 'r',  # Free form, never completed.
+    'typed': 'r',
+}
+
+INDEX_HEADER = '# squires completion index 1'
+
+# Finds completions in the index. Passed the words before the cursor
+# (newline separated) in SQUIRES_WORDS, and the word under the cursor in
+# SQUIRES_CUR. Prints completions, one per line. A line of a tab, then
+# 'files', 'dirs' or 'callback', asks the shell for those instead.
+_AWK = r'''
+BEGIN {
+  FS = "\t"
+  nw = split(ENVIRON["SQUIRES_WORDS"], w, "\n")
+  cur = ENVIRON["SQUIRES_CUR"]
+}
+/^#/ { next }
+$1 == "C" {
+  kids[$2] = kids[$2] "\n" $3
+  if ($4 != "h") shown[$2, $3] = 1
+  next
+}
+$1 == "O" {
+  n = ++nopts[$2]
+  oname[$2, n] = $3; okind[$2, n] = $4; opos[$2, n] = $5 + 0
+  ogroup[$2, n] = $6; ohidden[$2, n] = ($7 == "h")
+  next
+}
+$1 == "V" {
+  vals[$2, $3] = vals[$2, $3] "\n" $4
+}
+# Commands match case insensitively, as per Command._Matches().
+function child(path, word,    n, k, names, found, count) {
+  n = split(kids[path], names, "\n")
+  word = tolower(word)
+  count = 0
+  for (k = 2; k <= n; k++) {
+    if (names[k] == word) return word
+    if (index(names[k], word) == 1) { found = names[k]; count++ }
+  }
+  return count == 1 ? found : ""
+}
+# Values match exactly, or by a prefix of just one of them.
+function isvalue(list, word,    n, k, items, count) {
+  n = split(list, items, "\n")
+  count = 0
+  for (k = 2; k <= n; k++) {
+    if (items[k] == word) return 1
+    if (index(items[k], word) == 1) count++
+  }
+  return count == 1
+}
+function emit(item) {
+  if (index(item, cur) == 1) print item
+}
+function emitvalues(list,    n, k, items) {
+  n = split(list, items, "\n")
+  for (k = 2; k <= n; k++) emit(items[k])
+}
+function special(kind) {
+  if (kind == "p") print "\tfiles"
+  else if (kind == "P") print "\tdirs"
+  else if (kind == "d") print "\tcallback"
+}
+function available(j) {
+  return !used[j] && !(ogroup[path, j] != "" && (ogroup[path, j] in groups))
+}
+END {
+  path = ""
+  for (i = 1; i <= nw; i++) {
+    name = child(path, w[i])
+    if (name == "") break
+    path = path == "" ? name : path " " name
+  }
+  pos = 0
+  pending = 0
+  for (; i <= nw; i++) {
+    if (pending) {
+      pending = 0
+    } else {
+      for (j = 1; j <= nopts[path]; j++) {
+        kind = okind[path, j]
+        if (!available(j)) continue
+        if (opos[path, j] >= 0 && opos[path, j] != pos) continue
+        if (kind == "f" || kind ~ /^k/) {
+          if (w[i] != oname[path, j]) continue
+        } else if (kind == "s") {
+          if (!isvalue(vals[path, oname[path, j]], w[i])) continue
+        }
+        used[j] = 1
+        if (ogroup[path, j] != "") groups[ogroup[path, j]] = 1
+        if (kind ~ /^k/) pending = j
+        break
+      }
+    }
+    pos++
+  }
+  if (pending) {
+    kind = substr(okind[path, pending], 2)
+    if (kind == "s") emitvalues(vals[path, oname[path, pending]])
+    else special(kind)
+    exit
+  }
+  if (pos == 0) {
+    n = split(kids[path], names, "\n")
+    for (k = 2; k <= n; k++) {
+      if ((path, names[k]) in shown && index(names[k], tolower(cur)) == 1)
+        print names[k]
+    }
+  }
+  positional = 0
+  for (j = 1; j <= nopts[path]; j++) if (opos[path, j] == pos) positional = 1
+  for (j = 1; j <= nopts[path]; j++) {
+    if (!available(j) || ohidden[path, j]) continue
+    if (positional ? opos[path, j] != pos : opos[path, j] >= 0) continue
+    kind = okind[path, j]
+    if (kind == "f" || kind ~ /^k/) emit(oname[path, j])
+    else if (kind == "s") emitvalues(vals[path, oname[path, j]])
+    else special(kind)
+  }
+}
+'''
+
+_BASH = r'''# bash completion for %(prog)s, generated by squires.
+%(name)s_index=%(index)s
+%(name)s_callback=%(callback)s
+%(name)s_awk=%(awk)s
+
+%(name)s() {
+  local line=${COMP_LINE:0:COMP_POINT} cur= item
+  local -a args
+  read -ra args <<< "$line"
+  if [[ $line != *[[:space:]] ]]; then
+    cur=${args[${#args[@]}-1]}
+    unset 'args[${#args[@]}-1]'
+  fi
+  args=("${args[@]:1}")
+  COMPREPLY=()
+  local IFS=$'\n'
+  while read -r item; do
+    case $item in
+      $'\tfiles') COMPREPLY+=($(compgen -f -- "$cur")) ;;
+      $'\tdirs') COMPREPLY+=($(compgen -d -- "$cur")) ;;
+      $'\tcallback')
+        [[ -n $%(name)s_callback ]] &&
+          COMPREPLY+=($(eval "$%(name)s_callback"' "${args[@]}" "$cur"')) ;;
+      *) COMPREPLY+=("$item") ;;
+    esac
+  done < <(SQUIRES_WORDS="${args[*]}" SQUIRES_CUR="$cur" \
+           awk "$%(name)s_awk" "$%(name)s_index" 2>/dev/null)
+  # bash replaces only the part of cur after any COMP_WORDBREAKS.
+  local prefix=${cur%%"${COMP_WORDS[COMP_CWORD]}"}
+  [[ -n $prefix ]] && COMPREPLY=("${COMPREPLY[@]#"$prefix"}")
+  return 0
+}
+complete -F %(name)s %(prog)s
+'''
+
+_ZSH = r'''# zsh completion for %(prog)s, generated by squires.
+%(name)s_index=%(index)s
+%(name)s_callback=%(callback)s
+%(name)s_awk=%(awk)s
+
+%(name)s() {
+  local cur=${words[CURRENT]} item
+  local -a args reply
+  args=("${(@)words[2,CURRENT-1]}")
+  for item in "${(@f)$(SQUIRES_WORDS=${(pj:\n:)args} SQUIRES_CUR=$cur \
+      awk "$%(name)s_awk" "$%(name)s_index" 2>/dev/null)}"; do
+    case $item in
+      $'\tfiles') _files ;;
+      $'\tdirs') _files -/ ;;
+      $'\tcallback')
+        [[ -n $%(name)s_callback ]] &&
+          reply+=("${(@f)$(eval \
+              "$%(name)s_callback"' "${args[@]}" "$cur"')}") ;;
+      ?*) reply+=("$item") ;;
+    esac
+  done
+  (( ${#reply} )) && compadd -- "${reply[@]}"
+}
+compdef %(name)s %(prog)s
+'''
+
+
+def WriteIndex(command, out):
+  """Writes the static completion index of a command tree.
+
+  Lazy commands are loaded, so the index covers the whole tree.
+
+  Args:
+    command: A Command, the root of the tree.
+    out: A file object to write to.
+  """
+  out.write(INDEX_HEADER + '\n')
+  for record in _IndexRecords(command, ''):
+    if not any('\t' in field or '\n' in field for field in record):
+      out.write('\t'.join(record) + '\n')
+
+
+def _IndexRecords(command, path):
+  """Yields the index records for a command and its subcommands.
+
+  Args:
+    command: A Command.
+    path: A str, the command names leading to command, space separated.
+
+  Yields:
+    Tuples of str, the fields of each record.
+  """
+  command.Load()
+  for option in command.options.GetAllOptions():
+    if option.arg_key is not None:
+      continue  # Indexed with its key.
+    value_option = option.arg_val or option
+    kind = KINDS.get(value_option.matcher.MATCH, 'r')
+    if kind == 'p' and value_option.only_dir_paths:
+      kind = 'P'
+    if option.keyvalue:
+      kind = 'k' + kind
+    yield ('O', path, option.name, kind, str(option.position),
+           option.group or '', 'h' if option.hidden else '')
+    if kind.endswith('s'):
+      matcher = value_option.matcher
+      for value in matcher.match:
+        if not matcher._GetRegex(value):
+          yield ('V', path, option.name, value)
+  for name in sorted(command):
+    subcommand = command[name]
+    yield ('C', path, name, 'h' if subcommand.hidden else '')
+    for record in _IndexRecords(subcommand, (path + ' ' + name).lstrip()):
+      yield record
+
+
+def _Script(template, prog, index_path, callback):
+  """Fills in a completion script template."""
+  return template % {
+      'prog': prog,
+      'name': '_%s_squires' % re.sub(r'\W', '_', prog),
+      'index': shlex.quote(index_path),
+      'callback': shlex.quote(callback or ''),
+      'awk': shlex.quote(_AWK),
+  }
+
+
+def BashScript(prog, index_path, callback=None):
+  """Returns a bash completion script.
+
+  Args:
+    prog: A str, the program to complete.
+    index_path: A str, the path of the index written by WriteIndex().
+    callback: A str, the shell command printing dynamic completions, or
+      None to not complete them.
+
+  Returns:
+    A str, the script to source.
+  """
+  return _Script(_BASH, prog, index_path, callback)
+
+
+def ZshScript(prog, index_path, callback=None):
+  """Returns a zsh completion script. Args are as for BashScript()."""
+  return _Script(_ZSH, prog, index_path, callback)
+
+
+def Export(command, prog, directory, callback=None, index_path=None):
+  """Writes the completion index and scripts for a command tree.
+
+  Args:
+    command: A Command, the root of the tree.
+    prog: A str, the program to complete.
+    directory: A str, the directory to write to.
+    callback: A str, the shell command printing dynamic completions, or
+      None to not complete them.
+    index_path: A str, where the scripts find the index once installed.
+      Defaults to where it is written.
+
+  Returns:
+    A dict of the paths written, keyed by 'index', 'bash' and 'zsh'.
+  """
+  paths = {}
+  for kind, suffix in (('index', '.index'), ('bash', '.bash'),
+                       ('zsh', '.zsh')):
+    paths[kind] = os.path.join(directory, prog + suffix)
+  index_path = index_path or os.path.abspath(paths['index'])
+  with open(paths['index'], 'w') as out:
+    WriteIndex(command, out)
+  with open(paths['bash'], 'w') as out:
+    out.write(BashScript(prog, index_path, callback))
+  with open(paths['zsh'], 'w') as out:
+    out.write(ZshScript(prog, index_path, callback))
+  return paths
+
+
+def PrintCandidates(command, words, out=None):
+  """Prints completions for a shell callback, one per line.
+
+  Placeholders such as '<string>' and '<cr>' are left out, as the shell
+  would insert them.
+
+  Args:
+    command: A Command, the root of the tree.
+    words: A list of str, the words after the program name. The last is
+      the word being completed.
+    out: A file object to write to. Defaults to sys.stdout.
+  """
+  out = out or sys.stdout
+  result = command.Complete(' '.join(_Quote(word) for word in words))
+  for candidate in squires._SortedCandidates(result.candidates):
+    if not candidate.startswith('<') and candidate != squires.PIPE_CHAR:
+      out.write(candidate + '\n')
+
+
+def _Quote(word):
+  """Quotes a shell word for a squires command line, if it needs it."""
+  if not word or not re.search(r'[\s"\'\\|]', word):
+    return word
+  return '"%s"' % re.sub(r'(["\\])', r'\\\1', word)
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import shell_completion
+import squires
+
+# Runs the generated bash function on each line given as an argument.
+BASH_DRIVER = r'''
+source "$1"
+shift
+for line in "$@"; do
+  COMP_LINE=$line
+  COMP_POINT=${#line}
+  read -ra COMP_WORDS <<< "$line"
+  [[ $line == *' ' ]] && COMP_WORDS+=('')
+  COMP_CWORD=$((${#COMP_WORDS[@]} - 1))
+  _mycli_squires
+  IFS=, eval 'echo "${COMPREPLY[*]}"'
+done
+'''
+
+# As above, for the generated zsh function. The completion system is not
+# loaded, so compadd and compdef print or do nothing instead.
+ZSH_DRIVER = r'''
+compdef() { }
+_files() { }
+compadd() { shift; print -r -- ${(j:,:)@} }
+source "$1"
+shift
+for line in "$@"; do
+  words=(${(z)line})
+  [[ $line == *' ' ]] && words+=('')
+  CURRENT=${#words}
+  _mycli_squires || print
+done
+'''
+
+# Lines to complete, and the completions expected, for both shells.
+LINES = {
+    'mycli ': 'show',
+    'mycli s i ': 'xe1,xe10',
+    'mycli S I ': 'xe1,xe10',
+    'mycli show interface xe': 'xe1,xe10',
+    'mycli show interface xe1 ': 'terse,detail,colour,peer',
+    'mycli show interface xe1 terse ': 'colour,peer',
+    'mycli show interface xe1 colour ': 'red,blue',
+    'mycli show interface xe1 colour r': 'red',
+    'mycli show interface xe1 colour r ': 'terse,detail,peer',
+    'mycli show interface xe1 peer ': 'alpha',
+    'mycli debug ': '',
+}
+
+
+class ShellCompletionTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = squires.Command('<root>')
+    show = self.root.AddCommand('show', help='Show', method=squires)
+    interface = show.AddSubCommand('interface', help='Intf', method=squires)
+    interface.AddOption('name', position=0,
+                        match={'xe1': 'one', 'xe10': 'ten'})
+    interface.AddOption('terse', group='format')
+    interface.AddOption('detail', group='format')
+    interface.AddOption('colour', keyvalue=True, match=['red', 'blue'])
+    interface.AddOption('peer', keyvalue=True, match=lambda o: ['alpha'])
+    interface.AddOption('secret', hidden=True)
+    show.AddSubCommand('version', help='Version', method=squires)
+    self.root.AddCommand('debug', help='Debug', method=squires, hidden=True)
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testWriteIndex(self):
+    out = io.StringIO()
+    shell_completion.WriteIndex(self.root, out)
+    self.assertEqual([
+        shell_completion.INDEX_HEADER,
+        'C\t\tdebug\th',
+        'C\t\tshow\t',
+        'C\tshow\tinterface\t',
+        'O\tshow interface\tterse\tf\t-1\tformat\t',
+        'O\tshow interface\tdetail\tf\t-1\tformat\t',
+        'O\tshow interface\tcolour\tks\t-1\t\t',
+        'V\tshow interface\tcolour\tred',
+        'V\tshow interface\tcolour\tblue',
+        'O\tshow interface\tpeer\tkd\t-1\t\t',
+        'O\tshow interface\tsecret\tf\t-1\t\th',
+        'O\tshow interface\tname\ts\t0\t\t',
+        'V\tshow interface\tname\txe1',
+        'V\tshow interface\tname\txe10',
+        'C\tshow\tversion\t'], out.getvalue().splitlines())
+
+  @unittest.skipUnless(shutil.which('bash') and shutil.which('awk'),
+                       'Needs bash and awk')
+  def testBash(self):
+    paths = shell_completion.Export(self.root, 'mycli', self.tmpdir,
+                                    callback='sh -c "echo alpha"')
+    self.assertEqual(['index', 'bash', 'zsh'], list(paths))
+    for path in paths.values():
+      self.assertTrue(os.path.exists(path))
+    output = subprocess.check_output(
+        ['bash', '-c', BASH_DRIVER, 'bash', paths['bash']] + list(LINES),
+        universal_newlines=True)
+    self.assertEqual(list(LINES.values()), output.splitlines())
+
+  @unittest.skipUnless(shutil.which('zsh') and shutil.which('awk'),
+                       'Needs zsh and awk')
+  def testZsh(self):
+    paths = shell_completion.Export(self.root, 'mycli', self.tmpdir,
+                                    callback='sh -c "echo alpha"')
+    output = subprocess.check_output(
+        ['zsh', '-f', '-c', ZSH_DRIVER, 'zsh', paths['zsh']] + list(LINES),
+        universal_newlines=True)
+    self.assertEqual(list(LINES.values()), output.splitlines())
+
+  def testPrintCandidates(self):
+    out = io.StringIO()
+    shell_completion.PrintCandidates(
+        self.root, ['show', 'interface', 'xe1', ''], out)
+    self.assertEqual('colour\ndetail\npeer\nterse\n', out.getvalue())
+    out = io.StringIO()
+    shell_completion.PrintCandidates(
+        self.root, ['show', 'interface', 'xe1', 'peer', ''], out)
+    self.assertEqual('alpha\n', out.getvalue())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -42,26 +42,94 @@ from __future__ import print_function
 
 __version__ = '0.9.9'
 
-import inspect
+import bisect
+import copy
+import gc
+import heapq
+import importlib
+import io
+import itertools
 import os
+import pickle
 import re
-import shlex
-import signal
-import subprocess
 import sys
+import threading
 import time
-import traceback
+import types
 
+import executor
 import option_lib
 import pipe
-import readline
+
+
+class _LazyModule(types.ModuleType):
+  """A module that is only imported once an attribute is looked up.
+
+  Attributes set on this stand-in (eg by tests) take precedence over the
+  module's own.
+  """
+
+  def __getattr__(self, name):
+    return getattr(importlib.import_module(self.__name__), name)
+
+
+# Imported by the interactive prompt, not by scripts that only Execute().
+readline = _LazyModule('readline')
+
 COMPLETE_SUFFIX = ''
 
 SHOW_HIDDEN = False  # Force display of hidden commands and options.
 
+# Completions listed per page, None to list them all at once.
+MAX_COMPLETIONS = 100
+
+# If True, and no subcommand starts with the token being completed, the
+# subcommands closest to it are completed instead. See option_lib.FuzzyIndex.
+# Commands still only run if their names are typed by a unique prefix.
+FUZZY_COMMANDS = False
+
 # Character used as a pipe to split command line
 PIPE_CHAR = pipe.PIPE_CHAR
 
+# Names a method by 'pkg.mod:func', eg for an OptionDefinition's match.
+Reference = option_lib.Reference
+
+# A named set of values shared by options, eg Domain('interfaces').
+Domain = option_lib.Domain
+
+# A memory mapped file of values for options, written by BuildCatalog().
+Catalog = option_lib.Catalog
+BuildCatalog = option_lib.BuildCatalog
+
+# The value of an option with expand set, eg for 'ge-1/0/[0-47]'.
+Expansion = option_lib.Expansion
+
+# Types of option values, eg AddOption('vlan', match=Integer(1, 4094)).
+Integer = option_lib.Integer
+Float = option_lib.Float
+Duration = option_lib.Duration
+Size = option_lib.Size
+Address = option_lib.Address
+Network = option_lib.Network
+
+# Held while a lazy command's loader runs. See Command.Load().
+_LOAD_LOCK = threading.RLock()
+
+# Its 'loading' attribute is True while this thread runs a lazy command's
+# loader. See Command.Load().
+_local = threading.local()
+
+# Changes when options start or stop being inherited, or commands are
+# attached, so that the inherited options and completion tables worked out
+# before then are worked out again. See Options.GetAllOptions().
+_inherited_version = 0
+
+# Trailing token that runs a command as a background job.
+BACKGROUND_CHAR = '&'
+
+# First line of a tree snapshot file, followed by the snapshot key.
+SNAPSHOT_MAGIC = b'squires-snapshot 1'
+
 
 class Error(Exception):
   pass
@@ -80,6 +148,209 @@ class NoMatchError(Error):
   """Subcommand did not match."""
 
 
+# A token: a run of unquoted characters, escaped characters and quoted
+# strings. A quote or escape left open at the end of the line ends the
+# token, and is noted in the squote/dquote/escape group.
+_TOKEN_RE = re.compile(r"""
+    (?P<word>(?:[^\s|'"\\]+|\\.|'[^']*'|"(?:[^"\\]|\\.)*"|
+              (?P<squote>'[^']*\Z)|(?P<dquote>"(?:[^"\\]|\\.)*\\?\Z)|
+              (?P<escape>\\\Z))+)
+    |(?P<pipe>\|)
+    """, re.VERBOSE | re.DOTALL)
+
+# The parts of a token that has quotes or escapes.
+_PIECE_RE = re.compile(r"""
+    \\(?P<escaped>.)|'(?P<single>[^']*)'?|"(?P<double>(?:[^"\\]|\\.)*)"?|
+    (?P<plain>[^\\'"]+)
+    """, re.VERBOSE | re.DOTALL)
+
+# Escapes that are honoured within double quotes.
+_DOUBLE_ESCAPE_RE = re.compile(r'\\(["\\])')
+
+
+class CommandLine(list):
+  """A command line split into tokens, see SplitCommandLine().
+
+  Attributes:
+    line: A str, the command line as typed.
+    offsets: A list of (start, end) int tuples, the span of each token in
+      line, including any quotes.
+    quote: A str, the quote character left unterminated at the end of the
+      line, else ''.
+    escape: A boolean, True if the line ends with an unescaped backslash.
+    trailing_space: A boolean, True if there is whitespace after the last
+      token, ie a new token has been started.
+  """
+
+  def __init__(self, line, tokens, offsets, quote='', escape=False):
+    super(CommandLine, self).__init__(tokens)
+    self.line = line
+    self.offsets = offsets
+    self.quote = quote
+    self.escape = escape
+    end = offsets[-1][1] if offsets else 0
+    self.trailing_space = len(line) > end
+
+  @property
+  def complete(self):
+    """A boolean, False if a quote or escape is unterminated."""
+    return not (self.quote or self.escape)
+
+
+def SplitCommandLine(line):
+  """Splits a command line into tokens, in a single pass.
+
+  The quoting and escaping rules are those of a POSIX shell (and of
+  shlex in posix mode). The pipe character (|) is always a token of its
+  own, unless quoted or escaped. An unterminated quote or escape is not
+  an error, it is taken to close at the end of the line and noted in the
+  result, as is needed when completing a partial line.
+
+  Args:
+    line: A str, the command line.
+
+  Returns:
+    A CommandLine.
+  """
+  tokens = []
+  offsets = []
+  quote = ''
+  escape = False
+  for match in _TOKEN_RE.finditer(line):
+    word = match.group('word')
+    if word is None:
+      tokens.append(PIPE_CHAR)
+    else:
+      if '\\' in word or '"' in word or "'" in word:
+        word = _Unquote(word)
+        if match.group('squote') is not None:
+          quote = "'"
+        elif match.group('dquote') is not None:
+          quote = '"'
+        elif match.group('escape') is not None:
+          escape = True
+      tokens.append(word)
+    offsets.append(match.span())
+  return CommandLine(line, tokens, offsets, quote, escape)
+
+
+def _Unquote(word):
+  """Removes the quotes and escapes from a token."""
+  parts = []
+  for match in _PIECE_RE.finditer(word):
+    kind = match.lastgroup
+    if kind == 'double':
+      parts.append(_DOUBLE_ESCAPE_RE.sub(r'\1', match.group(kind)))
+    elif kind is not None:
+      parts.append(match.group(kind))
+  return ''.join(parts)
+
+
+class CompletionResult(object):
+  """Completions found for a command line.
+
+  Attributes:
+    line: A str, the command line up to the cursor.
+    word: A str, the text before the cursor that a completion replaces,
+      being the last token as typed, with any quotes.
+    candidates: A dict. Keys are valid next tokens, values are help text.
+  """
+
+  def __init__(self, line, candidates, tokens=None):
+    """Initialise object.
+
+    Args:
+      line: A str, as per the attribute.
+      candidates: A dict, as per the attribute.
+      tokens: A CommandLine, line split into tokens. If None, it is split
+        here.
+    """
+    if tokens is None:
+      tokens = SplitCommandLine(line)
+    self.line = line
+    self.word = ''
+    if tokens and not tokens.trailing_space:
+      self.word = line[tokens.offsets[-1][0]:]
+    self.candidates = candidates
+
+  @property
+  def matches(self):
+    """A list of str, the candidates as offered to readline.
+
+    These are the first MAX_COMPLETIONS candidates in sorted order, then
+    the last one, so that the prefix common to all candidates is kept.
+    """
+    keys = _FirstCandidates(self.candidates, MAX_COMPLETIONS)
+    if len(keys) < len(self.candidates):
+      keys.append(max(self.candidates))
+    matches = [cand + COMPLETE_SUFFIX for cand in keys]
+    if any(cand.startswith('<') for cand in self.candidates):
+      # Make an additional dummy candidate to force
+      # display of these instead of auto-completing.
+      matches.append('%@%@%@')
+    return matches
+
+
+class CompletionDriver(object):
+  """Edits a command line with simulated tab and '?' presses.
+
+  Keys behave as with the readline bindings of Command.Loop, without a
+  terminal. Tab inserts the longest unambiguous completion, or lists the
+  candidates when pressed again with nothing to insert. '?' lists them.
+
+  Attributes:
+    command: The Command that completion starts from.
+    buffer: A str, the command line.
+    cursor: An int, the cursor position in buffer.
+  """
+
+  def __init__(self, command, buffer=''):
+    self.command = command
+    self.buffer = buffer
+    self.cursor = len(buffer)
+    self._tabbed = False
+
+  def Type(self, text):
+    """Inserts text at the cursor."""
+    self.buffer = self.buffer[:self.cursor] + text + self.buffer[self.cursor:]
+    self.cursor += len(text)
+    self._tabbed = False
+
+  def Tab(self):
+    """Presses tab.
+
+    Returns:
+      A str, the completions listed, as per Command.FormatCompletions(), or
+      None if nothing was listed.
+    """
+    result = self.command.Complete(self.buffer, self.cursor)
+    matches = result.matches
+    if len(matches) == 1:
+      insert = matches[0] + ' '
+    else:
+      insert = os.path.commonprefix(matches)
+    if insert and insert != result.word:
+      start = self.cursor - len(result.word)
+      self.buffer = self.buffer[:start] + insert + self.buffer[self.cursor:]
+      self.cursor = start + len(insert)
+      self._tabbed = False
+      return None
+    if not result.candidates or self._tabbed:
+      return self.command.FormatCompletions(result)
+    self._tabbed = True
+    return None
+
+  def Help(self):
+    """Presses '?'.
+
+    Returns:
+      A str, the completions listed, as per Command.FormatCompletions().
+    """
+    self._tabbed = False
+    return self.command.FormatCompletions(
+        self.command.Complete(self.buffer, self.cursor))
+
+
 class Command(dict):
   """An element on the command tree.
 
@@ -101,14 +372,49 @@ class Command(dict):
       level command.
     histfile: A str, the filename to read/write history from.
     method: A method, called from within Run(), unless Run() is overridden.
+      A 'pkg.mod:func' string is kept as an option_lib.Reference(), so the
+      module is imported on the first run rather than now.
     execute_command_string: A string, to display as '<cr>' help, if runnable.
     orig_ancestors: A list of strings, ancestors of this command.
     pipetree: A Command(), root of tree after a pipe. If none, there is
       no piping.
     meta: Any object type. Meta information that can be stored by the calling
       program for reference later.
+    timeout: A float, seconds after which the command is cancelled. If
+      None, the parent's timeout applies, so setting it on the root sets
+      a global timeout.
+    executor: A str, how to run the method, one of executor.EXECUTORS. If
+      None, the parent's executor applies, else 'inline'. 'process'
+      commands run in the root's pool of worker processes.
+    cpu_limit: A float, CPU seconds the method may use. If None, the
+      parent's limit applies. Only enforced for 'process' commands.
+    memory_limit: An int, bytes of address space the worker process may
+      grow to while running the method. If None, the parent's limit
+      applies. Only enforced for 'process' commands.
+    token: An executor.CancelToken, for the current (or last) run of the
+      command. The method may check it to stop early when cancelled.
+    loader: A callable, or None. If set, it is called with this command
+      the first time the command is entered, to add its subcommands and
+      options. It may instead return a tree, as for ParseTree(), to be
+      added below the command. See Load().
+    jobs: An executor.JobTable, the background jobs. Only valid for the top
+      level command, and created on first use.
+    pool: An executor.Pool, the worker processes for 'process' commands.
+      Only valid for the top level command. Created by StartPool(), or on
+      first use. Its workers are retired if the tree changes.
   """
 
+  # Trees hold many commands, so the attributes every command has are
+  # kept in slots. The instance dict, for any others, is only created when
+  # one is set.
+  __slots__ = ('name', 'help', 'root', 'parent', 'ancestors', 'options',
+               'command_line', 'hidden', 'prompt', 'method', 'pipetree',
+               'meta', 'histfile', 'timeout', 'executor', 'cpu_limit',
+               'memory_limit', 'token', 'loader', 'jobs', 'pool', 'runnable',
+               'execute_command_string', 'orig_ancestors', '_completion_cache',
+               '_completion_result', '_completion_page', '_completion_state',
+               '_completion_table', '__dict__')
+
   def __init__(self, name='', help=None, runnable=None, method=None):
     super(Command, self).__init__(self)
     self.name = name
@@ -121,11 +427,25 @@ class Command(dict):
     self.command_line = []
     self.hidden = False
     self.prompt = '> '
+    if isinstance(method, str):
+      method = option_lib.Reference(method)
     self.method = method
     self.pipetree = None
     self.meta = None
     self.histfile = None
+    self.timeout = None
+    self.executor = None
+    self.cpu_limit = None
+    self.memory_limit = None
+    self.token = None
+    self.loader = None
+    self.jobs = None
+    self.pool = None
     self._completion_cache = (None, None)
+    self._completion_result = None
+    self._completion_page = (None, 0)
+    self._completion_state = None
+    self._completion_table = None
 
     if runnable is None:
       # Set to 'True' if a method is supplied.
@@ -135,13 +455,37 @@ class Command(dict):
         runnable = False
     self.runnable = runnable
 
-    # Help string is method docstring by default.
-    if self.method is not None and help is None:
+    # Help string is method docstring by default. A Reference is not
+    # imported for it.
+    if (self.method is not None and help is None and
+        not isinstance(method, option_lib.Reference)):
       if hasattr(method, '__doc__'):
         self.help = method.__doc__
     self.execute_command_string = 'Execute this command'
     self.orig_ancestors = []
 
+  # Changes to the subcommands drop the table their completions are looked
+  # up in, so it is rebuilt when next used.
+  def __setitem__(self, name, subcommand):
+    dict.__setitem__(self, name, subcommand)
+    self._completion_table = None
+
+  def __delitem__(self, name):
+    dict.__delitem__(self, name)
+    self._completion_table = None
+
+  def pop(self, *args):
+    self._completion_table = None
+    return dict.pop(self, *args)
+
+  def update(self, *args, **kwargs):
+    dict.update(self, *args, **kwargs)
+    self._completion_table = None
+
+  def clear(self):
+    dict.clear(self)
+    self._completion_table = None
+
   def __str__(self):
     attribs = ["'%s'" % self.name]
     if self.help:
@@ -167,7 +511,8 @@ class Command(dict):
     print('(Squires warning) PrepareReadline() is deprecated and now a NoOp.')
 
   def AddCommand(self, name, help=None, runnable=None, method=None, pipe=None,
-                 meta=None, hidden=False):
+                 meta=None, hidden=False, timeout=None, executor=None,
+                 cpu_limit=None, memory_limit=None, loader=None):
     """Convenience function to add a command to the tree.
 
     Returns the new Command() object, already added to the tree. Options
@@ -180,23 +525,44 @@ class Command(dict):
       runnable: A boolean, as per the Command() 'runnable' attribute.
       method: A function which will be the new object's 'Run' method. This
         method will be passed two arguments - the Command object ("self"), and
-        the entire command line as a list of strings.
+        the entire command line as a list of strings. Or a 'pkg.mod:func'
+        string naming the function, imported when the command is first run.
       pipe: A Command object, the pipe command tree. Currently unused.
       meta: Any object. Meta information supplied by the squires user to
         be used by it arbitrarily.
       hidden: A boolean. If True, command does not show up in help or
         tab completion.
+      timeout: A float, as per the Command() 'timeout' attribute.
+      executor: A str, as per the Command() 'executor' attribute.
+      cpu_limit: A float, as per the Command() 'cpu_limit' attribute.
+      memory_limit: An int, as per the Command() 'memory_limit' attribute.
+      loader: A callable, as per the Command() 'loader' attribute.
 
     Returns:
       A Command() object.
     """
     name = name.split()
-    command = Command(name=name[-1], help=help, runnable=runnable,
-                      method=method)
+    command = self._NewCommand(
+        name[-1], help=help, runnable=runnable, method=method, meta=meta,
+        hidden=hidden, timeout=timeout, executor=executor,
+        cpu_limit=cpu_limit, memory_limit=memory_limit, loader=loader)
     command.ancestors = name[:-1]
+    self.root.Attach(command)
+    return command
+
+  @staticmethod
+  def _NewCommand(name, help=None, runnable=None, method=None, pipe=None,
+                  meta=None, hidden=False, timeout=None, executor=None,
+                  cpu_limit=None, memory_limit=None, loader=None):
+    """Returns a detached Command(), with AddCommand() args."""
+    command = Command(name=name, help=help, runnable=runnable, method=method)
     command.meta = meta
     command.hidden = hidden
-    self.root.Attach(command)
+    command.timeout = timeout
+    command.executor = executor
+    command.cpu_limit = cpu_limit
+    command.memory_limit = memory_limit
+    command.loader = loader
     return command
 
   def AddSubCommand(self, name, **kwargs):
@@ -233,6 +599,104 @@ class Command(dict):
       return self.parent.GetPipeTree()
     return None
 
+  def GetTimeout(self):
+    """Get the command timeout, climbing the command tree.
+
+    Returns:
+      A float, the timeout in seconds. None if there is not any.
+    """
+    if self.timeout is not None:
+      return self.timeout
+    if self.parent is not None:
+      return self.parent.GetTimeout()
+    return None
+
+  def GetExecutor(self):
+    """Get the executor to run the command in, climbing the command tree.
+
+    Returns:
+      A str, one of executor.EXECUTORS.
+    """
+    if self.executor is not None:
+      return self.executor
+    if self.parent is not None:
+      return self.parent.GetExecutor()
+    return 'inline'
+
+  def GetLimits(self):
+    """Get the resource limits for the command, climbing the command tree.
+
+    Returns:
+      A dict, as per executor.Pool.Run(). Has 'cpu' and 'memory' keys, each
+      None if there is no limit.
+    """
+    limits = {'cpu': self.cpu_limit, 'memory': self.memory_limit}
+    if self.parent is not None:
+      for key, value in self.parent.GetLimits().items():
+        if limits[key] is None:
+          limits[key] = value
+    return limits
+
+  def StartPool(self, size=None):
+    """Starts the worker processes for 'process' commands.
+
+    Call this once the tree is built (ie after ParseTree()), so the
+    workers inherit it. Otherwise the pool is started on first use.
+    Changing the tree afterwards retires the workers, once any commands
+    they are running finish, and new ones are forked with the new tree
+    as needed.
+
+    Args:
+      size: An int, the number of workers. If None, executor.POOL_SIZE.
+
+    Returns:
+      An executor.Pool.
+    """
+    root = self.root
+    if root.pool is not None and size and root.pool.size != size:
+      root.ClosePool()
+    if root.pool is None:
+      root.pool = executor.Pool(root._RunInWorker, size)
+    root.pool.Start()
+    return root.pool
+
+  def ClosePool(self):
+    """Stops the worker processes, if started."""
+    root = self.root
+    if root.pool is not None:
+      root.pool.Close()
+      root.pool = None
+
+  def _TreeChanged(self):
+    """Retires the pool's workers, as they hold the old tree.
+
+    Busy workers finish their runs first. Not while a lazy command is
+    loaded, as workers load their own copy.
+    """
+    if self.root.pool is not None and not getattr(_local, 'loading', False):
+      self.root.pool.Retire()
+
+  def _RunInWorker(self, path, command_line, command):
+    """Runs a command in a pool worker. Called in the worker process.
+
+    Args:
+      path: A list of str, the names of the commands from the root.
+      command_line: A list of str, the command's command_line.
+      command: A list of str, the command line for Run().
+
+    Returns:
+      The value returned by Run().
+    """
+    cmd = self
+    for name in path:
+      # The worker's copy of a lazy command may not be loaded yet.
+      cmd.Load()
+      cmd = cmd[name]
+    cmd.Load()
+    cmd.command_line = command_line
+    cmd.token = executor.CurrentToken()
+    return cmd.WriteOutput(cmd.Run(command))
+
   def _ReadHistory(self):
     """Reads history file, if it exists."""
     if self.histfile:
@@ -322,14 +786,17 @@ class Command(dict):
     Args:
       command: A string, the command to split.
     Returns:
-      A list of strings.
-    """
-    lex = shlex.shlex(command, posix=True)
-    lex.commenters = ''  # disable comments, just like shlex.split
-    # Includes all ASCII printable chars other than |\"'.
-    lex.wordchars += '!#$%&()*+,-./:;<=>?@[]^_`{}~'
+      A CommandLine, a list of strings.
 
-    return list(lex)
+    Raises:
+      ValueError: A quote or escape is unterminated.
+    """
+    tokens = SplitCommandLine(command)
+    if tokens.quote:
+      raise ValueError('No closing quotation')
+    if tokens.escape:
+      raise ValueError('No escaped character')
+    return tokens
 
   def Prompt(self, prompt=None):
     """Prompt user (with readline) then execute command.
@@ -340,6 +807,8 @@ class Command(dict):
     if prompt is not None:
       self.prompt = prompt
 
+    self._ReportJobs()
+    self._completion_state = None
     self._ReadlinePrepare()
     if sys.version_info.major < 3:
       line = raw_input(self.prompt)
@@ -365,10 +834,18 @@ class Command(dict):
     except Exception as e:
       # Other exceptions whilst running command have trace
       # printed, then back to the prompt.
+      import traceback
       traceback.print_exc(file=sys.stdout)
     finally:
       self._RestoreHistory()
 
+  def _ReportJobs(self):
+    """Prints background jobs that have finished since the last prompt."""
+    if self.jobs is None:
+      return
+    for job in self.jobs.Unreported():
+      _PrintJob(job)
+
   def ReadlineCompleter(self, word, state):
     """Readline completion handler.
 
@@ -390,19 +867,15 @@ class Command(dict):
         self._completion_cache = (None, None)
       return next_completion
 
-    initial_candidates = self.FindCurrentCandidates()
-    if not initial_candidates:
-      print('\nNo valid completions.')
-      print(self.prompt + readline.get_line_buffer(), end='')
+    result = self._ReadlineComplete()
+    if not result.candidates:
+      sys.stdout.write('%s\n%s%s' % (self.FormatCompletions(result),
+                                     self.prompt, result.line))
       sys.stdout.flush()
       return None
-    candidates = []
-    for cand in sorted(initial_candidates):
-      candidates.append(cand + COMPLETE_SUFFIX)  # Add space after the token.
-      if cand.startswith('<'):
-        # Make an additional dummy candidate to force
-        # display of these instead of auto-completing.
-        candidates.append('%@%@%@' + cand)
+    # Kept for FormatCompleterOptions, which readline calls next.
+    self._completion_result = result
+    candidates = result.matches
     candidates.append(None)  # readline expects None at the end.
     self._completion_cache = (word, candidates)
     return candidates[state]
@@ -421,37 +894,122 @@ class Command(dict):
         ReadlineCompleter.
       unused_longest: An int, the length of the longest match.
     """
-    print(u'\nValid completions:')
-    candidates = self.FindCurrentCandidates()
-    for candidate in sorted(candidates):
-      if not candidate.startswith('%@%@%@'):
-        # Print it unless its a dummy candidate (see above).
-        print(u' %-21s %s' % (candidate, candidates[candidate] or ''))
-    print(u'%s%s' % (self.prompt, readline.get_line_buffer()), end=u'')
+    line = readline.get_line_buffer()
+    result = self._completion_result
+    if result is None or result.line != line:
+      result = self._ReadlineComplete()
+    sys.stdout.write('%s\n%s%s' % (self.FormatCompletions(result),
+                                   self.prompt, line))
     sys.stdout.flush()
 
+  def FormatCompletions(self, result):
+    """Formats completions for display, with help text.
+
+    At most MAX_COMPLETIONS candidates are listed at a time. Listing the
+    same line again shows the next page, wrapping back to the first.
+
+    Args:
+      result: A CompletionResult.
+
+    Returns:
+      A str, the listing. It starts with a newline, and has no trailing one.
+    """
+    candidates = result.candidates
+    if not candidates:
+      return '\nNo valid completions.'
+    offset = 0
+    if self._completion_page[0] == result.line:
+      offset = self._completion_page[1]
+      if offset >= len(candidates):
+        offset = 0
+    count = None if MAX_COMPLETIONS is None else offset + MAX_COMPLETIONS
+    page = _FirstCandidates(candidates, count)[offset:]
+    self._completion_page = (result.line, offset + len(page))
+
+    lines = ['', 'Valid completions:']
+    for candidate in page:
+      lines.append(' %-21s %s' % (candidate, candidates[candidate] or ''))
+    remaining = len(candidates) - offset - len(page)
+    if remaining:
+      lines.append(' ... %d more, list again for the next page' % remaining)
+    return '\n'.join(lines)
+
   def FindCurrentCandidates(self):
     """Finds valid completions on the current line.
 
     Returns:
       A dict. Keys are valid next token, values are help text for each.
     """
+    return self._ReadlineComplete().candidates
+
+  def _ReadlineComplete(self):
+    """Completes the readline buffer, reporting any error.
+
+    Returns:
+      A CompletionResult, with no candidates if completion failed.
+    """
+    line = readline.get_line_buffer()
     try:
-      for quote in ('', "'", '"'):
-        # Auto close quotations to allow tab completion.
-        try:
-          current_line = shlex.split(readline.get_line_buffer() + quote)
-          break
-        except ValueError as e:
-          pass
-      else:
-        raise  # Re-raise exception that our extra quotes couldnt stop.
-      if readline.get_line_buffer().endswith(' '):
-        current_line.append(' ')
-      return self.Completer(current_line)
+      return self.Complete(line)
     except Exception:
+      import traceback
       print('\n%s' % traceback.format_exc())
-      return {}
+      return CompletionResult(line, {})
+
+  def Complete(self, buffer, cursor=None):
+    """Finds completions for a command line.
+
+    This is the completion used by the readline handlers, and needs no
+    readline session. Unterminated quotes are closed, to allow completion
+    within them.
+
+    Args:
+      buffer: A str, the command line.
+      cursor: An int, the cursor position in buffer. Only the text before
+        it is completed. Defaults to the end of buffer.
+
+    Returns:
+      A CompletionResult.
+    """
+    line = buffer if cursor is None else buffer[:cursor]
+    tokens = SplitCommandLine(line)
+    return CompletionResult(line, self.CompleteTokens(tokens), tokens)
+
+  def CompleteTokens(self, tokens):
+    """Finds completions for a tokenized line, reusing earlier work.
+
+    Between tab presses the line usually only grows within its last
+    token. So the command reached by the tokens before it, and the
+    options they hold, are kept and reused for as long as those tokens
+    are unchanged. Otherwise the tree is walked from the top, as by
+    Completer().
+
+    Args:
+      tokens: A CommandLine, as from SplitCommandLine().
+
+    Returns:
+      A dict, as per Completer().
+    """
+    if tokens.trailing_space:
+      settled, partial = list(tokens), [' ']
+    else:
+      settled, partial = list(tokens[:-1]), list(tokens[-1:])
+    if partial == [PIPE_CHAR] or settled[:1] == [PIPE_CHAR]:
+      # Starting a pipe moves to the pipe tree, so the line before the
+      # pipe must be walked afresh. A leading pipe is dropped by
+      # Disambiguate(), so cannot be resumed from.
+      return self.Completer(settled + partial)
+    state = self._completion_state
+    if (state is None or state.tokens != settled or
+        state.domains != _DomainVersions(state.node)):
+      node, line = self._FindCompleter(settled + [' '])
+      state = self._completion_state = _CompletionState(settled, node,
+                                                        line[:-1])
+    if state.node._HasOwnCompleter():
+      return state.node.Completer(state.line + partial)
+    line = state.node.Disambiguate(state.line + partial)
+    state.node.command_line = line
+    return state.node._LocalCompletes(line, state.parsed)
 
   def Completer(self, current_line):
     """Completion handler.
@@ -464,7 +1022,7 @@ class Command(dict):
     matched regardless of case, however returned commands
     may have case.
 
-    Tokens should be supplied pre-processed by shlex, so that
+    Tokens should be supplied pre-processed by SplitCommandLine(), so that
     quoted parameters are set as one token. Ie, if a line
     entered by the user is:
 
@@ -484,28 +1042,119 @@ class Command(dict):
       completion (eg, if one wants to show "<string>   The string.")
     """
 
-    # First disambiguate as much as possible.
-    line = self.Disambiguate(current_line)
-    self.command_line = line
+    node, line = self._FindCompleter(current_line)
+    if node is not self:
+      return node.Completer(line)
+    return self._LocalCompletes(line)
+
+  def _FindCompleter(self, line):
+    """Walks down the tree to the command that completes the last token.
 
-    # If a pipe is present, tab complete down the pipeline.
-    if self.WillPipe(line):
-      return self.GetPipeTree().Completer(pipe.SplitByPipe(line)[1])
+    Args:
+      line: A list of str, the line at this point.
 
-    candidates = {}
+    Returns:
+      A tuple of the Command() and the (disambiguated) tokens of the line
+      that are left for it. The Command() is either the one to complete
+      the line, or one that has its own Completer().
+    """
+    node = self
+    while True:
+      # First disambiguate as much as possible.
+      line = node.Disambiguate(line)
+      node.command_line = line
+
+      # If a pipe is present, tab complete down the pipeline.
+      if node.WillPipe(line):
+        node = node.GetPipeTree()
+        line = pipe.SplitByPipe(line)[1]
+        if node._HasOwnCompleter():
+          return node, line
+        continue
 
-    # Examine subcommands for completions.
-    for name, subcommand in self.items():
-      if subcommand._Matches(line):
-        if len(line) > 1:
+      if len(line) < 2:
+        return node, line
+      for subcommand in node.values():
+        if subcommand._Matches(line):
           # A line with more elements here is passed to the first match.
-          return subcommand.Completer(line[1:])
-        elif not subcommand.hidden or SHOW_HIDDEN:
-          # Or add non-hidden commands to the help options.
-          candidates[name] = subcommand.help
+          break
+      else:
+        return node, line
+      node = subcommand
+      line = line[1:]
+      if node._HasOwnCompleter():
+        return node, line
+
+  def _GetCompletionTable(self):
+    """Returns the _CompletionTable for this command, building if needed."""
+    if self.loader is not None:
+      self.Load()
+    signature = (SHOW_HIDDEN, self.runnable, self.execute_command_string,
+                 self.GetPipeTree() is not None, _inherited_version)
+    table = self._completion_table
+    if table is None or not table.IsFor(signature):
+      table = self._completion_table = _CompletionTable(self, signature)
+    return table
+
+  def _HasStaticOptions(self):
+    """Returns True if the completions for the options never change.
+
+    That is, none are fuzzy or match on a method, path or regex (other
+    than the values of keyvalue options, which are not completed first).
+    """
+    if type(self.options).GetOptionCompletes is not Options.GetOptionCompletes:
+      return False
+    for option in self.options.GetAllOptions():
+      if option.arg_key is not None:
+        continue
+      matcher = option.matcher
+      if type(matcher) is option_lib.BooleanMatch:
+        continue
+      if option.fuzzy or type(matcher) not in (option_lib.ListMatch,
+                                                option_lib.DictMatch):
+        return False
+      for item in matcher.match:
+        if matcher._GetRegex(item):
+          return False
+    return True
+
+  def _HasOwnCompleter(self):
+    """Returns True if a subclass has replaced Completer()."""
+    return type(self).Completer is not Command.Completer
+
+  def _LocalCompletes(self, line, parsed=None):
+    """Returns completions from this command's subcommands and options.
+
+    Args:
+      line: A list of str, the (disambiguated) line for this command.
+      parsed: A dict, for Options.GetOptionCompletes(), or None.
+
+    Returns:
+      A dict, as per Completer().
+    """
+    token = line[0] if line else None
+    if len(line) < 2 and (token in (None, ' ') or token.strip()):
+      # The first token here, served from the table.
+      table = self._GetCompletionTable()
+      candidates = table.Completes(token)
+      if table.static_options:
+        return candidates
+      candidates = dict(candidates)
+    else:
+      candidates = {}
+      # Examine subcommands for completions.
+      for name, subcommand in self.items():
+        if subcommand._Matches(line):
+          if not subcommand.hidden or SHOW_HIDDEN:
+            # Add non-hidden commands to the help options.
+            candidates[name] = subcommand.help
 
     # Add completions for options.
-    candidates.update(self.options.GetOptionCompletes(line))
+    if parsed is None or (type(self.options).GetOptionCompletes is not
+                          Options.GetOptionCompletes):
+      candidates.update(self.options.GetOptionCompletes(line))
+    else:
+      candidates.update(self.options.GetOptionCompletes(line, parsed))
 
     return candidates
 
@@ -536,6 +1185,7 @@ class Command(dict):
       chaining of AddOption calls to a single Command object.
     """
     self.options.AddOption(name, **kwargs)
+    self.root._completion_state = None
     return self
 
   def _GetCommonPrefix(self, words):
@@ -573,6 +1223,8 @@ class Command(dict):
       A list, where the tokens are disambiguated. If
       ambiguous, returns the supplied 'command'
     """
+    if self.loader is not None:
+      self.Load()
     expanded = []
     if self.WillPipe(command):
       first, last = pipe.SplitByPipe(command)
@@ -612,15 +1264,14 @@ class Command(dict):
     if not command:
       return []
 
-    matches = []  # List of candidate sub-commands.
     # Attempt to look for valid subcommands.
-    for candidate in self:
-      if prefer_exact_match and candidate == command[0].lower():
-        # An exact match short-circuits the search.
-        matches = [candidate]
-        break
-      if candidate.startswith(command[0].lower()):
-        matches.append(candidate)
+    token = command[0].lower()
+    if prefer_exact_match and token in self:
+      # An exact match short-circuits the search.
+      matches = [token]
+    else:
+      # List of candidate sub-commands.
+      matches = self._GetCompletionTable().Names(token)
 
     if len(matches) > 1:
       # More than one, find common prefix, return that.
@@ -638,6 +1289,35 @@ class Command(dict):
     else:  # No match, try options. Exclude '<> completes.
       return self.options.Disambiguate(list(command))
 
+  def Load(self):
+    """Adds the subcommands and options of a lazy command.
+
+    The loader is run once, the first time the command is entered (eg by
+    GetCommand(), Completer() or Disambiguate()). Other threads entering
+    the command meanwhile wait for it to finish. If the loader raises, it
+    is run again the next time.
+    """
+    if self.loader is None:
+      return
+    with _LOAD_LOCK:
+      loader = self.loader
+      if loader is None:
+        return  # Loaded by another thread.
+      root = self.root
+      # Workers load their own copy of the command when they need it, so
+      # the pool is kept, unlike for other changes to the tree.
+      loading = getattr(_local, 'loading', False)
+      _local.loading = True
+      try:
+        tree = loader(self)
+        if tree is not None:
+          ParseTree(self, tree)
+      finally:
+        _local.loading = loading
+      self.loader = None
+      self._completion_table = None
+      root._completion_state = None
+
   def _AddAncestors(self, command_object):
     """Ensure all ancestors are present in the command tree."""
     command = self
@@ -669,6 +1349,8 @@ class Command(dict):
     Args:
       command_object: A Command() object.
     """
+    self.root._TreeChanged()
+    self.root._completion_state = None
     ancestors = list(command_object.ancestors)
     if not command_object.orig_ancestors:
       command_object.orig_ancestors = ancestors
@@ -679,6 +1361,9 @@ class Command(dict):
         command_object.update(self[command_object.name])
       self[command_object.name] = command_object
       command_object.parent = self
+      self._completion_table = None
+      # Its options may inherit from new ancestors.
+      _InheritedChanged()
       return
 
     # The '_busy' attribute is used for loop prevention when this method
@@ -754,29 +1439,166 @@ class Command(dict):
       suppress_backspace: (bool) If True, dont print
         initial (realine workaround) backspace.
 
+    If the last token is BACKGROUND_CHAR, the command is run as a
+    background job instead. See Background().
+
     Returns:
       The value returned by a command's 'Run' method. Else None.
     """
+    background = bool(command) and command[-1] == BACKGROUND_CHAR
+    if background:
+      command = command[:-1]
     cmd = self.GetCommand(command)
     if cmd.options.HasAllValidOptions(cmd.command_line, describe=True):
+      if background:
+        return self.root.Background(cmd, ' '.join(command))
       if not suppress_backspace:
         print('\r', end='')  # Backspace due to a readline quirk adding spurious space.
         sys.stdout.flush()
-      if cmd.WillPipe(cmd.command_line):
+      return cmd._RunCommandLine()
+    return False
+
+  def _PipeCommand(self):
+    """Returns a pipe command of its own for a job to run command_line.
+
+    The commands of a pipe tree, and their pipe.Pipe objects, are shared
+    by every command that pipes through them. A background job is given
+    copies, so that it and the commands in the foreground do not reset
+    each other's pipe.
+
+    Returns:
+      A tuple of a Command(), the copy of the pipe command, and the lists
+      of str to Execute() it with to start and to stop the pipe.
+    """
+    line = pipe.SplitByPipe(self.command_line)[1]
+    pipetree = self.GetPipeTree()
+    if isinstance(pipetree, ShellCommand):
+      return copy.copy(pipetree), line + ['start'], line + ['stop']
+    start = pipetree.GetCommand(line + ['start'])
+    start_line = start.command_line
+    stop_line = pipetree.GetCommand(line + ['stop']).command_line
+    pipe_cmd = copy.copy(start)
+    if getattr(pipe_cmd, 'pipe', None) is not None:
+      pipe_cmd.pipe = copy.copy(pipe_cmd.pipe)
+      pipe_cmd.method = pipe_cmd.pipe.State
+    return pipe_cmd, start_line, stop_line
+
+  def _RunCommandLine(self, token=None, pipe_command=None):
+    """Runs this command with its command_line, piping if requested.
+
+    Args:
+      token: An executor.CancelToken for the run. If None, a new one.
+      pipe_command: A tuple, as from _PipeCommand(), to pipe through. If
+        None, the pipe tree's own commands are used.
+
+    Returns:
+      The value returned by Run(), or False if cancelled.
+    """
+    try:
+      if self.WillPipe(self.command_line):
         retval = None
-        first, last = pipe.SplitByPipe(cmd.command_line)
+        first, last = pipe.SplitByPipe(self.command_line)
+        pipe_cmd, start, stop = pipe_command or (
+            self.GetPipeTree(), last + ['start'], last + ['stop'])
         # Run "<pipecmd> start" to init pipe.
-        if cmd.GetPipeTree().Execute(last + ['start']):
+        if pipe_cmd.Execute(start, suppress_backspace=True):
           try:
-            retval = cmd.Run(first)
+            retval = self._Invoke(first, token)
+          except pipe.PipeClosed:
+            pass  # Pipe stopped reading, eg the user quit the pager.
           finally:
             # Run "<pipecmd> stop" to close pipe.
-            cmd.GetPipeTree().Execute(last + ['stop'])
+            pipe_cmd.Execute(stop, suppress_backspace=True)
         return retval
       else:
-        return cmd.Run(cmd.command_line)
+        return self._Invoke(self.command_line, token)
+    except executor.Cancelled as e:
+      print('%% %s' % e)
     return False
 
+  def Background(self, cmd, command_line):
+    """Runs a resolved command as a background job.
+
+    The job's output is spooled, to be shown by the 'fg' command (see
+    DEFAULT_JOBTREE). Up to jobs.max_jobs jobs run at once.
+
+    Args:
+      cmd: A Command(), with command_line set, as from GetCommand().
+      command_line: A str, the command line to display.
+
+    Returns:
+      An executor.Job, or False if the command cannot run in the background.
+    """
+    if cmd.WillPipe(cmd.command_line) and isinstance(cmd.GetPipeTree(),
+                                                     ShellCommand):
+      print('% Shell pipes cannot be run in the background.')
+      return False
+    if self.root.jobs is None:
+      self.root.jobs = executor.JobTable()
+    # The job works on a copy, as command_line is overwritten whenever
+    # the command is completed or run again in the foreground. Its pipe
+    # is resolved here too, as the pipe tree is shared in the same way.
+    job_cmd = copy.copy(cmd)
+    pipe_command = None
+    if job_cmd.WillPipe(job_cmd.command_line):
+      pipe_command = job_cmd._PipeCommand()
+    token = executor.CancelToken()
+    job = self.root.jobs.Submit(
+        command_line,
+        lambda: job_cmd._RunCommandLine(token, pipe_command), token)
+    print('[%d] %s' % (job.id, command_line))
+    return job
+
+  def _Invoke(self, command, token=None):
+    """Runs the command in its executor, and writes out its output.
+
+    Args:
+      command: A list of str, the command line for Run().
+      token: An executor.CancelToken for the run. If None, a new one.
+
+    Returns:
+      The value returned by Run().
+    """
+    self.token = token or executor.CancelToken()
+    if self.GetExecutor() == 'process':
+      path = []
+      cmd = self
+      while cmd.parent is not None:
+        path.insert(0, cmd.name)
+        cmd = cmd.parent
+      pool = self.root.pool or self.root.StartPool()
+      return pool.Run((path, self.command_line, command),
+                      timeout=self.GetTimeout(), token=self.token,
+                      limits=self.GetLimits())
+    return executor.Run(lambda: self.WriteOutput(self.Run(command)),
+                        executor=self.GetExecutor(),
+                        timeout=self.GetTimeout(), token=self.token)
+
+  def WriteOutput(self, retval):
+    """Writes out the output of a command that returned a generator.
+
+    A command method may yield its output a line at a time rather than
+    printing it. The lines are then pulled only as fast as stdout (or
+    a pipe such as the pager) consumes them, and the generator is closed
+    as soon as the consumer stops reading.
+
+    Args:
+      retval: The value returned by Run().
+
+    Returns:
+      None if retval is a generator, else retval.
+    """
+    if not isinstance(retval, types.GeneratorType):
+      return retval
+    try:
+      for line in retval:
+        line = '%s' % line
+        if not line.endswith('\n'):
+          line += '\n'
+        sys.stdout.write(line)
+    finally:
+      retval.close()
+
   def Run(self, command):
     """Run the given command."""
     if self.method is not None:
@@ -798,6 +1620,343 @@ class Command(dict):
     for item in self._saved_history:
       readline.add_history(item)
 
+class _CompletionState(object):
+  """Completion work kept between tab presses, see CompleteTokens().
+
+  Attributes:
+    tokens: A list of str, the tokens before the one being completed.
+    node: A Command(), the command those tokens lead to.
+    line: A list of str, the tokens left over for node.
+    parsed: A dict, options parsed by node.options.GetOptionCompletes().
+    domains: A list of the Domain() and Catalog() objects node's options
+      match on, and their versions when parsed.
+  """
+
+  def __init__(self, tokens, node, line):
+    self.tokens = tokens
+    self.node = node
+    self.line = line
+    self.parsed = {}
+    self.domains = _DomainVersions(node)
+
+
+def _DomainVersions(command):
+  """Returns the domains and catalogs of command's options, and versions."""
+  return [(option.matcher.domain, option.matcher.domain.version)
+          for option in command.options.GetAllOptions()
+          if type(option.matcher) in (option_lib.DomainMatch,
+                                      option_lib.CatalogMatch)]
+
+
+class _SortedCompletes(dict):
+  """Completions, with keys added in sorted order."""
+
+
+def _SortedCandidates(candidates):
+  """Returns the keys of a dict of completions, sorted."""
+  if isinstance(candidates, _SortedCompletes):
+    return list(candidates)
+  return sorted(candidates)
+
+
+def _FirstCandidates(candidates, count):
+  """Returns the first keys of a dict of completions, in sorted order.
+
+  Only the keys returned are ever sorted, so the cost stays bounded by
+  count rather than by the size of candidates.
+
+  Args:
+    candidates: A dict of completions.
+    count: An int, the number of keys to return, or None for all of them.
+
+  Returns:
+    A list of str.
+  """
+  if count is None or count >= len(candidates):
+    return _SortedCandidates(candidates)
+  if isinstance(candidates, _SortedCompletes):
+    return list(itertools.islice(candidates, count))
+  return heapq.nsmallest(count, candidates)
+
+
+def _PrefixRange(items, keys, prefix):
+  """Returns the (key, value) items whose key starts with prefix.
+
+  Args:
+    items: A list of (key, value) tuples, sorted.
+    keys: A list of str, the keys of items.
+    prefix: A str.
+
+  Returns:
+    A list of (key, value) tuples.
+  """
+  start = end = bisect.bisect_left(keys, prefix)
+  while end < len(keys) and keys[end].startswith(prefix):
+    end += 1
+  return items[start:end]
+
+
+class _CompletionTable(object):
+  """Sorted completions for the first token after a command.
+
+  A command's subcommands, and usually its options, do not change between
+  tab presses, so their completions are worked out and sorted once, and
+  looked up by prefix from then on. A subcommand's help and hidden
+  attributes are read when looked up, as they are often set after it is
+  added.
+
+  The table is dropped when the subcommands are added, removed or
+  replaced, and rebuilt when the values of the list and dict options it
+  holds change. See IsFor().
+
+  Attributes:
+    signature: A tuple, the settings the table was built for.
+    static_options: A boolean, True if the table holds the completions of
+      the options as well as the subcommands. If False, the options must
+      be completed with GetOptionCompletes().
+  """
+
+  def __init__(self, command, signature):
+    self.signature = signature
+    self.static_options = command._HasStaticOptions()
+    self._commands = sorted(command.items())
+    self._command_keys = [key for key, _ in self._commands]
+    options = {}
+    # List and dict matchers held, with the version of their values.
+    self._lists = []
+    if self.static_options:
+      options = command.options.GetOptionCompletes([' '])
+      for option in command.options.GetAllOptions():
+        if option.arg_key is None and type(option.matcher) in (
+            option_lib.ListMatch, option_lib.DictMatch):
+          self._lists.append((option.matcher, option.matcher.version))
+    self._all_options = sorted(options.items())
+    # '<cr>' and the pipe are only offered when there is no token.
+    self._options = [item for item in self._all_options
+                     if item[0] not in ('<cr>', PIPE_CHAR)]
+    self._option_keys = [key for key, _ in self._options]
+    self._fuzzy = None
+
+  def IsFor(self, signature):
+    """Returns True if the table is still valid for its command.
+
+    Args:
+      signature: A tuple, the settings now, as per the attribute.
+    """
+    if signature != self.signature:
+      return False
+    for matcher, version in self._lists:
+      if matcher.version != version:
+        return False
+    return True
+
+  def Names(self, prefix):
+    """Returns the names of the subcommands starting with prefix."""
+    return [name for name, _ in _PrefixRange(self._commands,
+                                             self._command_keys, prefix)]
+
+  def _Commands(self, items):
+    """Returns (name, help) of the subcommands that are not hidden."""
+    return [(name, subcommand.help) for name, subcommand in items
+            if not subcommand.hidden or SHOW_HIDDEN]
+
+  def _Closest(self, token):
+    """Returns the (name, subcommand) items with names closest to token."""
+    if self._fuzzy is None:
+      self._fuzzy = option_lib.FuzzyIndex(self._command_keys)
+    commands = dict(self._commands)
+    return [(name, commands[name]) for name in self._fuzzy.Search(token)]
+
+  def Completes(self, token):
+    """Looks up the completions for a token.
+
+    Args:
+      token: A str, the (disambiguated) token. ' ' or None for all.
+
+    Returns:
+      A _SortedCompletes. Unless static_options is True, only the
+      completions of the subcommands.
+    """
+    if token in (None, ' '):
+      commands = self._Commands(self._commands)
+      options = self._all_options
+    else:
+      # Commands match case insensitively, as per _Matches().
+      commands = self._Commands(_PrefixRange(
+          self._commands, self._command_keys, token.lower()))
+      if not commands and FUZZY_COMMANDS:
+        commands = self._Commands(sorted(self._Closest(token)))
+      options = _PrefixRange(self._options, self._option_keys, token)
+    if not self.static_options:
+      return _SortedCompletes(commands)
+    # Where both have a key, the option's help wins, as it is added later.
+    completes = _SortedCompletes(
+        heapq.merge(commands, options, key=lambda item: item[0]))
+    if token not in (None, ' '):
+      freeform = [key for key in completes if key.startswith('<')]
+      if len(freeform) != len(completes):
+        # As per Options.GetOptionCompletes().
+        for key in freeform:
+          del completes[key]
+    return completes
+
+
+# Lists and dicts with more plain values than this are not copied into an
+# _OptionLookup, but looked up in their own index.
+_LOOKUP_VALUES = 256
+
+# Regexes with backreferences, whose group numbers would change if they were
+# joined with others.
+_BACKREFERENCE_RE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class _OptionLookup(object):
+  """Finds the options that may match a token, in one lookup.
+
+  The words that options match by prefix, being the names of boolean
+  options and the plain values of list and dict options, are kept in one
+  sorted list. Regex options and the regex values of lists are joined into
+  one regex, with a named group for each. So a token is looked up once,
+  rather than being matched by every option in turn. Fuzzy and expand
+  options, and options with other matchers, such as a method or a path,
+  are always candidates.
+
+  Attributes:
+    options: A tuple of Option(), the options looked up, in order.
+    inherited_version: An int, the _inherited_version the options are for.
+    required_options: A set of str, the names of the required options that
+      are not in a group.
+    required_groups: A set of str, the groups with a required option.
+  """
+
+  def __init__(self, options, inherited_version):
+    self.options = tuple(options)
+    self.inherited_version = inherited_version
+    self.required_options = set()
+    self.required_groups = set()
+    # Lists whose values are copied, with the version of their values.
+    self._lists = []
+    # Option numbers, for those always candidates, those looked up in their
+    # own index, and those regexes matched on their own.
+    self._always = []
+    self._indexed = []
+    self._separate = []
+    words = []
+    regexes = []
+    for number, option in enumerate(self.options):
+      if option.required and option.group:
+        self.required_groups.add(option.group)
+      elif option.required and not option.arg_key:
+        self.required_options.add(option.name)
+      matcher = option.matcher
+      if type(option).FindMatches is not option_lib.Option.FindMatches:
+        self._always.append(number)
+      elif type(matcher) is option_lib.BooleanMatch:
+        words.append((matcher.match, number))
+      elif option.fuzzy or option.expand:
+        # Completes or matches tokens that no value starts with, so is
+        # never left out.
+        self._always.append(number)
+      elif type(matcher) is option_lib.RegexMatch and not option.multiword:
+        regexes.append(('(?i:^(?:%s))' % matcher.match_str, number))
+      elif type(matcher) in (option_lib.DomainMatch, option_lib.CatalogMatch):
+        # Shared, and changed in place, so never copied.
+        self._indexed.append(number)
+      elif type(matcher) in (option_lib.ListMatch, option_lib.DictMatch):
+        values, list_regexes, _ = matcher._Index()
+        if len(values) > _LOOKUP_VALUES:
+          self._indexed.append(number)
+          continue
+        self._lists.append((matcher, matcher.version))
+        words.extend((value, number) for value in values)
+        regexes.extend(('(?:%s)' % matcher._GetRegex(value), number)
+                       for value in list_regexes)
+      else:
+        self._always.append(number)
+    words.sort()
+    self._words = [word for word, _ in words]
+    self._word_numbers = [number for _, number in words]
+    self._regex = None
+    self._regex_numbers = []
+    self._patterns = []
+    for regex, number in regexes:
+      if _BACKREFERENCE_RE.search(regex):
+        self._separate.append((option_lib.CompilePattern(regex), number))
+      else:
+        self._patterns.append(option_lib.CompilePattern(regex))
+        self._regex_numbers.append(number)
+    if self._patterns:
+      try:
+        self._regex = option_lib.CompilePattern('|'.join(
+            '(?P<_%d>%s)' % (index, pattern.pattern)
+            for index, pattern in enumerate(self._patterns)))
+      except re.error:
+        # Eg flags that must start the regex. Each is matched on its own.
+        self._separate.extend(zip(self._patterns, self._regex_numbers))
+        self._patterns = []
+        self._regex_numbers = []
+
+  def IsFor(self, inherited_version):
+    """Returns True if the lookup is still valid for its options.
+
+    The Options() drop the lookup when they change themselves.
+
+    Args:
+      inherited_version: An int, the _inherited_version now.
+    """
+    if inherited_version != self.inherited_version:
+      return False
+    for matcher, version in self._lists:
+      if matcher.version != version:
+        return False
+    return True
+
+  def Candidates(self, line, index, after=None):
+    """Returns the options that may match a token.
+
+    Args:
+      line: A list of str, the command line.
+      index: An int, the position in line of the token.
+      after: An Option(), if given only options after it are returned.
+
+    Returns:
+      A list of Option(), in order. Options left out do not match the
+      token, as per Option.FindMatches().
+    """
+    numbers = list(self._always)
+    if 0 <= index < len(line) and line[index].strip():
+      token = line[index]
+      words = self._words
+      position = bisect.bisect_left(words, token)
+      while position < len(words) and words[position].startswith(token):
+        numbers.append(self._word_numbers[position])
+        position += 1
+      if self._regex is not None:
+        match = self._regex.match(token)
+        if match:
+          # The regexes before the one matching do not match.
+          first = int(match.lastgroup[1:])
+          numbers.append(self._regex_numbers[first])
+          for pattern, number in zip(self._patterns[first + 1:],
+                                     self._regex_numbers[first + 1:]):
+            if pattern.match(token):
+              numbers.append(number)
+      for pattern, number in self._separate:
+        if pattern.match(token):
+          numbers.append(number)
+      for number in self._indexed:
+        if self.options[number].matcher.Matches(line, index):
+          numbers.append(number)
+    start = 0 if after is None else self.options.index(after) + 1
+    candidates = []
+    for number in sorted(set(numbers)):
+      option = self.options[number]
+      if number >= start and (option.position < 0 or
+                              option.position == index):
+        candidates.append(option)
+    return candidates
+
+
 class ShellCommand(Command):
   """A type of Command that is useful for direct shell pipelines."""
 
@@ -805,7 +1964,7 @@ class ShellCommand(Command):
     """Command line completer, for now just return a default placeholder."""
     return {'<command>': 'Shell command to pipe output through'}
 
-  def Execute(self, command):
+  def Execute(self, command, suppress_backspace=False):
     """Called immediately before and immediately after the primary command."""
     action = command[-1]
     cmd = []
@@ -829,6 +1988,7 @@ class ShellCommand(Command):
 
   def _StartPipe(self, pipe):
     """Direct stdout to the supplied pipe."""
+    import subprocess
     self._shell = subprocess.Popen(pipe, stdin=subprocess.PIPE, shell=True)
     self._prevfd = os.dup(sys.stdout.fileno())
     os.dup2(self._shell.stdin.fileno(), sys.stdout.fileno())
@@ -847,16 +2007,77 @@ class ShellCommand(Command):
     return True
 
 
+def _InheritedChanged():
+  """Notes that the options inherited by some commands have changed."""
+  global _inherited_version
+  _inherited_version += 1
+
+
 class Options(list):
   """Represents all options for a command.
 
+  Tokens are matched to options through an _OptionLookup, built when first
+  needed and again once options are added or removed, options inherited
+  change, or the values of a list or dict option change. Other changes to
+  an option once the command is in use are not seen.
+
   Attributes:
     command: A Command() object, the associated command.
   """
 
+  __slots__ = ('command', '_lookup', '_all')
+
   def __init__(self, *args):
     super(Options, self).__init__(*args)
     self.command = None
+    self._lookup = None
+    self._all = None
+
+  def __getstate__(self):
+    # The lookup is rebuilt when needed, so is not pickled.
+    return None, {'command': self.command, '_lookup': None, '_all': None}
+
+  # Changes to the options drop what was worked out from them. Unpickling
+  # adds the options before the attributes are set, so they are only set.
+  def _Changed(self):
+    self._lookup = None
+    self._all = None
+
+  def __setitem__(self, index, value):
+    list.__setitem__(self, index, value)
+    self._Changed()
+
+  def __delitem__(self, index):
+    list.__delitem__(self, index)
+    self._Changed()
+
+  def append(self, option):
+    list.append(self, option)
+    self._Changed()
+
+  def extend(self, options):
+    list.extend(self, options)
+    self._Changed()
+
+  def insert(self, index, option):
+    list.insert(self, index, option)
+    self._Changed()
+
+  def pop(self, *args):
+    self._Changed()
+    return list.pop(self, *args)
+
+  def sort(self, *args, **kwargs):
+    list.sort(self, *args, **kwargs)
+    self._Changed()
+
+  def _GetLookup(self):
+    """Returns the _OptionLookup for GetAllOptions(), building if needed."""
+    lookup = self._lookup
+    if lookup is None or not lookup.IsFor(_inherited_version):
+      lookup = self._lookup = _OptionLookup(self.GetAllOptions(),
+                                            _inherited_version)
+    return lookup
 
   def GetOptionObject(self, name):
     """Fetches the Option object for the given option name.
@@ -865,12 +2086,49 @@ class Options(list):
       name: A str, the option name to fetch.
 
     Returns:
-      An Option(), the option requested. None if the name is not found.
+      An Option(), the option requested, which may be inherited. None if
+      the name is not found.
     """
-    for option in self:
+    for option in self.GetAllOptions():
       if option.name == name:
         return option
 
+  def GetAllOptions(self):
+    """Returns these options, and those inherited from ancestor commands.
+
+    An option added with inherit=True applies to every command below the
+    one it was added to, unless a nearer command has an option of the same
+    name. Inherited options are looked up each time rather than copied to
+    each command.
+
+    The list is kept until the options, or those inherited, change.
+
+    Returns:
+      A list of Option(), in the same order as the options are sorted. If
+      nothing is inherited, this is the Options() itself.
+    """
+    if self._all is not None and self._all[0] == _inherited_version:
+      return self._all[1]
+    options = self
+    names = None
+    parent = self.command and self.command.parent
+    while parent is not None:
+      inherited = [option for option in parent.options if option.inherit]
+      if inherited:
+        if names is None:
+          names = set(option.name for option in self)
+          options = list(self)
+        # The value option of a keyvalue option goes with its key.
+        inherited = [option for option in inherited
+                     if (option.arg_key or option).name not in names]
+        options.extend(inherited)
+        names.update(option.name for option in inherited)
+      parent = parent.parent
+    if options is not self:
+      options.sort()
+    self._all = (_inherited_version, options)
+    return options
+
   def remove(self, key):
     """Override parent remove.
 
@@ -880,16 +2138,16 @@ class Options(list):
     Raises:
       ValueError, if the item is not present.
     """
-    new = []
     if isinstance(key, option_lib.Option):  # Remove by object.
       key = key.name
-    for option in self:
-      if option.name != key:
-        new.append(option)
-        break
-    else:
+    new = [option for option in self if option.name != key]
+    if len(new) == len(self):
       raise ValueError('%s not in list' % key)
+    inherited = any(option.inherit for option in self
+                    if option.name == key)
     self[:] = new
+    if inherited:
+      _InheritedChanged()
 
   def AddOption(self, name, **kwargs):
     """Adds an option to this command.
@@ -903,14 +2161,39 @@ class Options(list):
       ValueError: An invalid option parameter combination was supplied.
     """
     # First, see if this is a replacement for an existing option,
-    # and if so, remove it.
-    existing = self.GetOptionObject(name)
-    if existing is not None:
-      if existing.arg_val is not None:
-        # Also remove keyvalue "value" option.
-        self.remove(existing.arg_val.name)
-      self.remove(existing.name)
+    # and if so, remove it. An inherited option is not replaced.
+    new = self._NewOptions(name, kwargs)
+    for existing in self:
+      if existing.name == name:
+        if existing.arg_val is not None:
+          # Also remove keyvalue "value" option.
+          self.remove(existing.arg_val.name)
+        self.remove(existing.name)
+        break
+
+    self.extend(new)
+    if new[0].inherit:
+      _InheritedChanged()
+    if self.command is not None:
+      self.command._completion_table = None
+
+    # Now re-order the options so that non-boolean/dict/list ones come last.
+    self.sort()
+
+  @staticmethod
+  def _NewOptions(name, kwargs):
+    """Creates the Option() objects for AddOption(), without adding them.
+
+    Args:
+      name: A string, the name of the option.
+      kwargs: A dict, the Option() kwargs. This is modified.
+
+    Returns:
+      A list of Option(), the option, then its value option if keyvalue.
 
+    Raises:
+      ValueError: An invalid option parameter combination was supplied.
+    """
     kwargs['name'] = name
     default = kwargs.get('default')
     if kwargs.get('keyvalue'):
@@ -924,6 +2207,8 @@ class Options(list):
       # and other parameters are passed to the 'value' option.
       match = kwargs.pop('match', None)
       path = kwargs.pop('is_path', None)
+      fuzzy = kwargs.pop('fuzzy', False)
+      expand = kwargs.pop('expand', False)
 
       kwargs['boolean'] = True
 
@@ -932,12 +2217,14 @@ class Options(list):
             'With "keyvalue", one of "match" or "is_path" must be set.')
 
     option = option_lib.Option(**kwargs)
-    self.append(option)
+    options = [option]
 
     if option.keyvalue:
       kwargs['match'] = match
       kwargs['boolean'] = False
       kwargs['is_path'] = path
+      kwargs['fuzzy'] = fuzzy
+      kwargs['expand'] = expand
       kwargs['name'] = '<' + option.name + '__arg>'
 
       optionv = option_lib.Option(**kwargs)
@@ -947,10 +2234,8 @@ class Options(list):
 
       option.arg_val = optionv
       option.default = default
-      self.append(optionv)
-
-    # Now re-order the options so that non-boolean/dict/list ones come last.
-    self.sort()
+      options.append(optionv)
+    return options
 
   def GetOption(self, command_line, option_name):
     """Fetches an option from command line.
@@ -964,7 +2249,10 @@ class Options(list):
       option_name: A string, the name of the option.
 
     Returns:
-      The option value, if set (string or True), else None.
+      The option value, if set (string or True), else None. For an option
+      matching on a ValueType, the parsed value, eg an int. For an option
+      with expand set, an option_lib.Expansion, to iterate over for the
+      values it stands for.
     """
     # Get options set on command line, return value if there's a match.
     for option, value in self._FindOptions(command_line)[0].items():
@@ -973,7 +2261,14 @@ class Options(list):
 
     # Not on command line. Look for default (may be None).
     option = self.GetOptionObject(option_name)
-    return option and option.default or None
+    if not option or not option.default:
+      return None
+    matcher = (option.arg_val or option).matcher
+    if (option.arg_val or option).expand:
+      return option_lib.Expansion(str(option.default), matcher, literal=True)
+    if isinstance(matcher, option_lib.TypedMatch):
+      return matcher.Convert(option.default)
+    return option.default
 
   def GetGroupOption(self, command_line, group):
     """Fetches set options in a group.
@@ -990,7 +2285,7 @@ class Options(list):
       the name of the option (for bool options) or the matching
       string, for non-bool options.
     """
-    for option in self:
+    for option in self.GetAllOptions():
       if option.group == group:
         value = self.GetOption(command_line, option.name)
         if value:
@@ -1020,16 +2315,22 @@ class Options(list):
     # the command line, attempt to expand the option to its full
     # string.
     # Stop processing if an ambiguous token is reached.
+    lookup = self._GetLookup()
     index = 0
     while index < len(command):
       candidates = []
-      for option in self:
+      options = lookup.Candidates(command, index)
+      while options:
         # Look through options. Any that match the current word
         # are added to candidates.
+        option = options.pop(0)
         match = option.FindMatches(command, index)
         if match.count:
           candidates.extend(list(match.valid.keys()))
-          index += match.count-1
+          if match.count > 1:
+            # Later options are matched after the words this one took.
+            index += match.count-1
+            options = lookup.Candidates(command, index, after=option)
       if len(candidates) == 1:
         # Expanded command line is built with uniquely matching options.
         newcommand[index] = candidates[0]
@@ -1038,21 +2339,11 @@ class Options(list):
 
   def _GetRequiredGroups(self):
     """Returns required groups in this option set."""
-    required_groups = set()
-    # Build a list of required option groups.
-    for option in self:
-      if option.group and option.required:
-        required_groups.add(option.group)
-    return required_groups
+    return set(self._GetLookup().required_groups)
 
   def _GetRequiredOptions(self):
     """Returns required options in this option set."""
-    required_options = set()
-    # Build a list of required options.
-    for option in self:
-      if option.required and not option.group and not option.arg_key:
-        required_options.add(option.name)
-    return required_options
+    return set(self._GetLookup().required_options)
 
   def _FindOptions(self, line):
     """Find options present on the command line.
@@ -1067,11 +2358,12 @@ class Options(list):
     """
     found_options = {}
     found_groups = []
+    lookup = self._GetLookup()
 
     idx = 0
     while idx < len(line):
       token = line[idx]
-      for option in self:
+      for option in lookup.Candidates(line, idx):
         if option in found_options:
           continue
         if option.arg_key is not None:
@@ -1098,7 +2390,7 @@ class Options(list):
         break  # Didnt find option for this token. Abort.
     return (found_options, found_groups)
 
-  def GetOptionCompletes(self, line):
+  def GetOptionCompletes(self, line, parsed=None):
     """Fetches option completions.
 
     If self.command.runnable is set, any/all required options are
@@ -1111,12 +2403,16 @@ class Options(list):
       line: A list of strings, the options on the line. Eg if the user
         entered 'set pager on colour red' and the Command is for 'pager',
         line should be ['on', 'colour', 'red'].
+      parsed: A dict, in which the options found before the last token
+        are kept, keyed by those tokens. Passing the same dict for lines
+        that differ only in the last token saves parsing them again.
 
     Returns:
       A dict, keys are valid completions, values are associated helpstring.
     """
     # The final returned dict.
     completes = {}
+    options = self.GetAllOptions()
     # Get the last token on the line.
     last_index = len(line)-1
     last_token = None
@@ -1126,15 +2422,30 @@ class Options(list):
     # found options are options which are found.
     # Seem groups are groups for which a member was seen.
     # Skip last token if still being typed.
-    if last_token != ' ':
-      find_line = line[:-1]
+    key = (tuple(line[:-1]), last_token == ' ')
+    if parsed is not None and key in parsed:
+      found_options, seen_groups, has_required = parsed[key]
     else:
-      find_line = line
-    find_line = self.Disambiguate(find_line)
-    found_options, seen_groups = self._FindOptions(find_line)
+      if last_token != ' ':
+        find_line = line[:-1]
+      else:
+        find_line = line
+      find_line = self.Disambiguate(find_line)
+      found_options, seen_groups = self._FindOptions(find_line)
+
+      # Ensure has all the required options present.
+      has_required = self.HasAllValidOptions(line[:-1])
+      if parsed is not None:
+        parsed[key] = (found_options, seen_groups, has_required)
 
-    # Ensure has all the required options present.
-    has_required = self.HasAllValidOptions(line[:-1])
+    if last_token != ' ':
+      # Only these options can match the token being typed.
+      matching = set(self._GetLookup().Candidates(line, last_index))
+
+    def _Completes(option, line, index):
+      """Whether the option matches, or fuzzily completes, the token."""
+      match = option.FindMatches(line, index)
+      return match.count or (option.fuzzy and match.valid)
 
     def _SkipOption(option, line):
       """Determines whether to skip the given option."""
@@ -1146,10 +2457,10 @@ class Options(list):
           # Position is not valid at this token.
           (option.position >= 0 and last_index != option.position) or
           # No match for this option (unless no token is present).
-          (last_token != ' ' and not
-           option.FindMatches(line, last_index).count)):
+          (last_token != ' ' and (option not in matching or
+                                  not _Completes(option, line, last_index)))):
         return True
-      for opt in self:
+      for opt in options:
         # If another option with 'position' is here, skip this option.
         if (opt.position >= 0 and last_index == opt.position and
             opt.name != option.name):
@@ -1162,7 +2473,7 @@ class Options(list):
 
     # Go through options that were not found on the line, and
     # see if they need to be considered for completion candidates.
-    for option in self:
+    for option in options:
       if _SkipOption(option, line):
         continue
       match = option.FindMatches(line, last_index)
@@ -1175,7 +2486,8 @@ class Options(list):
           # Line too short or previous token doesnt match
           continue
         # Reset all completes, as we only want whetever matches the keyvalue.
-        if option.matcher.MATCH in ('list', 'dict', 'path', 'method'):
+        if option.matcher.MATCH in ('list', 'dict', 'path', 'method',
+                                    'domain', 'catalog', 'typed'):
           completes = match.valid
           if len(completes) != 1:
             # single value of keyvalue not present.
@@ -1236,8 +2548,9 @@ class Options(list):
       command = pipe.SplitByPipe(command)[0]
 
     # All required are missing until they are seen.
-    missing_options = self._GetRequiredOptions()
-    missing_groups = self._GetRequiredGroups()
+    lookup = self._GetLookup()
+    missing_options = set(lookup.required_options)
+    missing_groups = set(lookup.required_groups)
     # Note which options are already matched on the command line.
     found_options = []
     # Note tokens which do not have any match.
@@ -1246,8 +2559,10 @@ class Options(list):
     idx = 0
     while idx < len(command):
       token = command[idx]
+      # A typed option the token is not a valid value for, and why.
+      rejected = None
       # Find option matching this token.
-      for option in self:
+      for option in lookup.Candidates(command, idx):
         if option.name in found_options:
           # Already found this option.
           continue
@@ -1259,6 +2574,8 @@ class Options(list):
         match = option.FindMatches(command, idx)
         if not match.count:
           # Option does not match anyway.
+          if type(option.matcher) is option_lib.TypedMatch and match.reason:
+            rejected = (option, match.reason)
           continue
 
         # As 'Disambiguate' is called before this point, ignore
@@ -1271,8 +2588,12 @@ class Options(list):
         found_options.append(option.name)
 
         # A 'multiple match' error is displayed unless the
-        # token is an exact match for one of the candidates.
-        if len(match.valid) != 1 and token not in match.valid:
+        # token is an exact match for one of the candidates. Paths are
+        # taken literally, as they may name a file yet to be created, and
+        # ranges and wildcards stand for all the values they match.
+        if (len(match.valid) != 1 and token not in match.valid and
+            not option.is_path and
+            not isinstance(match.value, option_lib.Expansion)):
           if describe:
             print('%% Multiple matches for "%s" argument "%s":' % (
                 option.name, token))
@@ -1299,14 +2620,16 @@ class Options(list):
             # Arg does not match.
             if describe:
               print('%% Invalid argument for option "%s".' % option.name, end='')
-            if vmatch.reason:
-              print(u'%s' % vmatch.reason)
-            else:
-              print()
+              if vmatch.reason:
+                print(u' %s' % vmatch.reason)
+              else:
+                print()
             return False
           idx += vmatch.count
           tok = command[idx]
-          if len(vmatch.valid) != 1 and tok not in vmatch.valid:
+          if (len(vmatch.valid) != 1 and tok not in vmatch.valid and
+              not option.arg_val.is_path and
+              not isinstance(vmatch.value, option_lib.Expansion)):
             if describe:
               print('%% Multiple matches for "%s" argument "%s":' % (
                   option.name, tok))
@@ -1339,7 +2662,10 @@ class Options(list):
     if unknown_tokens or missing_groups or missing_options:
       if describe:
         # Only print out the first error to avoid confusing the user.
-        if unknown_tokens:
+        if unknown_tokens and rejected:
+          print('%% Invalid value for "%s". %s' % (rejected[0].name,
+                                                  rejected[1]))
+        elif unknown_tokens:
           print('%% Unknown/duplicate token(s): %s' % ', '.join(unknown_tokens))
         elif missing_groups:
           print('%% Missing group(s): %s' % ', '.join(missing_groups))
@@ -1378,7 +2704,32 @@ class CommandDefinition(Definition):
 
 
 class OptionDefinition(Definition):
-  """Definition for an Option in the tree."""
+  """Definition for an Option in the tree.
+
+  The Option() objects are made the first time the definition is parsed,
+  and shared by every command it is given for. A definition kept in a
+  variable and used throughout a tree is so only built once, and its
+  options must not be changed.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(OptionDefinition, self).__init__(*args, **kwargs)
+    self._options = None
+
+  def GetOptions(self):
+    """Returns the Option() objects defined, making them on first use.
+
+    Returns:
+      A list of Option(), the option, then its value option if keyvalue.
+
+    Raises:
+      ValueError: An invalid option parameter combination was supplied.
+    """
+    if self._options is None:
+      kwargs = dict(self.kwargs)
+      name = self.args[0] if self.args else kwargs.pop('name')
+      self._options = Options._NewOptions(name, kwargs)
+    return self._options
 
 
 class PipeTreeDefinition(Definition):
@@ -1396,6 +2747,112 @@ def Definitions():
   return CommandDefinition, OptionDefinition, PipeTreeDefinition, PipeDefinition
 
 
+class TreeBuilder(object):
+  """Adds commands and options to command trees in bulk.
+
+  Unlike Command.AddCommand(), which finds the parent from the root for
+  every command, commands are attached straight below the given parent.
+  Options are appended without sorting, and each command's options are
+  sorted once by Finish(). Building a tree this way takes linear time.
+
+  The tree should not be used until Finish() is called.
+  """
+
+  def __init__(self):
+    self._roots = {}
+    self._unsorted = {}
+
+  def AddCommand(self, parent, name, **kwargs):
+    """Adds a command below parent, as with parent.AddSubCommand().
+
+    Args:
+      parent: A Command(), the command to add below.
+      name: A string, the command name relative to parent, eg 'pager'.
+        Missing commands between parent and the new one are created.
+      kwargs: As for Command.AddCommand().
+
+    Returns:
+      A Command() object, the new command.
+    """
+    name = name.split()
+    for key in name[:-1]:
+      if key not in parent:
+        self._Attach(parent, Command(name=key, help=kwargs.get('help')))
+      parent = parent[key]
+    return self._Attach(parent, Command._NewCommand(name[-1], **kwargs))
+
+  def _Attach(self, parent, command):
+    """Attaches command below parent. See Command.Attach()."""
+    root = parent.root
+    self._roots[id(root)] = root
+    if parent is not root:
+      command.orig_ancestors = parent.orig_ancestors + [parent.name]
+    command.root = root
+    command.parent = parent
+    existing = parent.get(command.name)
+    if existing is not None:
+      # If node already exists, merge sub-commands.
+      command.update(existing)
+    parent[command.name] = command
+    parent._completion_table = None
+    # Its options may inherit from new ancestors.
+    _InheritedChanged()
+    return command
+
+  def AddOption(self, command, name, **kwargs):
+    """Adds an option to command, as with command.AddOption().
+
+    Args:
+      command: A Command(), the command to add the option to.
+      name: A string, the name of the option.
+      kwargs: As for Option().
+
+    Raises:
+      ValueError: An invalid option parameter combination was supplied.
+    """
+    self.AddOptions(command, Options._NewOptions(name, kwargs))
+
+  def AddOptions(self, command, new):
+    """Adds Option() objects to command, replacing any of the same name.
+
+    The objects are not copied, so the same ones may be added to many
+    commands, as for an OptionDefinition(). Shared options must not be
+    changed.
+
+    Args:
+      command: A Command(), the command to add the options to.
+      new: A list of Option(), an option then its value option if keyvalue.
+    """
+    pending = self._unsorted.get(id(command))
+    if pending is None:
+      pending = (command, set(option.name for option in command.options))
+      self._unsorted[id(command)] = pending
+      self._roots[id(command.root)] = command.root
+    options = command.options
+    name = new[0].name
+    if name in pending[1]:
+      # A replacement for an existing option, and its keyvalue option.
+      if any(option.inherit for option in options):
+        _InheritedChanged()
+      options[:] = [option for option in options if option.name != name and
+                    (option.arg_key is None or option.arg_key.name != name)]
+    options.extend(new)
+    pending[1].update(option.name for option in new)
+    if new[0].inherit:
+      _InheritedChanged()
+
+  def Finish(self):
+    """Sorts the options added, and resets state held by the roots."""
+    for command, _ in self._unsorted.values():
+      command.options.sort()
+      command._completion_table = None
+    for root in self._roots.values():
+      root._TreeChanged()
+      root._completion_state = None
+    self._unsorted = {}
+    self._roots = {}
+
+
 def ParseTree(joint, tree):
   """Parses the given tree and adds as sub to 'joint'.
 
@@ -1408,60 +2865,575 @@ def ParseTree(joint, tree):
       a nested dict, but with the tree, Options are defined as a
       list/set rather than a dict.
   """
+  builder = TreeBuilder()
+  _ParseTree(builder, joint, tree)
+  builder.Finish()
+
+
+def _ParseTree(builder, joint, tree):
+  """Adds the tree below joint with builder. See ParseTree()."""
   if isinstance(tree, (set, tuple, list)):
     # If tree is a list type, convert to dict. A list type is usually how
     # options for a command are defined.
-    newtree = {}
-    for item in tree:
-      newtree[item] = {}
-    tree = newtree
+    tree = dict.fromkeys(tree, {})
   # Walk the tree, create items.
   for item, subs in tree.items():
     if isinstance(item, (CommandDefinition, PipeDefinition)):
       # Command or pipe item.
-      if joint.root == joint:
-        # Toplevel
-        newcmd = joint.AddCommand(*item.args, **item.kwargs)
-      else:
-        newcmd = joint.AddSubCommand(*item.args, **item.kwargs)
+      newcmd = builder.AddCommand(joint, *item.args, **item.kwargs)
       if isinstance(item, PipeDefinition):
         # Create a command for the pipe
         pipe_cmd = item.kwargs.get('pipe')
         newcmd.pipe = pipe_cmd
         newcmd.method = pipe_cmd.State
         newcmd.runnable = True
-        newcmd.AddOption('start', boolean=True, hidden=True)
-        newcmd.AddOption('stop', boolean=True, hidden=True)
+        builder.AddOption(newcmd, 'start', boolean=True, hidden=True)
+        builder.AddOption(newcmd, 'stop', boolean=True, hidden=True)
       # Recurse down the tree.
-      ParseTree(newcmd, subs)
+      _ParseTree(builder, newcmd, subs)
     elif isinstance(item, OptionDefinition):
-      # Option.
-      joint.AddOption(*item.args, **item.kwargs)
+      # Option, shared with other commands given the same definition.
+      builder.AddOptions(joint, item.GetOptions())
     elif isinstance(item, PipeShellDefinition):
       pipetree = ShellCommand()
       joint.pipetree = pipetree
     elif isinstance(item, PipeTreeDefinition):
       # Define a pipe tree at this point.
       pipetree = Command()
-      ParseTree(pipetree, item.kwargs['tree'])
+      _ParseTree(builder, pipetree, item.kwargs['tree'])
       joint.pipetree = pipetree
 
 
+def TreeHash(tree):
+  """Returns a hash of a tree definition, for use as a snapshot key.
+
+  Callables and classes are hashed by import path, other objects by their
+  type and attributes, so the hash is stable from one run to the next.
+  This walks the whole definition, so a key that is cheaper to find (eg
+  the program's version) saves more time where there is one.
+
+  Args:
+    tree: A tree definition, as for ParseTree().
+
+  Returns:
+    A str, the hex digest.
+  """
+  parts = [__version__]
+  _HashParts(tree, parts)
+  import hashlib
+  return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def _HashParts(value, parts, walking=None):
+  """Appends the strings to hash for a value of a tree definition.
+
+  Args:
+    value: The value to hash.
+    parts: A list of str, appended to.
+    walking: A set of the ids of the objects whose attributes are being
+      hashed, so that a cycle (eg a used pipe's command, which refers back
+      to the pipe) is hashed once.
+  """
+  if walking is None:
+    walking = set()
+  if isinstance(value, (str, int, float, type(None))):
+    parts.append(repr(value))
+  elif isinstance(value, Definition):
+    parts.append(type(value).__name__)
+    _HashParts(value.args, parts, walking)
+    _HashParts(sorted(value.kwargs.items()), parts, walking)
+  elif isinstance(value, dict):
+    parts.append('{')
+    for item in value.items():
+      _HashParts(item, parts, walking)
+    parts.append('}')
+  elif isinstance(value, (list, tuple)):
+    parts.append('[')
+    for item in value:
+      _HashParts(item, parts, walking)
+    parts.append(']')
+  elif isinstance(value, (set, frozenset)):
+    # Sets have no stable order, so their members are sorted.
+    members = []
+    for item in value:
+      member = []
+      _HashParts(item, member, walking)
+      members.append('\0'.join(member))
+    parts.append('(%s)' % '\1'.join(sorted(members)))
+  elif isinstance(value, (option_lib.Domain, option_lib.Catalog)):
+    # The values change at run time, so are not part of the tree.
+    parts.append(repr(value))
+  elif hasattr(value, '__qualname__') and not isinstance(value,
+                                                         types.MethodType):
+    parts.append('%s.%s' % (getattr(value, '__module__', ''),
+                            value.__qualname__))
+  elif id(value) in walking:
+    parts.append('<cycle>')
+  else:
+    walking.add(id(value))
+    try:
+      _HashObject(value, parts, walking)
+    finally:
+      walking.discard(id(value))
+
+
+def _HashObject(value, parts, walking):
+  """Appends the strings to hash for a bound method or other object.
+
+  Objects are hashed by their type and attributes. Those with neither
+  slots nor a __dict__ (eg a datetime.timedelta) are hashed by how they
+  pickle, or failing that by their repr().
+  """
+  if isinstance(value, types.MethodType):
+    _HashParts(value.__func__, parts, walking)
+    _HashParts(value.__self__, parts, walking)
+    return
+  _HashParts(type(value), parts, walking)
+  attributes = _Attributes(value)
+  if attributes:
+    _HashParts(sorted(attributes.items()), parts, walking)
+    return
+  try:
+    reduced = value.__reduce_ex__(pickle.HIGHEST_PROTOCOL)
+  except Exception:
+    parts.append(repr(value))
+    return
+  if isinstance(reduced, str):
+    parts.append(reduced)
+  else:
+    # The constructor, its arguments and any state.
+    _HashParts(tuple(reduced[:3]), parts, walking)
+
+
+# Names of the slots of classes, by class. See _Attributes().
+_SLOT_NAMES = {}
+
+
+def _Attributes(value):
+  """Returns the attributes of an object, from its slots and __dict__.
+
+  Args:
+    value: Any object.
+
+  Returns:
+    A dict, attribute values by name. Unset slots are left out.
+  """
+  instance_dict, attributes = _State(value)
+  attributes.update(instance_dict or ())
+  return attributes
+
+
+def _State(value):
+  """Returns the instance dict and the slots of an object.
+
+  Where possible, an object with no instance dict yet is not given one.
+
+  Args:
+    value: Any object.
+
+  Returns:
+    A tuple of the object's __dict__ (None if it has none), and a new dict
+    of the values of its slots by name, leaving out unset slots.
+  """
+  if hasattr(object, '__getstate__'):  # Python 3.11 on.
+    try:
+      state = object.__getstate__(value)
+    except TypeError:
+      state = getattr(value, '__dict__', None)
+    if isinstance(state, tuple):
+      return state[0], dict(state[1] or ())
+    return state, {}
+  cls = type(value)
+  names = _SLOT_NAMES.get(cls)
+  if names is None:
+    names = []
+    for base in reversed(cls.__mro__):
+      slots = base.__dict__.get('__slots__', ())
+      if isinstance(slots, str):
+        slots = (slots,)
+      names.extend(name for name in slots
+                   if name not in ('__dict__', '__weakref__'))
+    names = _SLOT_NAMES[cls] = tuple(names)
+  slots = {}
+  for name in names:
+    try:
+      slots[name] = getattr(value, name)
+    except AttributeError:
+      pass
+  return getattr(value, '__dict__', None), slots
+
+
+# Command attributes holding run time state, and so not in snapshots.
+_TRANSIENT = frozenset([
+    'command_line', 'token', 'jobs', 'pool', '_completion_cache',
+    '_completion_result', '_completion_page', '_completion_state',
+    '_completion_table'])
+
+
+# Attributes new snapshot objects start with, by class.
+_SNAPSHOT_DEFAULTS = {}
+
+
+def _SnapshotDefaults(cls):
+  """Returns the attributes a new Command or Option starts with.
+
+  Snapshots leave out attributes still holding these values, which keeps
+  them small and quick to load.
+
+  Args:
+    cls: A subclass of Command or option_lib.Option.
+
+  Returns:
+    A tuple of a dict of the attributes with immutable values, and a tuple
+    of the names of those starting as empty lists. Run time state is
+    included, though never saved.
+  """
+  if cls not in _SNAPSHOT_DEFAULTS:
+    if issubclass(cls, Command):
+      instance = Command()
+    else:
+      instance = option_lib.Option('')
+    values = {}
+    lists = []
+    for name, value in _Attributes(instance).items():
+      if value is None or isinstance(value, (bool, int, float, str, tuple)):
+        values[name] = value
+      elif type(value) is list and not value:
+        lists.append(name)
+    _SNAPSHOT_DEFAULTS[cls] = (values, tuple(lists))
+  return _SNAPSHOT_DEFAULTS[cls]
+
+
+def _NewSnapshotObject(cls):
+  """Creates a Command or Option being loaded from a snapshot."""
+  instance = cls.__new__(cls)
+  values, lists = _SnapshotDefaults(cls)
+  for name, value in values.items():
+    setattr(instance, name, value)
+  for name in lists:
+    setattr(instance, name, [])
+  return instance
+
+
+def _NewSnapshotPipe(cls, kwargs):
+  """Creates a pipe being loaded from a snapshot."""
+  return cls(**kwargs)
+
+
+def _ReducePipe(pipe_object):
+  """Returns how to pickle a pipe, as its class and constructor arguments.
+
+  The other attributes of a pipe are run time state. The arguments are
+  found in the attributes of the same names, as the pipes here keep them.
+
+  Args:
+    pipe_object: A pipe.Pipe.
+
+  Returns:
+    A tuple, as from object.__reduce__().
+
+  Raises:
+    pickle.PicklingError: An argument was not found.
+  """
+  cls = type(pipe_object)
+  kwargs = {}
+  if cls.__init__ is not object.__init__:
+    import inspect
+    parameters = list(inspect.signature(cls.__init__).parameters.values())
+    for parameter in parameters[1:]:
+      if parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+        continue
+      if parameter.name in pipe_object.__dict__:
+        kwargs[parameter.name] = pipe_object.__dict__[parameter.name]
+      elif parameter.default is parameter.empty:
+        raise pickle.PicklingError('%s has no attribute for argument %r' % (
+            cls.__name__, parameter.name))
+  return (_NewSnapshotPipe, (cls, kwargs))
+
+
+class _SnapshotPickler(pickle.Pickler):
+  """Pickles a command tree, leaving out run time state and defaults."""
+
+  def reducer_override(self, obj):
+    if isinstance(obj, pipe.Pipe):
+      return _ReducePipe(obj)
+    if not isinstance(obj, (Command, option_lib.Option)):
+      return NotImplemented
+    values, lists = _SnapshotDefaults(type(obj))
+    transient = _TRANSIENT if isinstance(obj, Command) else ()
+    state = {}
+    for name, value in _Attributes(obj).items():
+      if name in transient:
+        continue
+      if name in lists and type(value) is list and not value:
+        continue
+      if (name in values and type(value) is type(values[name]) and
+          value == values[name]):
+        continue
+      state[name] = value
+    items = iter(obj.items()) if isinstance(obj, Command) else None
+    # Set with setattr(), as for slots.
+    return (_NewSnapshotObject, (type(obj),), (None, state), None, items)
+
+
+def SaveSnapshot(command, path, key):
+  """Saves a built command tree to a file, for LoadSnapshot().
+
+  Functions, methods and classes in the tree are saved by import path, so
+  must be importable by name (eg not lambdas). Pipes are saved as their
+  class and constructor arguments. Other objects in the tree are saved
+  whole.
+
+  Args:
+    command: A Command(), the root of the tree.
+    path: A str, the file to write.
+    key: A str, identifying the tree definition. Eg TreeHash(tree).
+
+  Raises:
+    Error: The tree holds something that cannot be saved.
+  """
+  _PrepareSnapshot(command)
+  data = io.BytesIO()
+  data.write(SNAPSHOT_MAGIC + b' ' + key.encode() + b'\n')
+  try:
+    _SnapshotPickler(data, pickle.HIGHEST_PROTOCOL).dump(command)
+  except (pickle.PicklingError, TypeError, AttributeError) as e:
+    raise Error('Cannot snapshot the command tree: %s' % e)
+  temp_path = '%s.%d.tmp' % (path, os.getpid())
+  with open(temp_path, 'wb') as snapshot:
+    snapshot.write(data.getvalue())
+  os.replace(temp_path, path)
+
+
+def _PrepareSnapshot(command):
+  """Builds the lookup data of a tree's options, so it is saved too."""
+  for option in command.options:
+    if getattr(option.matcher, 'INDEXED', False):
+      option.matcher._Index()
+  if command.pipetree is not None:
+    _PrepareSnapshot(command.pipetree)
+  for subcommand in command.values():
+    _PrepareSnapshot(subcommand)
+
+
+def LoadSnapshot(path, key):
+  """Loads a command tree saved by SaveSnapshot().
+
+  The snapshot is unpickled, which can run arbitrary code. So the file
+  must be trusted as much as the program itself: written by SaveSnapshot()
+  and kept where only the program's owner can write.
+
+  Args:
+    path: A str, the file to read.
+    key: A str, as passed to SaveSnapshot().
+
+  Returns:
+    A Command(), the root of the tree. None if there is no snapshot, or it
+    is for another key, or cannot be loaded (eg a saved callable was
+    renamed).
+  """
+  try:
+    with open(path, 'rb') as snapshot:
+      data = snapshot.read()
+  except (IOError, OSError):
+    return None
+  header, _, body = data.partition(b'\n')
+  if header != SNAPSHOT_MAGIC + b' ' + key.encode():
+    return None
+  # The tree is all new objects, none of them garbage, so collecting
+  # while loading only wastes time.
+  collecting = gc.isenabled()
+  gc.disable()
+  try:
+    return pickle.loads(body)
+  except Exception:
+    return None
+  finally:
+    if collecting:
+      gc.enable()
+
+
+# Attributes that refer back up a tree, so are not followed by
+# MemoryReport().
+_BACK_REFERENCES = frozenset(['root', 'parent', 'command', 'option',
+                              'arg_key'])
+
+
+def MemoryReport(command):
+  """Reports the memory held by a command tree, eg to track bytes per node.
+
+  Counts the objects that make up the tree: commands, options, matchers,
+  and the lists, dicts and other objects they hold. Strings, numbers and
+  callables are not counted, as they are usually shared with the rest of
+  the program. An object shared by several commands is counted once. Lazy
+  commands are counted as they are, without loading them.
+
+  Args:
+    command: A Command(), the root of the tree.
+
+  Returns:
+    A dict. Keys are the type names of the objects, values lists of
+    [count, bytes]. The 'total' key is for all of them. Eg the bytes per
+    command are report['total'][1] / report['Command'][0].
+  """
+  report = {}
+  seen = set()
+  owned = (__name__, option_lib.__name__)
+  values = [command]
+  while values:
+    value = values.pop()
+    if (value is None or id(value) in seen or
+        isinstance(value, (str, bytes, int, float, type, types.ModuleType,
+                           types.FunctionType, types.MethodType,
+                           types.BuiltinFunctionType))):
+      continue
+    seen.add(id(value))
+    entry = report.setdefault(type(value).__name__, [0, 0])
+    entry[0] += 1
+    entry[1] += sys.getsizeof(value)
+    if isinstance(value, dict):
+      values.extend(value.values())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+      values.extend(value)
+    if type(value).__module__ in owned:
+      instance_dict, attributes = _State(value)
+      if instance_dict is not None:
+        values.append(instance_dict)
+        attributes.update(instance_dict)
+      for name, attribute in attributes.items():
+        if name not in _BACK_REFERENCES:
+          values.append(attribute)
+  report['total'] = [sum(entry[0] for entry in report.values()),
+                     sum(entry[1] for entry in report.values())]
+  return report
+
+
 # Define a basic tree for pipes that modules can use.
 _COMMAND, _OPTION, _PIPETREE, _PIPE = Definitions()
-DEFAULT_PIPETREE = {
-    _PIPE('more', help='One page at a time', pipe=pipe.MorePipe()): {},
-    _PIPE('grep', help='Find a string', pipe=pipe.GrepPipe()): (
-        _OPTION('string', helptext='String to find', match='\S',
-                required=True),
+
+
+def _DefaultPipeTree():
+  """Returns a new basic tree for pipes. See DEFAULT_PIPETREE."""
+  return {
+      _PIPE('more', help='One page at a time', pipe=pipe.MorePipe()): {},
+      _PIPE('grep', help='Find a string', pipe=pipe.GrepPipe()): (
+          _OPTION('string', helptext='String to find', match=r'\S',
+                  required=True),
+      ),
+      _PIPE('except', help='Except a string', pipe=pipe.ExceptPipe()): (
+          _OPTION('string', helptext='String to exclude', match=r'\S',
+                  required=True),
+      ),
+      _PIPE('count', help='Count lines', pipe=pipe.CountPipe()): {},
+      _PIPE('sh', help='pipe to shell command', pipe=pipe.ShellPipe()): (
+          _OPTION('string', helptext='Command to pipe to', match=r'\S',
+                  required=True),
+      ),
+      _PIPE('save', help='Save to a file', pipe=pipe.SavePipe()): (
+          _OPTION('path', helptext='File to save to', is_path=True,
+                  position=0, required=True),
+      ),
+      _PIPE('tee', help='Save to a file and display', pipe=pipe.TeePipe()): (
+          _OPTION('path', helptext='File to save to', is_path=True,
+                  position=0, required=True),
+      ),
+  }
+
+
+def __getattr__(name):
+  """Builds DEFAULT_PIPETREE, and its pipes, when it is first used."""
+  if name != 'DEFAULT_PIPETREE':
+    raise AttributeError(
+        "module '%s' has no attribute '%s'" % (__name__, name))
+  with _LOAD_LOCK:
+    tree = globals().get(name)
+    if tree is None:
+      tree = globals()[name] = _DefaultPipeTree()
+  return tree
+
+
+def _GetJob(command):
+  """Returns the job given on the command line, or the latest job."""
+  jobs = command.root.jobs
+  job = jobs and jobs.Get(command.GetOption('<job>'))
+  if job is None:
+    print('% No such job.')
+  return job
+
+
+def _PrintJob(job):
+  """Prints a line describing a background job, and its state."""
+  print('[%d] %-10s %s' % (job.id, job.state.capitalize(), job.command))
+
+
+def _ListJobs(command, unused_line):
+  """List background jobs."""
+  if command.root.jobs is not None:
+    for job in command.root.jobs.List():
+      _PrintJob(job)
+
+
+def _AttachJob(command, unused_line):
+  """Show the output of a job, following it until the job finishes.
+
+  Ctrl-c stops following the job, but leaves it running.
+  """
+  job = _GetJob(command)
+  if job is None:
+    return
+  offset = 0
+  try:
+    while True:
+      closed = job.output.closed
+      output, offset = job.output.Read(offset, timeout=executor.POLL_INTERVAL)
+      if output:
+        sys.stdout.write(output)
+        sys.stdout.flush()
+      elif closed:
+        break
+  except KeyboardInterrupt:
+    print('\n[%d] Detached' % job.id)
+    return
+  job.reported = True
+  _PrintJob(job)
+  command.root.jobs.Remove(job)
+
+
+def _WaitJob(command, unused_line):
+  """Wait for a job to finish."""
+  job = _GetJob(command)
+  if job is None:
+    return
+  try:
+    while not job.Wait(executor.POLL_INTERVAL):
+      pass
+  except KeyboardInterrupt:
+    print()
+    return
+  job.reported = True
+  _PrintJob(job)
+
+
+def _KillJob(command, unused_line):
+  """Cancel a job."""
+  job = _GetJob(command)
+  if job is None:
+    return
+  job.Cancel()
+  job.reported = job.finished
+  _PrintJob(job)
+
+
+# Define commands to manage background jobs, that modules can use.
+DEFAULT_JOBTREE = {
+    _COMMAND('jobs', help='List background jobs', method=_ListJobs): {},
+    _COMMAND('fg', help='Show the output of a job', method=_AttachJob): (
+        _OPTION('<job>', helptext='Job number', match=r'\d+', position=0),
     ),
-    _PIPE('except', help='Except a string', pipe=pipe.ExceptPipe()): (
-        _OPTION('string', helptext='String to exclude', match='\S',
-                required=True),
+    _COMMAND('wait', help='Wait for a job to finish', method=_WaitJob): (
+        _OPTION('<job>', helptext='Job number', match=r'\d+', position=0),
     ),
-    _PIPE('count', help='Count lines', pipe=pipe.CountPipe()): {},
-    _PIPE('sh', help='pipe to shell command', pipe=pipe.ShellPipe()): (
-        _OPTION('string', helptext='Command to pipe to', match='\S',
-                required=True),
+    _COMMAND('kill', help='Cancel a job', method=_KillJob): (
+        _OPTION('<job>', helptext='Job number', match=r'\d+', position=0),
     ),
 }
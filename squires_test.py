@@ -14,16 +14,53 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import contextlib
 import io
 import os
+import pickle
+import shutil
+import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unittest
 
 import squires
 
 TEST_PATH = '.'
 
+# Modules that squires imports only when they are needed, as they are slow
+# to import.
+DEFERRED_MODULES = ('asyncio', 'ctypes', 'datetime', 'hashlib', 'inspect',
+                    'ipaddress', 'mmap', 'readline', 'subprocess',
+                    'traceback')
+
+# Imports squires and runs a command, as a script would. Prints the deferred
+# modules imported by each step.
+IMPORT_SCRIPT = '''
+import sys
+import squires
+print(' '.join(sorted(set(sys.modules) & set(%r))))
+root = squires.Command('<root>')
+root.AddCommand('show', help='Show', method=lambda command, line: None)
+root.Execute(['show'])
+print(' '.join(sorted(set(sys.modules) & set(%r))))
+''' % (DEFERRED_MODULES, DEFERRED_MODULES)
+
+# A module of command methods, for testReferences.
+LAZY_MODULE = '''
+def Show(command, line):
+  return command.GetOption('colour')
+
+def Colours(option):
+  return ['red', 'green']
+'''
+
+
+def _Colours(unused_option):
+  return ['red', 'green']
+
 
 class CommandsTest(unittest.TestCase):
 
@@ -477,6 +514,40 @@ class CommandsTest(unittest.TestCase):
                          squires.COMPLETE_SUFFIX)
     squires.readline.get_line_buffer = get_line_buffer
 
+  def testCompleteBuffer(self):
+    result = self.cmd.Complete('show ve and more', 7)
+    self.assertEqual('show ve', result.line)
+    self.assertEqual('ve', result.word)
+    self.assertEqual({'version': 'version help'}, result.candidates)
+    self.assertEqual(['version' + squires.COMPLETE_SUFFIX], result.matches)
+    self.assertEqual('"vers', self.cmd.Complete('show "vers').word)
+    # The word is the last token, however it is quoted or escaped.
+    self.assertEqual('"a b', self.cmd.Complete('show desc "a b').word)
+    self.assertEqual('a\\ b', self.cmd.Complete('show desc a\\ b').word)
+    self.assertEqual('', self.cmd.Complete('show "a b" ').word)
+
+    driver = squires.CompletionDriver(self.cmd, 'sh')
+    self.assertEqual(None, driver.Tab())
+    self.assertEqual('show ', driver.buffer)
+    driver.Type('interface x')
+    # The common prefix is inserted, then a second tab lists.
+    self.assertEqual(None, driver.Tab())
+    self.assertEqual('show interface xe1', driver.buffer)
+    self.assertEqual(None, driver.Tab())
+    listing = ['', 'Valid completions:', ' xe1                   xe1 help',
+               ' xe10                  xe10 help']
+    self.assertEqual(listing, driver.Tab().split('\n'))
+    self.assertEqual(listing, driver.Help().split('\n'))
+    driver.Type(' zz')
+    self.assertEqual('\nNo valid completions.', driver.Tab())
+
+    driver = squires.CompletionDriver(self.cmd, 'show  interface')
+    driver.cursor = 5
+    driver.Type('v')
+    self.assertEqual(None, driver.Tab())
+    self.assertEqual('show version  interface', driver.buffer)
+    self.assertEqual(13, driver.cursor)
+
   def testComplete(self):
     """Test command completion."""
     self.assertEqual(
@@ -677,6 +748,136 @@ class CommandsTest(unittest.TestCase):
     self.assertEqual('two' + squires.COMPLETE_SUFFIX, root.ReadlineCompleter('', 1))
     self.assertEqual(None, root.ReadlineCompleter('', 2))
 
+  def testPagedCompletions(self):
+    root = squires.Command('<root>')
+    values = dict(('v%05d' % i, 'Value %d' % i) for i in range(5000))
+    root.AddCommand('set', help='Set', method=squires).AddOption(
+        'value', match=values, required=True)
+
+    class Output(io.StringIO):
+      writes = 0
+
+      def write(self, text):
+        self.writes += 1
+        return super(Output, self).write(text)
+
+    get_line_buffer = squires.readline.get_line_buffer
+    max_completions = squires.MAX_COMPLETIONS
+    squires.readline.get_line_buffer = lambda: 'set value v0'
+    squires.MAX_COMPLETIONS = 3
+    try:
+      matches = []
+      while not matches or matches[-1] is not None:
+        matches.append(root.ReadlineCompleter('v0', len(matches)))
+      # The first candidates, then the last to keep the common prefix.
+      self.assertEqual(['v00000', 'v00001', 'v00002', 'v04999', None],
+                       matches)
+
+      buf = Output()
+      sys.stdout = buf
+      root.FormatCompleterOptions('v0', matches[:-1], 6)
+      sys.stdout = sys.__stdout__
+      self.assertEqual(1, buf.writes)
+      self.assertEqual(
+          ['', 'Valid completions:', ' v00000                Value 0',
+           ' v00001                Value 1', ' v00002                Value 2',
+           ' ... 4997 more, list again for the next page', '> set value v0'],
+          buf.getvalue().splitlines())
+
+      # Listing the same line again shows the next page.
+      buf = Output()
+      sys.stdout = buf
+      root.FormatCompleterOptions('v0', matches[:-1], 6)
+      sys.stdout = sys.__stdout__
+      self.assertEqual(
+          [' v00003                Value 3', ' v00004                Value 4',
+           ' v00005                Value 5',
+           ' ... 4994 more, list again for the next page'],
+          buf.getvalue().splitlines()[2:6])
+    finally:
+      sys.stdout = sys.__stdout__
+      squires.readline.get_line_buffer = get_line_buffer
+      squires.MAX_COMPLETIONS = max_completions
+
+  def testMemoryReport(self):
+    root = squires.Command('<root>')
+    show = root.AddCommand('show', help='Show', method=squires)
+    show.AddOption('terse')
+    show.AddOption('colour', keyvalue=True, match=['red', 'green'])
+    option = show.GetOptionObject('terse')
+    self.assertFalse(hasattr(option, '__dict__'))
+    self.assertFalse(hasattr(option.matcher, '__dict__'))
+    self.assertEqual('terse', option.name)
+
+    report = squires.MemoryReport(root)
+    self.assertEqual([2, 2, 3, 2], [
+        report['Command'][0], report['Options'][0], report['Option'][0],
+        report['BooleanMatch'][0]])
+    self.assertEqual(1, report['ListMatch'][0])
+    self.assertEqual(sum(entry[1] for name, entry in report.items()
+                         if name != 'total'), report['total'][1])
+    self.assertGreater(report['Command'][1], 0)
+
+    # Attributes of a command's own go in its instance dict.
+    show.extra = ['x']
+    self.assertEqual(report['total'][0] + 2,
+                     squires.MemoryReport(root)['total'][0])
+
+  def testSnapshot(self):
+    COMMAND = squires.CommandDefinition
+    OPTION = squires.OptionDefinition
+    PIPETREE = squires.PipeTreeDefinition
+
+    def Tree(help):
+      return {
+          COMMAND('show', help=help, method=squires.ParseTree): {
+              COMMAND('colour', method=squires.ParseTree): (
+                  OPTION('name', match=_Colours, position=0),
+                  OPTION('shade', keyvalue=True, match=['dark', 'light']),
+                  OPTION('terse', group='format'),
+              ),
+          },
+          PIPETREE(tree=squires.DEFAULT_PIPETREE): {},
+      }
+
+    key = squires.TreeHash(Tree('Show'))
+    self.assertEqual(key, squires.TreeHash(Tree('Show')))
+    self.assertNotEqual(key, squires.TreeHash(Tree('Display')))
+    # Values with neither slots nor a __dict__ count, as do cycles.
+    self.assertNotEqual(
+        squires.TreeHash([squires.Duration('1s', '5s')]),
+        squires.TreeHash([squires.Duration('2s', '9s')]))
+    grep = squires.pipe.GrepPipe()
+    grep.cmd = squires.pipe.Pipe()
+    grep.cmd.method = grep.State
+    self.assertEqual(squires.TreeHash([grep]), squires.TreeHash([grep]))
+
+    root = squires.Command('<root>')
+    squires.ParseTree(root, Tree('Show'))
+    root['show'].command_line = ['colour']
+    self.assertEqual({'dark': '', 'light': ''},
+                     root.Complete('show colour red shade ').candidates)
+    path = os.path.join(tempfile.mkdtemp(), 'tree')
+    squires.SaveSnapshot(root, path, key)
+    self.assertEqual(None, squires.LoadSnapshot(path, 'other'))
+    self.assertEqual(None, squires.LoadSnapshot(path + 'x', key))
+
+    loaded = squires.LoadSnapshot(path, key)
+    self.assertEqual(str(root), str(loaded))
+    self.assertEqual(squires.ParseTree, loaded['show']['colour'].method)
+    self.assertIs(loaded, loaded['show']['colour'].root)
+    self.assertIs(loaded['show'], loaded['show']['colour'].parent)
+    self.assertEqual([], loaded['show'].command_line)
+    self.assertIsNot(loaded['show'].ancestors, loaded['show'].orig_ancestors)
+    for line in ('show colour ', 'show colour red shade ', 'show c | gr'):
+      self.assertEqual(root.Complete(line).candidates,
+                       loaded.Complete(line).candidates)
+    os.remove(path)
+
+    root['show'].AddSubCommand('other', method=lambda *args: None)
+    self.assertRaises(squires.Error, squires.SaveSnapshot, root, path, key)
+    self.assertFalse(os.path.exists(path))
+
   def testParseTree(self):
     COMMAND = squires.CommandDefinition
     OPTION = squires.OptionDefinition
@@ -708,6 +909,394 @@ class CommandsTest(unittest.TestCase):
     self.assertTrue(root['one'].options[0].helptext in ('Quickly', 'Slowly'))
     self.assertTrue(root['one'].options[1].helptext in ('Quickly', 'Slowly'))
 
+  def testTreeBuilder(self):
+    root = squires.Command('<root>')
+    root.AddCommand('show', help='Show').AddCommand('show old', help='Old')
+    builder = squires.TreeBuilder()
+    show = builder.AddCommand(root, 'show', help='New show', method=squires)
+    pager = builder.AddCommand(show, 'set pager', help='Pager')
+    builder.AddOption(pager, 'lines', match=['10', '20'], position=0)
+    builder.AddOption(pager, 'colour', keyvalue=True, match=['red'])
+    builder.AddOption(pager, 'fast')
+    builder.AddOption(pager, 'colour', keyvalue=True, match=['blue'])
+    builder.Finish()
+
+    self.assertEqual('New show', root['show'].help)
+    self.assertEqual('Old', root['show']['old'].help)
+    self.assertEqual('Pager', root['show']['set'].help)
+    self.assertEqual(['show', 'set', 'pager'], pager.path)
+    self.assertEqual(['show', 'set'], pager.orig_ancestors)
+    self.assertIs(root, pager.root)
+    self.assertEqual(['fast', 'colour', 'lines', '<colour__arg>'],
+                     [option.name for option in pager.options])
+    self.assertEqual(
+        ['blue'], pager.GetOptionObject('<colour__arg>').matcher.match)
+    self.assertIs(pager, root.GetCommand(['show', 'set', 'pager']))
+
+  def testSharedOptions(self):
+    COMMAND = squires.CommandDefinition
+    OPTION = squires.OptionDefinition
+    vrf = OPTION('vrf', keyvalue=True, match=['red', 'blue'])
+    detail = OPTION('detail', group='format')
+    root = squires.Command('<root>')
+    squires.ParseTree(root, {
+        COMMAND('show', help='Show'): {
+            COMMAND('route', help='Route', method=squires): (vrf, detail),
+            COMMAND('arp', help='ARP', method=squires): (vrf, detail),
+        },
+    })
+    squires.ParseTree(root, {
+        COMMAND('clear arp', help='Clear', method=squires): (vrf,)})
+
+    route = root['show']['route']
+    arp = root['show']['arp']
+    for option in route.options:
+      self.assertIs(option, arp.GetOptionObject(option.name))
+    self.assertIs(route.GetOptionObject('vrf'),
+                  root['clear']['arp'].GetOptionObject('vrf'))
+    self.assertEqual(['vrf', 'detail', '<vrf__arg>'],
+                     [option.name for option in arp.options])
+    self.assertEqual({'red': '', 'blue': ''},
+                     arp.Completer(['show', 'arp', 'vrf', ' ']))
+    # Each command reads the shared options against its own line.
+    arp.command_line = ['vrf', 'blue']
+    route.command_line = ['vrf', 'red']
+    self.assertEqual('blue', arp.GetOption('vrf'))
+    self.assertEqual('red', route.GetOption('vrf'))
+    # A command's own option replaces the shared one.
+    arp.AddOption('vrf', keyvalue=True, match=['green'])
+    self.assertEqual(['red', 'blue'],
+                     route.GetOptionObject('<vrf__arg>').matcher.match)
+
+  def testInheritedOptions(self):
+    show = self.cmd.AddCommand('show', help='Show')
+    show.AddOption('vrf', keyvalue=True, match=['red', 'blue'], inherit=True)
+    show.AddOption('terse', inherit=True)
+    show.AddOption('brief')
+    route = self.cmd.AddCommand('show route', help='Route', method=squires)
+    bgp = self.cmd.AddCommand('show route bgp', help='BGP', method=squires)
+    bgp.AddOption('vrf', keyvalue=True, match=['green'])
+
+    self.assertEqual([], list(route.options))
+    self.assertEqual(['vrf', 'terse', '<vrf__arg>'],
+                     [option.name for option in route.options.GetAllOptions()])
+    self.assertEqual(
+        ['<cr>', 'bgp', 'terse', 'vrf'],
+        sorted(self.cmd.Completer(['show', 'route', ' '])))
+    self.assertEqual({'red': '', 'blue': ''},
+                     self.cmd.Completer(['show', 'route', 'vrf', ' ']))
+    # The nearer option of the same name applies.
+    self.assertEqual({'green': ''},
+                     self.cmd.Completer(['show', 'route', 'bgp', 'vrf', ' ']))
+    self.assertIsNotNone(bgp.GetOptionObject('terse'))
+    self.assertIsNone(bgp.GetOptionObject('brief'))
+    route.command_line = ['vrf', 'blue', 'terse']
+    self.assertTrue(route.options.HasAllValidOptions(route.command_line))
+    self.assertEqual('blue', route.GetOption('vrf'))
+    self.assertTrue(route.GetOption('terse'))
+    # Options inherited later are seen by commands completed before.
+    show.AddOption('detail', inherit=True)
+    self.assertIn('detail', self.cmd.Completer(['show', 'route', ' ']))
+    # And those removed, or from ancestors a command is attached below.
+    show.options.remove('terse')
+    self.assertNotIn('terse', self.cmd.Completer(['show', 'route', ' ']))
+    ospf = squires.Command('ospf', help='OSPF', method=squires)
+    ospf.ancestors = ['show', 'route']
+    self.assertEqual([], ospf.options.GetAllOptions())
+    self.cmd.Attach(ospf)
+    self.assertIn('detail',
+                  self.cmd.Completer(['show', 'route', 'ospf', ' ']))
+
+  def testOptionLookup(self):
+    command = self.cmd.AddCommand('show route', help='Route', method=squires)
+    command.AddOption('terse', group='format', required=True)
+    command.AddOption('term')
+    command.AddOption('colour', keyvalue=True, match=['red', '/gr[ae]y/'])
+    command.AddOption('prefix', match=r'\d+\.\d+', boolean=False)
+    command.AddOption('vlan', match=r'\d+', boolean=False)
+    command.AddOption('name', match=r'(\w)\1+', boolean=False, position=0)
+    command.AddOption('peer', keyvalue=True, match=lambda o: ['alpha'])
+    options = command.options
+    lookup = options._GetLookup()
+
+    def Candidates(line, index):
+      return [option.name for option in lookup.Candidates(line, index)]
+
+    # Values from a method are always candidates.
+    self.assertEqual(['terse', 'term', '<peer__arg>'], Candidates(['te'], 0))
+    self.assertEqual(['<colour__arg>', '<peer__arg>'],
+                     Candidates(['term', 'grey'], 1))
+    self.assertEqual(['<peer__arg>', 'prefix', 'vlan'],
+                     Candidates(['term', '10.1'], 1))
+    self.assertEqual(['<peer__arg>', 'vlan', 'name'], Candidates(['11'], 0))
+    self.assertEqual(['<peer__arg>', 'vlan'], Candidates(['term', '11'], 1))
+    self.assertEqual(['<peer__arg>'], Candidates([' '], 0))
+    self.assertEqual({'format'}, lookup.required_groups)
+    self.assertTrue(
+        options.HasAllValidOptions(['11', 'colour', 'red', 'terse']))
+    # Changes to the options, or a list's values, rebuild the lookup.
+    matcher = command.GetOptionObject('<colour__arg>').matcher
+    matcher.match.append('green')
+    matcher.Changed()
+    self.assertIn('<colour__arg>', [
+        option.name for option in options._GetLookup().Candidates(
+            ['colour', 'gre'], 1)])
+    matcher.match[0] = 'blue'
+    matcher.Changed()
+    self.assertTrue(options.HasAllValidOptions(['colour', 'blue', 'terse']))
+    self.assertFalse(options.HasAllValidOptions(['colour', 'red', 'terse']))
+    command.AddOption('verbose')
+    self.assertEqual(['verbose'],
+                     list(options.GetOptionCompletes(['11', 've'])))
+    self.assertIsNot(lookup, options._lookup)
+    lookup = options._GetLookup()
+    self.assertIs(lookup, options._GetLookup())
+    options.append(squires.option_lib.Option('extra'))
+    self.assertIsNot(lookup, options._GetLookup())
+    flags = squires.Options(options[:2])
+    flags._GetLookup()
+    self.assertIsNone(pickle.loads(pickle.dumps(flags))._lookup)
+
+  def testDomain(self):
+    interfaces = squires.Domain('squires_test interfaces')
+    interfaces.Replace(['xe-0/0/%d' % i for i in range(100)])
+    show = self.cmd.AddCommand('show route', help='Route', method=squires)
+    show.AddOption('interface', keyvalue=True, match=interfaces)
+    clear = self.cmd.AddCommand('clear', help='Clear', method=squires)
+    clear.AddOption('interface', keyvalue=True,
+                    match=squires.Domain('squires_test interfaces'))
+    self.assertIs(show.GetOptionObject('<interface__arg>').matcher.domain,
+                  clear.GetOptionObject('<interface__arg>').matcher.domain)
+
+    def Complete(line):
+      return self.cmd.CompleteTokens(squires.SplitCommandLine(line))
+
+    self.assertEqual(['xe-0/0/5'] + ['xe-0/0/5%d' % i for i in range(10)],
+                     sorted(Complete('show route interface xe-0/0/5')))
+    self.assertEqual(['<cr>'],
+                     list(Complete('show route interface xe-0/0/50 ')))
+    # Removing a value is seen by the completion kept from the last line.
+    interfaces.Remove(['xe-0/0/50'])
+    self.assertEqual([], list(Complete('show route interface xe-0/0/50 ')))
+    interfaces.Add({'ge-1/0/0': 'Uplink'})
+    self.assertEqual({'ge-1/0/0': 'Uplink'},
+                     self.cmd.Completer(['clear', 'interface', 'g']))
+    self.assertTrue(show.options.HasAllValidOptions(['interface', 'ge-1/0/0']))
+    # Only the name is kept, so the tree hash does not change with the values.
+    tree = {squires.CommandDefinition('x'): (
+        squires.OptionDefinition('y', keyvalue=True, match=interfaces),)}
+    digest = squires.TreeHash(tree)
+    interfaces.Add(['ge-1/0/1'])
+    self.assertEqual(digest, squires.TreeHash(tree))
+
+  def testFuzzyCompletion(self):
+    hosts = ['%s-rack%02d-host%02d' % (site, rack, host)
+             for site in ('lon', 'nyc') for rack in range(10)
+             for host in range(20)]
+    ssh = self.cmd.AddCommand('ssh', help='Ssh', method=squires)
+    ssh.AddOption('host', position=0, match=hosts, fuzzy=True)
+    ssh.AddOption('port', keyvalue=True, match={'22': 'ssh', '830': 'netconf'})
+    ssh.AddOption('via', keyvalue=True, match=hosts[:20], fuzzy=True)
+    self.cmd.AddCommand('show interface', help='Interface', method=squires)
+    self.cmd.AddCommand('show version', help='Version', method=squires)
+
+    def Complete(line):
+      return sorted(self.cmd.CompleteTokens(squires.SplitCommandLine(line)))
+
+    # A prefix still completes by prefix.
+    self.assertEqual(['nyc-rack09-host%02d' % host for host in range(10, 20)],
+                     Complete('ssh nyc-rack09-host1'))
+    # Otherwise the closest values complete.
+    self.assertIn('nyc-rack04-host17', Complete('ssh rack04-host17'))
+    self.assertIn('lon-rack03-host12', Complete('ssh lon-rack03-hsot12'))
+    self.assertEqual(squires.option_lib.FUZZY_LIMIT,
+                     len(Complete('ssh host07')))
+    self.assertEqual([], Complete('ssh xyz'))
+    self.assertEqual(['830'], Complete('ssh nyc-rack01-host01 port 8'))
+    self.assertEqual(['lon-rack00-host19'],
+                     Complete('ssh nyc-rack01-host01 via hsot19'))
+    # Only values that match by prefix run.
+    self.assertFalse(ssh.options.HasAllValidOptions(['rack04-host17']))
+    self.assertTrue(ssh.options.HasAllValidOptions(['nyc-rack04-host17']))
+
+    self.assertEqual([], Complete('show intf'))
+    squires.FUZZY_COMMANDS = True
+    try:
+      self.assertEqual(['interface'], Complete('show intf'))
+      self.assertEqual(['interface', 'version'], Complete('show '))
+      self.assertEqual(['show', 'intf'],
+                       self.cmd.Disambiguate(['show', 'intf']))
+    finally:
+      squires.FUZZY_COMMANDS = False
+
+  def testExpandOption(self):
+    ports = squires.Domain('squires_test ports')
+    ports.Replace(['ge-%d/0/%d' % (fpc, port) for fpc in range(2)
+                   for port in range(48)] + ['xe-%d/1/0' % fpc
+                                             for fpc in range(3)])
+
+    def Targets(command, unused_line):
+      return list(command.GetOption('port')), command.GetOption('vlan')
+
+    clear = self.cmd.AddCommand('clear', help='Clear', method=Targets)
+    clear.AddOption('port', keyvalue=True, match=ports, expand=True,
+                    default='ge-0/0/0')
+    clear.AddOption('vlan', keyvalue=True, match=r'\d+', expand=True)
+
+    def Run(line):
+      return self.cmd.Execute(squires.SplitCommandLine(line),
+                              suppress_backspace=True)
+
+    ports_run, vlans = Run('clear port ge-1/0/[0-2,40] vlan 1[00-02]')
+    self.assertEqual(['ge-1/0/0', 'ge-1/0/1', 'ge-1/0/2', 'ge-1/0/40'],
+                     ports_run)
+    self.assertIsInstance(vlans, squires.Expansion)
+    self.assertEqual(['100', '101', '102'], list(vlans))
+    self.assertEqual((['xe-0/1/0', 'xe-1/1/0', 'xe-2/1/0'], None),
+                     Run('clear port xe-*/1/*'))
+    # A single value, and the default, are expansions too.
+    self.assertEqual(['xe-2/1/0'], Run('clear port xe-2')[0])
+    self.assertEqual(['ge-0/0/0'], Run('clear')[0])
+    self.assertEqual(['17'], list(Run('clear vlan 17')[1]))
+
+    # Patterns that expand to nothing, or have no values to match, do not
+    # run.
+    self.assertFalse(clear.options.HasAllValidOptions(
+        ['port', 'ge-1/0/[50-60]']))
+    self.assertFalse(clear.options.HasAllValidOptions(['vlan', '1*']))
+    self.assertFalse(clear.options.HasAllValidOptions(['vlan', '[5-1]']))
+    self.assertTrue(clear.options.HasAllValidOptions(['vlan', '[1-4000]']))
+    self.assertEqual({}, self.cmd.Completer(['clear', 'port', 'ge-*']))
+
+  def testTypedOptions(self):
+    def Route(command, unused_line):
+      return (command.GetOption('prefix'), command.GetOption('metric'),
+              command.GetOption('hold'))
+
+    route = self.cmd.AddCommand('route', help='Route', method=Route)
+    route.AddOption('prefix', position=0, match=squires.Network(4),
+                    helptext='Destination', required=True)
+    route.AddOption('metric', keyvalue=True, match=squires.Integer(0, 255),
+                    default='10')
+    route.AddOption('hold', keyvalue=True, match=squires.Duration())
+
+    def Run(line):
+      return self.cmd.Execute(squires.SplitCommandLine(line),
+                              suppress_backspace=True)
+
+    prefix, metric, hold = Run('route 10.1.0.0/16 metric 5 hold 2m')
+    self.assertEqual('10.1.0.0/16', str(prefix))
+    self.assertEqual(5, metric)
+    self.assertEqual(120, hold.total_seconds())
+    self.assertEqual((10, None), Run('route 10.0.0.0/8')[1:])
+
+    self.assertEqual({'<ipv4-prefix>': 'Destination'},
+                     self.cmd.Completer(['route', ' ']))
+    self.assertEqual({'<0-255>': ''},
+                     self.cmd.Completer(['route', '10.0.0.0/8', 'metric',
+                                         ' ']))
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+      self.assertFalse(route.options.HasAllValidOptions(
+          ['10.0.0.0/8', 'metric', '300'], describe=True))
+    self.assertIn('"300" is more than 255.', out.getvalue())
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+      self.assertFalse(route.options.HasAllValidOptions(['2001:db8::/32'],
+                                                        describe=True))
+    self.assertEqual('% Invalid value for "prefix". "2001:db8::/32" is not an'
+                     ' IPv4 prefix.\n', out.getvalue())
+
+  def testLazyCommand(self):
+    COMMAND = squires.CommandDefinition
+    OPTION = squires.OptionDefinition
+    loads = []
+
+    def LoadShow(command):
+      loads.append(command.name)
+      time.sleep(0.1)  # Let the other threads catch up.
+      return {
+          COMMAND('version', help='Version', method=squires): {},
+          COMMAND('interface', help='Interface', method=squires): (
+              OPTION('terse'),),
+      }
+
+    def LoadSet(command):
+      loads.append(command.name)
+      pools.append(command.root.pool)
+      command.AddSubCommand('pager', help='Pager', method=squires)
+
+    root = squires.Command('<root>')
+    squires.ParseTree(root, {
+        COMMAND('show', help='Show', loader=LoadShow): {},
+        COMMAND('set', help='Set', loader=LoadSet): {},
+    })
+    self.assertEqual({'set': 'Set', 'show': 'Show'}, root.Completer(['s']))
+    self.assertEqual([], loads)
+
+    threads = [threading.Thread(target=root.GetCommand,
+                                args=(['show', 'version'],))
+               for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(['show'], loads)
+    self.assertEqual({'interface': 'Interface', 'version': 'Version'},
+                     root.Completer(['show', ' ']))
+    self.assertEqual({'<cr>': 'Execute this command', 'terse': None},
+                     root.Completer(['show', 'interface', ' ']))
+    self.assertEqual(['show'], loads)
+    self.assertIsNotNone(root['set'].loader)
+    # Loading keeps the pool, which is never taken from the root meanwhile.
+    pools = []
+    pool = root.pool = squires.executor.Pool(root._RunInWorker)
+    pager = root.GetCommand(['set', 'pager'])
+    self.assertIs(root['set']['pager'], pager)
+    self.assertEqual(['show', 'set'], loads)
+    self.assertEqual([pool], pools)
+    self.assertIs(pool, root.pool)
+
+  def testReferences(self):
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    with open(os.path.join(tmpdir, 'squires_lazy_module.py'), 'w') as f:
+      f.write(LAZY_MODULE)
+    sys.path.insert(0, tmpdir)
+    self.addCleanup(sys.path.remove, tmpdir)
+    self.addCleanup(sys.modules.pop, 'squires_lazy_module', None)
+
+    COMMAND = squires.CommandDefinition
+    OPTION = squires.OptionDefinition
+    root = squires.Command('<root>')
+    squires.ParseTree(root, {
+        COMMAND('show', help='Show', method='squires_lazy_module:Show'): (
+            OPTION('colour', keyvalue=True,
+                   match=squires.Reference('squires_lazy_module:Colours')),),
+        COMMAND('set', method='squires_lazy_module:Show'): {},
+    })
+    self.assertEqual('', root['set'].help)
+    self.assertTrue(root['set'].runnable)
+    self.assertEqual({'<cr>': 'Execute this command', 'colour': None},
+                     root.Completer(['show', ' ']))
+    self.assertNotIn('squires_lazy_module', sys.modules)
+
+    self.assertEqual({'green': '', 'red': ''},
+                     root.Completer(['show', 'colour', ' ']))
+    self.assertIn('squires_lazy_module', sys.modules)
+    command = root.GetCommand(['show', 'colour', 'red'])
+    self.assertEqual('red', command.Run(['show', 'colour', 'red']))
+
+  def testDeferredImports(self):
+    # A fresh interpreter, without site packages that import for their own
+    # sake.
+    output = subprocess.check_output(
+        [sys.executable, '-S', '-c', IMPORT_SCRIPT],
+        cwd=os.path.dirname(os.path.abspath(squires.__file__)),
+        universal_newlines=True).splitlines()
+    self.assertEqual(['', ''], output)
+    self.assertIn('more', [key.args[0] for key in squires.DEFAULT_PIPETREE])
+
   def testPipe(self):
     class testPipe(squires.pipe.Pipe):
       pass
@@ -749,6 +1338,330 @@ class CommandsTest(unittest.TestCase):
     self.assertFalse(root['two']['four'].WillPipe(
         ['two', 'four', 'grep']))
 
+  def testGeneratorOutput(self):
+    class HeadPipe(squires.pipe.Pipe):
+      """Accepts two lines, then closes."""
+
+      def Begin(self):
+        self.lines = []
+
+      def write(self, string):
+        if len(self.lines) == 2:
+          raise squires.pipe.PipeClosed('closed')
+        self.lines.append(string)
+
+    produced = []
+    closed = []
+
+    def Producer(unused_cmd, unused_line):
+      try:
+        for i in range(1000):
+          produced.append(i)
+          yield 'line %d' % i
+      finally:
+        closed.append(True)
+
+    head = HeadPipe()
+    root = squires.Command('<root>')
+    squires.ParseTree(root, {
+        squires.PipeTreeDefinition(tree={
+            squires.PipeDefinition('head', pipe=head): {},
+        }): {},
+        squires.CommandDefinition('produce', method=Producer): {},
+    })
+    self.assertEqual(None, root.Execute(['produce', '|', 'head'],
+                                        suppress_backspace=True))
+    self.assertEqual(['line 0\n', 'line 1\n'], head.lines)
+    self.assertEqual([0, 1, 2], produced)
+    self.assertEqual([True], closed)
+    self.assertTrue(sys.stdout is not head)
+
+  def testSavePipe(self):
+    tmpdir = tempfile.mkdtemp()
+    source = os.path.join(tmpdir, 'source')
+    saved = os.path.join(tmpdir, 'saved')
+    with open(source, 'wb') as f:
+      f.write(b'dump\n' * 1000)
+
+    def Dump(unused_cmd, unused_line):
+      print('header')
+      with open(source, 'rb') as f:
+        squires.pipe.SendFile(f)
+
+    root = squires.Command('<root>')
+    squires.ParseTree(root, {
+        squires.PipeTreeDefinition(tree=squires.DEFAULT_PIPETREE): {},
+        squires.CommandDefinition('dump', method=Dump): {},
+    })
+    try:
+      # The file does not exist yet, but is a valid argument.
+      root.Execute(['dump', '|', 'save', saved], suppress_backspace=True)
+      with open(saved, 'rb') as f:
+        self.assertEqual(b'header\n' + b'dump\n' * 1000, f.read())
+    finally:
+      for name in os.listdir(tmpdir):
+        os.remove(os.path.join(tmpdir, name))
+      os.rmdir(tmpdir)
+
+  def testTimeout(self):
+    class StatePipe(squires.pipe.Pipe):
+
+      def Begin(self):
+        self.stopped = False
+
+      def End(self):
+        self.stopped = True
+
+    def Hang(cmd, unused_line):
+      cmd.token.Wait()
+
+    state = StatePipe()
+    root = squires.Command('<root>')
+    squires.ParseTree(root, {
+        squires.PipeTreeDefinition(tree={
+            squires.PipeDefinition('state', pipe=state): {},
+        }): {},
+        squires.CommandDefinition('hang', method=Hang, executor='thread'): {},
+        squires.CommandDefinition('quick', method=lambda *_: 'ok',
+                                  timeout=5): {},
+    })
+    self.assertEqual(None, root.GetTimeout())
+    self.assertEqual(5, root['quick'].GetTimeout())
+    self.assertEqual('inline', root['quick'].GetExecutor())
+    self.assertEqual('thread', root['hang'].GetExecutor())
+
+    # A global timeout applies to all commands.
+    root.timeout = 0.1
+    self.assertEqual(0.1, root['hang'].GetTimeout())
+    buf = io.StringIO()
+    sys.stdout = buf
+    try:
+      self.assertFalse(root.Execute(['hang', '|', 'state'],
+                                    suppress_backspace=True))
+    finally:
+      sys.stdout = sys.__stdout__
+    self.assertTrue(state.stopped)
+    self.assertTrue(root['hang'].token.cancelled)
+    self.assertEqual('% Command timed out after 0.1s\n', buf.getvalue())
+    self.assertEqual('ok', root.Execute(['quick'], suppress_backspace=True))
+
+  def testProcessPool(self):
+    def Parse(cmd, unused_line):
+      for i in range(int(cmd.GetOption('count'))):
+        print('line %d from %d' % (i, os.getpid()))
+      return os.getpid()
+
+    root = squires.Command('<root>')
+    squires.ParseTree(root, {
+        squires.PipeTreeDefinition(tree=squires.DEFAULT_PIPETREE): {},
+        squires.CommandDefinition('parse', method=Parse, executor='process',
+                                  cpu_limit=10, memory_limit=1 << 34): (
+            squires.OptionDefinition('count', match=r'\d+', position=0),
+        ),
+    })
+    self.assertEqual({'cpu': 10, 'memory': 1 << 34},
+                     root['parse'].GetLimits())
+    root.memory_limit = 1 << 33
+    root['parse'].memory_limit = None
+    self.assertEqual({'cpu': 10, 'memory': 1 << 33},
+                     root['parse'].GetLimits())
+    pool = root.StartPool(size=1)
+    self.assertEqual(pool, root['parse'].root.pool)
+    buf = io.StringIO()
+    # Pipes write to the terminal.
+    output = squires.pipe.SetThreadOutput((None, buf))
+    try:
+      pid = root.Execute(['parse', '3', '|', 'grep', 'line [02]'],
+                         suppress_backspace=True)
+    finally:
+      squires.pipe.SetThreadOutput(output)
+    self.assertNotEqual(os.getpid(), pid)
+    self.assertEqual('line 0 from %d\nline 2 from %d\n' % (pid, pid),
+                     buf.getvalue())
+
+    # Changing the tree restarts the workers with it.
+    squires.ParseTree(root, {
+        squires.CommandDefinition('other', method=Parse): {},
+    })
+    self.assertIs(pool, root.pool)
+    buf = io.StringIO()
+    sys.stdout = buf
+    try:
+      self.assertNotEqual(pid, root.Execute(['parse', '0'],
+                                            suppress_backspace=True))
+    finally:
+      sys.stdout = sys.__stdout__
+      root.ClosePool()
+
+  def testBackgroundJobs(self):
+    release = squires.executor.CancelToken()
+
+    def Collect(cmd, unused_line):
+      print('collecting %s' % cmd.GetOption('what'))
+      release.Wait()
+      print('collected')
+
+    def Hang(cmd, unused_line):
+      cmd.token.Wait()
+
+    root = squires.Command('<root>')
+    squires.ParseTree(root, squires.DEFAULT_JOBTREE)
+    squires.ParseTree(root, {
+        squires.PipeTreeDefinition(tree=squires.DEFAULT_PIPETREE): {},
+        squires.CommandDefinition('collect', method=Collect): (
+            squires.OptionDefinition('what', match=r'\w+', position=0),
+        ),
+        squires.CommandDefinition('hang', method=Hang): {},
+        squires.CommandDefinition('say', method=lambda *_: print('said')): {},
+    })
+    stdout = sys.stdout
+    buf = io.StringIO()
+    sys.stdout = buf
+    try:
+      job = root.Execute(['collect', 'logs', '|', 'grep', 'coll', '&'])
+      self.assertEqual('collect logs | grep coll', job.command)
+      hung = root.Execute(['hang', '&'])
+      while hung.state != 'running':
+        time.sleep(0.01)
+      # The prompt can carry on while the jobs run.
+      root.Execute(['jobs'])
+      self.assertEqual(
+          '[1] collect logs | grep coll\n[2] hang\n'
+          '\r[1] Running    collect logs | grep coll\n'
+          '[2] Running    hang\n', buf.getvalue())
+      # The job's command line is its own.
+      root.Completer(['collect', 'other'])
+      # The job's pipe is its own too.
+      while 'collecting' not in job.output.Read(0, 0)[0]:
+        time.sleep(0.01)
+      root.Execute(['say', '|', 'grep', 'said'], suppress_backspace=True)
+      release.Cancel()
+      buf.truncate(0)
+      buf.seek(0)
+      root.Execute(['fg', '1'])
+      self.assertEqual('\rcollecting logs\ncollected\n'
+                       '[1] Done       collect logs | grep coll\n',
+                       buf.getvalue())
+      self.assertEqual([hung], root.jobs.List())
+
+      buf.truncate(0)
+      buf.seek(0)
+      root.Execute(['kill'])
+      self.assertEqual('\r[2] Cancelled  hang\n', buf.getvalue())
+      buf.truncate(0)
+      buf.seek(0)
+      root._ReportJobs()
+      root.Execute(['fg', '3'])
+      self.assertEqual('\r% No such job.\n', buf.getvalue())
+    finally:
+      sys.stdout = stdout
+
+  def testCompleteTokens(self):
+    command = self.cmd['show']['version']
+    command.AddOption('software')
+    command.AddOption('hardware', keyvalue=True, match={'cpu': 'CPU',
+                                                        'disk': 'Disk'})
+    walks = []
+    counting = []
+    find_completer = self.cmd._FindCompleter
+
+    def FindCompleter(line):
+      if counting:
+        walks.append(line)
+      return find_completer(line)
+
+    self.cmd._FindCompleter = FindCompleter
+
+    def Complete(line):
+      tokens = squires.SplitCommandLine(line)
+      full = list(tokens) + ([' '] if tokens.trailing_space else [])
+      expected = self.cmd.Completer(full)
+      counting.append(True)
+      try:
+        completes = self.cmd.CompleteTokens(tokens)
+      finally:
+        counting.pop()
+      self.assertEqual(expected, completes)
+      return completes
+
+    # Typing within the last token resumes from the 'version' command.
+    self.assertEqual({'software': None, 'hardware': None},
+                     Complete('sh ver '))
+    del walks[:]
+    self.assertEqual({'software': None}, Complete('sh ver s'))
+    self.assertEqual({'software': None}, Complete('sh ver so'))
+    self.assertEqual({'software': None}, Complete('sh ver "so'))
+    self.assertEqual([], walks)
+    # As does completing the options' values.
+    self.assertEqual({'cpu': 'CPU'}, Complete('sh ver hardware c'))
+    self.assertEqual(1, len(walks))
+    self.assertEqual({'cpu': 'CPU', 'disk': 'Disk'},
+                     Complete('sh ver hardware '))
+    self.assertEqual(1, len(walks))
+    # An edit before the last token walks the tree again.
+    self.assertEqual({'xe10': 'xe10 help', 'xe1': 'xe1 help'},
+                     Complete('sh int x'))
+    self.assertEqual(2, len(walks))
+    # Changing the tree discards the kept state.
+    self.assertEqual({'software': None}, Complete('sh ver s'))
+    self.assertEqual(3, len(walks))
+    command.AddOption('serial')
+    self.assertEqual({'software': None, 'serial': None},
+                     Complete('sh ver s'))
+    self.assertEqual(4, len(walks))
+
+  def testCompletionTable(self):
+    interface = self.cmd['show']['interface']
+    interface.runnable = True
+    completes = self.cmd.Completer(['show', 'interface', ' '])
+    self.assertEqual(['<cr>', 'teal', 'terse', 'xe1', 'xe10'],
+                     squires._SortedCandidates(completes))
+    self.assertEqual(['teal', 'terse'], list(
+        self.cmd.Completer(['show', 'interface', 'te'])))
+    # Static options are held by the table too.
+    interface.AddOption('detail', helptext='More')
+    interface.AddOption('colour', match={'red': 'Red', 'blue': 'Blue'})
+    self.assertTrue(interface._GetCompletionTable().static_options)
+    self.assertEqual(
+        ['<cr>', 'blue', 'detail', 'red', 'teal', 'terse', 'xe1', 'xe10'],
+        list(self.cmd.Completer(['show', 'interface', ' '])))
+    self.assertEqual({'detail': 'More'},
+                     self.cmd.Completer(['show', 'interface', 'd']))
+    # Added subcommands, and changes to hidden, show straight away.
+    self.cmd.AddCommand('show interface dummy', help='dummy help')
+    interface['terse'].hidden = True
+    self.assertEqual({'dummy': 'dummy help'},
+                     self.cmd.Completer(['show', 'interface', 'du']))
+    self.assertEqual({'teal': 'teal help'},
+                     self.cmd.Completer(['show', 'interface', 'te']))
+    # As do subcommands deleted, and values changed, in place.
+    del interface['dummy']
+    self.assertEqual({}, self.cmd.Completer(['show', 'interface', 'du']))
+    self.assertEqual(['show', 'interface', 'du'],
+                     self.cmd.Disambiguate(['sh', 'int', 'du']))
+    teal = interface.pop('teal')
+    self.assertEqual({}, self.cmd.Completer(['show', 'interface', 'te']))
+    interface.update(teal=teal)
+    self.assertEqual({'teal': 'teal help'},
+                     self.cmd.Completer(['show', 'interface', 'te']))
+    matcher = interface.GetOptionObject('colour').matcher
+    matcher.match['green'] = 'Green'
+    matcher.Changed()
+    self.assertEqual({'green': 'Green'},
+                     self.cmd.Completer(['show', 'interface', 'g']))
+    # Methods are always called.
+    calls = []
+
+    def Units(*unused_args):
+      calls.append(1)
+      return ['dozen', 'gross']
+
+    interface.AddOption('unit', match=Units)
+    self.assertFalse(interface._GetCompletionTable().static_options)
+    self.assertEqual({'dozen': ''},
+                     self.cmd.Completer(['show', 'interface', 'do']))
+    self.assertTrue(calls)
+
   def testSplitCommandLine(self):
     expected_tokens = ['command', 'subcommand', 'parameter', '|', 'pipe']
 
@@ -774,6 +1687,35 @@ class CommandsTest(unittest.TestCase):
                        'pipe', '"', '\\']
     self.assertEqual(tokens, expected_tokens)
 
+    command = "a'b c'd \"\" e"
+    self.assertEqual(['ab cd', '', 'e'], self.cmd._SplitCommandLine(command))
+    self.assertRaises(ValueError, self.cmd._SplitCommandLine, 'a "b')
+    self.assertRaises(ValueError, self.cmd._SplitCommandLine, 'a b\\')
+
+  def testSplitCommandLineState(self):
+    tokens = squires.SplitCommandLine('show "ver sion"|grep  ')
+    self.assertEqual(['show', 'ver sion', '|', 'grep'], tokens)
+    self.assertEqual([(0, 4), (5, 15), (15, 16), (16, 20)], tokens.offsets)
+    self.assertTrue(tokens.complete)
+    self.assertTrue(tokens.trailing_space)
+
+    # Unterminated quotes and escapes are closed at the end of the line.
+    tokens = squires.SplitCommandLine("show 'ver sion ")
+    self.assertEqual(['show', 'ver sion '], tokens)
+    self.assertEqual([(0, 4), (5, 15)], tokens.offsets)
+    self.assertEqual("'", tokens.quote)
+    self.assertFalse(tokens.complete)
+    self.assertFalse(tokens.trailing_space)
+    tokens = squires.SplitCommandLine('show "a\\"b')
+    self.assertEqual(['show', 'a"b'], tokens)
+    self.assertEqual('"', tokens.quote)
+    tokens = squires.SplitCommandLine('show a\\')
+    self.assertEqual(['show', 'a'], tokens)
+    self.assertTrue(tokens.escape)
+    self.assertFalse(tokens.complete)
+    self.assertEqual([], squires.SplitCommandLine(''))
+    self.assertTrue(squires.SplitCommandLine(' ').trailing_space)
+
 
 class ShellCommandTest(unittest.TestCase):
   def testShellCommand(self):